@@ -1,85 +1,302 @@
+import time
+
 import numpy as np
 from math import inf as infinity
 
+import bitboard as bb
+import perfect
+import stats
 
-# checks the play grid to see if the game has ended
-def check_victory(g):
-    v = None
+# score of each result code for the minimax algorithm
+SCORES = {bb.NONE: 0, bb.WHITE: +1, bb.BLACK: -1, bb.DRAW: 0}
 
-    # check if all spaces have been selected
-    if g.min() != 0:
-        v = "draw"  # the game is a draw
+# flags of the transposition table entries
+EXACT, LOWER, UPPER = 0, 1, 2
 
-    # check if there is any horizontal, vertical or diagonal line
-    win_state = [
-        [g[0][0], g[0][1], g[0][2]],
-        [g[1][0], g[1][1], g[1][2]],
-        [g[2][0], g[2][1], g[2][2]],
-        [g[0][0], g[1][0], g[2][0]],
-        [g[0][1], g[1][1], g[2][1]],
-        [g[0][2], g[1][2], g[2][2]],
-        [g[0][0], g[1][1], g[2][2]],
-        [g[2][0], g[1][1], g[0][2]],
-    ]
+# entries kept in the transposition table of a grid size, the oldest ones are dropped beyond it
+MAX_TABLE_ENTRIES = 1 << 18
 
-    if [1, 1, 1] in win_state:
-        return "white"  # white wins
-    elif [2, 2, 2] in win_state:
-        return "black"  # black wins
-    return v
+# score of a win, larger than any value of the heuristic
+WIN_SCORE = 1 << 48
 
+# default time, in seconds, for a move on grids that cannot be searched exhaustively
+DEFAULT_TIME_LIMIT = 1.0
 
-# heuristic for the minimax algorithm
-def evaluate(state):
-    if check_victory(state) == "white":
-        score = +1
-    elif check_victory(state) == "black":
-        score = -1
-    else:
+# statistics of the last search done by make_move_minimax
+search_stats = {"nodes": 0, "tt_hits": 0, "depth": 0, "complete": True}
+
+# upper bounds of the buckets of the histogram of nodes per search
+NODE_BOUNDS = (10, 100, 1000, 10000, 100000, 1000000)
+
+
+class SearchTimeout(Exception):
+    pass
+
+
+'''
+    Alpha-beta search for m,n,k games. Every grid geometry has its own instance and its own
+    transposition table, which persists across moves and games. The keys of the table are the
+    canonical position (see bitboard.Geometry.canonical) and the side to move, the values are
+    tuples (depth, flag, score, move). The table keeps at most MAX_TABLE_ENTRIES entries, the
+    oldest ones being dropped first.
+'''
+class Search:
+    def __init__(self, rows, cols, k):
+        self.geo = bb.geometry(rows, cols, k)
+        self.table = {}
+        self.nodes = 0
+        self.tt_hits = 0
+        self.deadline = None
+
+    # heuristic for non-terminal leaves: every line still open for a single side is worth 10^pieces
+    def evaluate(self, white, black):
         score = 0
+        for m in self.geo.win_masks:
+            if not m & black:
+                if m & white:
+                    score += 10 ** bin(m & white).count("1")
+            elif not m & white:
+                score -= 10 ** bin(m & black).count("1")
+        return score
 
-    return score
+    # returns the moves of the position, trying the best move found in a previous search first
+    def ordered_moves(self, empty, first=None):
+        moves = [x for x in self.geo.center_order if empty >> x & 1]
+        if first is not None and first in moves:
+            moves.remove(first)
+            moves.insert(0, first)
+        return moves
 
+    '''
+        Wins are scored as WIN_SCORE + number of empty cells, so faster wins and slower losses are
+        preferred, and the score of a position does not depend on how it was reached.
+    '''
+    def alphabeta(self, white, black, last, depth, white_turn, alpha, beta):
+        self.nodes += 1
+        if self.deadline is not None and self.nodes & 1023 == 0 and time.perf_counter() > self.deadline:
+            raise SearchTimeout()
 
-def minimax(state, depth, white_turn):
-    if white_turn:
-        best = [-1, -1, -infinity]
-    else:
-        best = [-1, -1, +infinity]
+        empty = self.geo.full_mask & ~(white | black)
+        num_empty = bin(empty).count("1")
+        # only the side that has just moved can have completed a line
+        if last is not None:
+            if not white_turn and self.geo.wins_through(white, last):
+                return WIN_SCORE + num_empty
+            if white_turn and self.geo.wins_through(black, last):
+                return -WIN_SCORE - num_empty
+        if num_empty == 0:
+            return 0
+        if depth == 0:
+            return self.evaluate(white, black)
 
-    if depth == 9:
-        return [1, 1, 0]  # always pick the middle cell at the start of the game
+        # a search deeper than the number of empty cells is complete
+        depth = min(depth, num_empty)
+        key = (self.geo.canonical(white, black), white_turn)
+        entry = self.table.get(key)
+        tt_move = None
+        if entry is not None:
+            entry_depth, flag, score, tt_move = entry
+            if entry_depth >= depth:
+                self.tt_hits += 1
+                if flag == EXACT:
+                    return score
+                elif flag == LOWER:
+                    alpha = max(alpha, score)
+                else:
+                    beta = min(beta, score)
+                if alpha >= beta:
+                    return score
 
-    if depth == 0 or evaluate(state) != 0:
-        score = evaluate(state)
-        return [-1, -1, score]
+        alpha_orig, beta_orig = alpha, beta
+        best = -infinity if white_turn else +infinity
+        best_move = None
+        for x in self.ordered_moves(empty, tt_move if key[0] == (white, black) else None):
+            bit = 1 << x
+            if white_turn:
+                score = self.alphabeta(white | bit, black, x, depth - 1, False, alpha, beta)
+                if score > best:
+                    best, best_move = score, x  # max value
+                alpha = max(alpha, best)
+            else:
+                score = self.alphabeta(white, black | bit, x, depth - 1, True, alpha, beta)
+                if score < best:
+                    best, best_move = score, x  # min value
+                beta = min(beta, best)
+            if alpha >= beta:
+                break
 
-    # iterate through every empty cell
-    moves = [s for s, v in np.ndenumerate(state) if v == 0]
-    for x in moves:
-        if white_turn:
-            state[x] = 1
-        else:
-            state[x] = 2
-        score = minimax(state, depth - 1, not white_turn)
-        state[x] = 0
-        score[0], score[1] = x[0], x[1]
-
-        if white_turn:
-            if score[2] > best[2]:
-                best = score  # max value
+        if best <= alpha_orig:
+            flag = UPPER
+        elif best >= beta_orig:
+            flag = LOWER
         else:
-            if score[2] < best[2]:
-                best = score  # min value
+            flag = EXACT
+        if key not in self.table and len(self.table) >= MAX_TABLE_ENTRIES:
+            # dictionaries keep the order of insertion, the first key is the oldest entry
+            del self.table[next(iter(self.table))]
+        self.table[key] = (depth, flag, best, best_move)
+        return best
+
+    # searches every move of the root to the given depth and returns the best one as (score, cell)
+    def search_root(self, white, black, depth, white_turn, first=None):
+        best_score = -infinity if white_turn else +infinity
+        best_move = None
+        alpha, beta = -infinity, +infinity
+        for x in self.ordered_moves(self.geo.full_mask & ~(white | black), first):
+            bit = 1 << x
+            try:
+                if white_turn:
+                    score = self.alphabeta(white | bit, black, x, depth - 1, False, alpha, beta)
+                else:
+                    score = self.alphabeta(white, black | bit, x, depth - 1, True, alpha, beta)
+            except SearchTimeout as timeout:
+                # the moves that were fully searched are still a valid answer if the previous best was one of them
+                timeout.partial = (best_score, best_move) if best_move is not None else None
+                raise
+            if (white_turn and score > best_score) or (not white_turn and score < best_score):
+                best_score, best_move = score, x
+                if white_turn:
+                    alpha = score
+                else:
+                    beta = score
+        return best_score, best_move
+
+    '''
+        Iterative deepening search. Returns the best move as (score, cell), and always has an answer
+        when the time runs out: the result of the deepest completed iteration.
+        time_limit: Seconds available for the move, None to search until the game is solved.
+        max_depth:  Maximum number of plies searched, None to search until the game is solved.
+    '''
+    def search(self, white, black, white_turn, time_limit=None, max_depth=None):
+        self.nodes = 0
+        self.tt_hits = 0
+        self.deadline = None if time_limit is None else time.perf_counter() + time_limit
+
+        empty = self.geo.full_mask & ~(white | black)
+        num_empty = bin(empty).count("1")
+        if max_depth is None:
+            max_depth = num_empty
+
+        # fallback in case not even the first iteration completes
+        best_score, best_move = 0, self.ordered_moves(empty)[0]
+        depth_done = 0
+        # without a time limit there is no need for the shallower iterations
+        first_depth = 1 if time_limit is not None else max_depth
+        for depth in range(first_depth, max_depth + 1):
+            try:
+                best_score, best_move = self.search_root(white, black, depth, white_turn, best_move)
+            except SearchTimeout as timeout:
+                if timeout.partial is not None:
+                    best_score, best_move = timeout.partial
+                break
+            depth_done = depth
+            # stop as soon as the game is solved
+            if depth >= num_empty or abs(best_score) >= WIN_SCORE:
+                break
+
+        self.deadline = None
+        search_stats["nodes"] = self.nodes
+        search_stats["tt_hits"] = self.tt_hits
+        search_stats["depth"] = depth_done
+        search_stats["complete"] = depth_done >= num_empty or abs(best_score) >= WIN_SCORE
+        if stats.enabled:
+            stats.count("ai.searches")
+            stats.count("ai.nodes", self.nodes)
+            stats.count("ai.tt_hits", self.tt_hits)
+            stats.gauge("ai.last_nodes", self.nodes)
+            stats.gauge("ai.last_depth", depth_done)
+            stats.observe("ai.nodes_per_search", self.nodes, NODE_BOUNDS)
+        return best_score, best_move
+
+
+_searches = {}
+
+
+# returns the search of a rows x cols grid with a win length of k, creating it the first time
+def get_search(rows, cols, k):
+    key = (rows, cols, k)
+    if key not in _searches:
+        _searches[key] = Search(rows, cols, k)
+    return _searches[key]
+
+
+# empties the transposition tables of every grid size
+def clear_transposition_table():
+    for s in _searches.values():
+        s.table.clear()
+
+
+# returns the win length of grid, by default a full row of a square grid
+def win_length(grid, k=None):
+    return min(grid.shape) if k is None else k
+
+
+# checks the play grid to see if the game has ended, k being the number of pieces in a row needed to win
+def check_victory(g, k=None):
+    k = win_length(g, k)
+    if g.shape == (3, 3) and k == 3:
+        return bb.VICTORY_NAMES[bb.winner(*bb.pack(g))]
+    geo = bb.geometry(g.shape[0], g.shape[1], k)
+    return bb.VICTORY_NAMES[geo.winner(*geo.pack(g))]
+
+
+# heuristic for the minimax algorithm
+def evaluate(state, k=None):
+    geo = bb.geometry(state.shape[0], state.shape[1], win_length(state, k))
+    return SCORES[geo.winner(*geo.pack(state))]
+
+
+'''
+    Returns the best move as [row, col, score], the score being +1 if white wins, -1 if black wins and
+    0 if the game is a draw or has not been solved within the time limit. The moves of the classic
+    game searched to the end are looked up in the perfect-play table (see perfect.py) instead.
+    depth:      Maximum number of plies searched.
+    k:          Number of pieces in a row needed to win.
+    time_limit: Seconds available for the move. Grids larger than 3x3 default to DEFAULT_TIME_LIMIT.
+    use_table:  False to always search, even when the table has the answer.
+'''
+def minimax(state, depth, white_turn, k=None, time_limit=None, use_table=True):
+    k = win_length(state, k)
+    search = get_search(state.shape[0], state.shape[1], k)
+    white, black = search.geo.pack(state)
+    index = bb.encode_state(state) if state.shape == (3, 3) else None
+    return search_position(search, white, black, index, depth, white_turn, time_limit, use_table)
+
+
+# minimax of the position of a board.Board, searched to the end of the game on the 3x3 grid
+def minimax_board(board, time_limit=None, use_table=True):
+    search = get_search(board.rows, board.cols, board.k)
+    return search_position(search, board.white, board.black, board.index, len(board.empty), board.white_turn,
+                           time_limit, use_table)
+
+
+# minimax of a position given by its masks, and by its base-3 index on the 3x3 grid
+def search_position(search, white, black, index, depth, white_turn, time_limit, use_table):
+    geo = search.geo
+    result = geo.winner(white, black)
+    if depth == 0 or result != bb.NONE:
+        return [-1, -1, SCORES[result]]
+
+    num_empty = bin(geo.full_mask & ~(white | black)).count("1")
+    classic = (geo.rows, geo.cols, geo.k) == (3, 3, 3)
+    if use_table and classic and depth >= num_empty:
+        search_stats.update(nodes=0, tt_hits=0, depth=num_empty, complete=True)
+        stats.count("ai.table_lookups")
+        return perfect.best_move(index, white_turn)
 
-    return best
+    if time_limit is None and (geo.rows, geo.cols) != (3, 3):
+        time_limit = DEFAULT_TIME_LIMIT
+    with stats.timer("ai.search"):
+        score, x = search.search(white, black, white_turn, time_limit, depth)
+    score = int(np.sign(score)) if abs(score) >= WIN_SCORE else 0
+    return [x // geo.cols, x % geo.cols, score]
 
 
-def make_move_minimax(grid, white_turn):
-    best = minimax(grid, (grid == 0).sum(), white_turn)
+def make_move_minimax(grid, white_turn, k=None, time_limit=None):
+    best = minimax(grid, (grid == 0).sum(), white_turn, k, time_limit)
     new_grid = np.copy(grid)
     if white_turn:
         new_grid[best[0]][best[1]] = 1
     else:
         new_grid[best[0]][best[1]] = 2
-    return new_grid, best
\ No newline at end of file
+    return new_grid, best
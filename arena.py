@@ -0,0 +1,311 @@
+import argparse
+import contextlib
+import io
+import itertools
+import json
+import math
+import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import ai
+import dense
+import mcts
+import rl
+
+
+'''
+    Tournament arena that makes the AIs play against each other without a display:
+
+    python arena.py qagent minimax --games 2000 --workers 4
+    python arena.py qagent qagent:backups/last_week random --games 1000
+
+    Every pair of players plays the given number of games, alternating the colours, and the games
+    are spread across a pool of processes. The players are given by their specs:
+
+    minimax             ai.make_move_minimax
+    qagent[:DIR]        rl.QAgent, with the values of DIR (datasets by default)
+    deeprl[:DIR]        rl.DeepAgent, with the models of DIR (datasets by default)
+    nn[:FILE]           the imitation network (nn.make_move) saved in FILE (.npz or .h5), the one of nn.py by default
+    mcts[:PLAYOUTS]     mcts.MCTSAgent, with PLAYOUTS playouts per move (mcts.DEFAULT_PLAYOUTS by default)
+    random              a random legal move
+
+    The game number i is played with the random generators seeded with seed + i, so a run gives the
+    same results with any number of workers, unless a time per move makes minimax depend on the
+    speed of the machine. The results are reported as win/draw/loss rates with Wilson confidence
+    intervals, and the Elo ratings of the players are fitted to all the games.
+'''
+PLAYER_TYPES = ("minimax", "qagent", "deeprl", "nn", "random", "mcts")
+
+# z value of the 95% confidence intervals
+Z_95 = 1.959964
+
+
+class RandomPlayer:
+    def move(self, grid, white_turn, time_limit):
+        new_grid = np.copy(grid)
+        new_grid.flat[np.random.choice(np.flatnonzero(grid.reshape(-1) == 0))] = 1 if white_turn else 2
+        return new_grid
+
+
+class MinimaxPlayer:
+    def move(self, grid, white_turn, time_limit):
+        return ai.make_move_minimax(grid, white_turn, time_limit=time_limit)[0]
+
+
+# plays the moves of a pair of agents, one for each colour, without exploration and without learning
+class AgentPlayer:
+    def __init__(self, white_agent, black_agent):
+        self.agents = (black_agent, white_agent)
+
+    def move(self, grid, white_turn, time_limit):
+        return self.agents[white_turn].make_optimal_move(grid)
+
+
+class NetworkPlayer:
+    def __init__(self, path):
+        import nn
+        self.nn = nn
+        if path.endswith(".npz"):
+            self.model = dense.load(path)
+        else:
+            from keras.models import load_model
+            self.model = dense.from_keras(load_model(path))
+
+    def move(self, grid, white_turn, time_limit):
+        return self.nn.make_move(self.model, grid, white_turn)
+
+
+# creates the player of a spec such as "qagent" or "qagent:backups/last_week"
+def make_player(spec):
+    kind, _, arg = spec.partition(":")
+    if kind not in PLAYER_TYPES:
+        raise ValueError("unknown player: " + spec + ", the players are " + ", ".join(PLAYER_TYPES))
+    # the agents print when they load their values
+    with contextlib.redirect_stdout(io.StringIO()):
+        if kind == "minimax":
+            return MinimaxPlayer()
+        if kind == "random":
+            return RandomPlayer()
+        if kind == "mcts":
+            playouts = int(arg) if arg else None
+            return AgentPlayer(mcts.MCTSAgent(True, playouts=playouts), mcts.MCTSAgent(False, playouts=playouts))
+        if kind == "qagent":
+            directory = arg or "datasets"
+            return AgentPlayer(rl.QAgent(True, directory=directory), rl.QAgent(False, directory=directory))
+        if kind == "deeprl":
+            directory = arg or "datasets"
+            return AgentPlayer(rl.DeepAgent(True, play_only=True, directory=directory),
+                               rl.DeepAgent(False, play_only=True, directory=directory))
+        import nn
+        if not arg:
+            arg = nn.PLAY_MODEL_PATH if os.path.isfile(nn.PLAY_MODEL_PATH) else nn.MODEL_PATH
+        return NetworkPlayer(arg)
+
+
+'''
+    Plays a game between two players. Returns 1 if white wins, -1 if black wins and 0 for a draw,
+    and the longest time taken by a move of each player as (white, black).
+    time_limit:     Seconds per move, given to the players that can use them (minimax).
+    strict_time:    If True, a player that takes longer than the time limit for a move loses the game.
+'''
+def play_game(white, black, time_limit=None, strict_time=False):
+    grid = np.zeros((3, 3))
+    white_turn = True
+    longest = [0.0, 0.0]
+    while True:
+        start = time.perf_counter()
+        grid = (white if white_turn else black).move(grid, white_turn, time_limit)
+        elapsed = time.perf_counter() - start
+        side = 0 if white_turn else 1
+        longest[side] = max(longest[side], elapsed)
+        if strict_time and time_limit is not None and elapsed > time_limit:
+            return (-1 if white_turn else 1), tuple(longest)
+        victory = ai.check_victory(grid)
+        if victory is not None:
+            return {"white": 1, "black": -1, "draw": 0}[victory], tuple(longest)
+        white_turn = not white_turn
+
+
+# players of the worker process, created once by init_worker
+_players = {}
+
+
+def init_worker(specs):
+    for spec in specs:
+        _players[spec] = make_player(spec)
+
+
+'''
+    Plays the games start..start + count - 1 of the match between the specs a and b. The player a
+    is white in the even games. Returns the results from the point of view of a (1 win, 0 draw,
+    -1 loss) and the longest move times of a and b.
+'''
+def play_games(a, b, start, count, seed, time_limit=None, strict_time=False):
+    results, longest = [], [0.0, 0.0]
+    for i in range(start, start + count):
+        random.seed(seed + i)
+        np.random.seed((seed + i) % 2 ** 32)
+        a_white = i % 2 == 0
+        white, black = (a, b) if a_white else (b, a)
+        result, times = play_game(_players[white], _players[black], time_limit, strict_time)
+        results.append(result if a_white else -result)
+        a_time, b_time = times if a_white else times[::-1]
+        longest = [max(longest[0], a_time), max(longest[1], b_time)]
+    return results, longest
+
+
+# returns the Wilson score interval of a proportion of successes out of n trials
+def wilson_interval(successes, n, z=Z_95):
+    if n == 0:
+        return 0.0, 1.0
+    p = successes / n
+    center = (p + z * z / (2 * n)) / (1 + z * z / n)
+    half = z * math.sqrt(p * (1 - p) / n + z * z / (4 * n * n)) / (1 + z * z / n)
+    return max(0.0, center - half), min(1.0, center + half)
+
+
+# returns the Elo difference that corresponds to an expected score
+def elo_difference(score):
+    score = min(max(score, 1e-6), 1 - 1e-6)
+    return -400 * math.log10(1 / score - 1) + 0.0  # + 0.0 turns -0.0 into 0.0
+
+
+'''
+    Fits the Elo ratings of the players to the results of the matches by maximum likelihood, with
+    the mean rating fixed at 1500. Every pair of players that has met gets one virtual draw, so the
+    ratings stay finite when a player wins every game.
+    matches:    {(a, b): (wins of a, draws, losses of a)}
+'''
+def fit_elo(players, matches, iterations=2000):
+    ratings = {p: 0.0 for p in players}
+    pairs = []
+    for (a, b), (w, d, l) in matches.items():
+        pairs.append((a, b, w + d / 2 + 0.5, w + d + l + 1))
+    for _ in range(iterations):
+        gradient = {p: 0.0 for p in players}
+        games = {p: 0 for p in players}
+        for a, b, score, n in pairs:
+            expected = n / (1 + 10 ** ((ratings[b] - ratings[a]) / 400))
+            gradient[a] += score - expected
+            gradient[b] -= score - expected
+            games[a] += n
+            games[b] += n
+        for p in players:
+            if games[p]:
+                ratings[p] += 400 * gradient[p] / games[p]
+        mean = sum(ratings.values()) / len(ratings)
+        ratings = {p: r - mean for p, r in ratings.items()}
+    return {p: 1500 + r for p, r in ratings.items()}
+
+
+'''
+    Plays num_games games between every pair of specs and returns the report, a dictionary that
+    can be serialised to JSON.
+    workers:        Number of processes, 1 to play every game in this process.
+    seed:           Seed of the first game, the game i is played with seed + i.
+    time_limit:     Seconds per move, see play_game.
+    strict_time:    If True, a move over the time limit loses the game.
+'''
+def run_tournament(specs, num_games, workers=os.cpu_count(), seed=0, time_limit=None, strict_time=False):
+    specs = list(dict.fromkeys(specs))
+    if len(specs) < 2:
+        raise ValueError("a tournament needs at least two different players")
+    pairs = list(itertools.combinations(specs, 2))
+    # small chunks keep every worker busy until the end, even if some players are slower
+    chunk = max(1, math.ceil(num_games / (4 * workers)))
+    tasks = [(a, b, start, min(chunk, num_games - start), seed, time_limit, strict_time)
+             for a, b in pairs for start in range(0, num_games, chunk)]
+
+    start_time = time.perf_counter()
+    if workers == 1:
+        init_worker(specs)
+        outputs = [play_games(*task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(workers, initializer=init_worker, initargs=(specs,)) as pool:
+            futures = [pool.submit(play_games, *task) for task in tasks]
+            outputs = [future.result() for future in futures]
+    elapsed = time.perf_counter() - start_time
+
+    matches, longest, report_matches = {}, {spec: 0.0 for spec in specs}, []
+    for (a, b, *_), (results, times) in zip(tasks, outputs):
+        w, d, l = matches.get((a, b), (0, 0, 0))
+        matches[(a, b)] = (w + results.count(1), d + results.count(0), l + results.count(-1))
+        longest[a] = max(longest[a], times[0])
+        longest[b] = max(longest[b], times[1])
+
+    for (a, b), (w, d, l) in matches.items():
+        n = w + d + l
+        score = (w + d / 2) / n
+        # interval of the score, from the normal approximation of the mean of the game scores
+        deviation = math.sqrt(max((w + d / 4) / n - score * score, 0) / n)
+        low, high = max(0.0, score - Z_95 * deviation), min(1.0, score + Z_95 * deviation)
+        report_matches.append({
+            "players": [a, b],
+            "games": n,
+            "wins": w,
+            "draws": d,
+            "losses": l,
+            "win_rate": w / n,
+            "win_interval": wilson_interval(w, n),
+            "draw_rate": d / n,
+            "draw_interval": wilson_interval(d, n),
+            "loss_rate": l / n,
+            "loss_interval": wilson_interval(l, n),
+            "score": score,
+            "elo_difference": elo_difference(score),
+            "elo_interval": (elo_difference(low), elo_difference(high)),
+        })
+
+    return {
+        "games_per_match": num_games,
+        "seed": seed,
+        "time_limit": time_limit,
+        "strict_time": strict_time,
+        "workers": workers,
+        "elapsed": elapsed,
+        "games_per_second": num_games * len(pairs) / elapsed if elapsed > 0 else None,
+        "matches": report_matches,
+        "ratings": fit_elo(specs, matches),
+        "longest_move": longest,
+    }
+
+
+def format_interval(interval, scale=100, digits=1):
+    return "[" + format(interval[0] * scale, "." + str(digits) + "f") + ", " + \
+        format(interval[1] * scale, "." + str(digits) + "f") + "]"
+
+
+def print_report(report):
+    for m in report["matches"]:
+        a, b = m["players"]
+        print(a, "vs", b, "-", m["games"], "games")
+        print("  wins   %5.1f%% %s" % (m["win_rate"] * 100, format_interval(m["win_interval"])))
+        print("  draws  %5.1f%% %s" % (m["draw_rate"] * 100, format_interval(m["draw_interval"])))
+        print("  losses %5.1f%% %s" % (m["loss_rate"] * 100, format_interval(m["loss_interval"])))
+        print("  Elo difference %+.0f %s" % (m["elo_difference"], format_interval(m["elo_interval"], 1, 0)))
+    print("ratings:")
+    for spec, rating in sorted(report["ratings"].items(), key=lambda item: -item[1]):
+        print("  %-30s %6.0f   longest move %.3f s" % (spec, rating, report["longest_move"][spec]))
+    print("%.1f games per second" % (report["games_per_second"] or 0))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Plays the AIs against each other and rates them.")
+    parser.add_argument("players", nargs="+", help="specs of the players, such as minimax, qagent or qagent:DIR")
+    parser.add_argument("--games", type=int, default=1000, help="games of every pair of players")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="number of processes")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the first game")
+    parser.add_argument("--time-per-move", type=float, default=None, help="seconds per move")
+    parser.add_argument("--strict-time", action="store_true", help="a move over the time per move loses the game")
+    parser.add_argument("--output", default=None, help="JSON file for the report")
+    args = parser.parse_args()
+
+    report = run_tournament(args.players, args.games, args.workers, args.seed, args.time_per_move, args.strict_time)
+    print_report(report)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,496 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+import ai
+import bitboard as bb
+import board as bd
+import dense
+import mcts
+import movelog
+import perfect
+import rl
+import train
+
+
+'''
+    Headless benchmarks of the hot paths of the engines. Every benchmark works on a fixed set of
+    positions generated from a seed, and the random generators are reseeded before every run, so
+    two runs on the same machine do the same work:
+
+    python bench.py                          # runs every benchmark
+    python bench.py minimax_3x3 qagent_move  # runs some of them
+    python bench.py --save-baseline          # stores the results as the new baseline
+
+    The median and 95th percentile of the time of a run, the throughput (items per second at the
+    median) and the peak memory allocated by python during a run are reported and written to a
+    JSON file. When a baseline file exists, the results are compared with it and the program exits
+    with status 1 if the median time or the peak memory of a benchmark grows by more than the
+    threshold. The times depend on the machine, so no baseline is shipped: without one nothing is
+    compared, and --require-baseline makes this an error (status 2) for the runs that must gate.
+
+    The benchmarks run in a temporary copy of the datasets of the game, so the values learned and
+    the moves logged by the benchmarks never reach the datasets. The benchmarks of the
+    neural networks are skipped when keras is not installed.
+'''
+DATASET_FILES = ("qvalues_white.bin", "qvalues_black.bin", "model_values_white.h5", "model_values_black.h5",
+                 "moves.log", "perfect_play.bin")
+RESULTS_PATH = "bench_results.json"
+BASELINE_PATH = "bench_baseline.json"
+DEFAULT_THRESHOLD = 0.25
+
+BENCHMARKS = {}
+
+
+# raised by the setup of a benchmark that can not run in this environment
+class Skip(Exception):
+    pass
+
+
+'''
+    Registers a benchmark. The decorated function receives the seed, prepares everything that is
+    not measured and returns (run, items) or (run, items, before): a function without arguments
+    that does the measured work, the number of items (positions, moves, games...) that it
+    processes, and a function called before every run, outside of the measured time.
+'''
+def benchmark(name):
+    def register(setup):
+        BENCHMARKS[name] = setup
+        return setup
+    return register
+
+
+def require_keras():
+    try:
+        import keras  # noqa: F401
+    except ImportError:
+        raise Skip("keras is not installed")
+
+
+def seed_all(seed):
+    random.seed(seed)
+    np.random.seed(seed)
+
+
+# returns n distinct positions of a rows x columns grid reached by random play, in which the game has not ended
+def random_positions(n, seed, rows=3, columns=3, k=3, min_empty=2):
+    rng = np.random.default_rng(seed)
+    geo = bb.geometry(rows, columns, k)
+    positions, seen = [], set()
+    while len(positions) < n:
+        grid = np.zeros((rows, columns))
+        for ply in range(rng.integers(0, rows * columns - min_empty + 1)):
+            cell = rng.choice(np.flatnonzero(grid.reshape(-1) == 0))
+            grid.flat[cell] = 1 if ply % 2 == 0 else 2
+            if geo.winner(*geo.pack(grid)) != bb.NONE:
+                break
+        key = grid.tobytes()
+        if geo.winner(*geo.pack(grid)) == bb.NONE and key not in seen:
+            seen.add(key)
+            positions.append(grid)
+    return positions
+
+
+def white_to_move(grid):
+    return (grid == 1).sum() == (grid == 2).sum()
+
+
+@benchmark("check_victory")
+def bench_check_victory(seed):
+    positions = random_positions(1000, seed)
+
+    def run():
+        for grid in positions:
+            ai.check_victory(grid)
+    return run, len(positions)
+
+
+@benchmark("check_victory_batch")
+def bench_check_victory_batch(seed):
+    boards = np.array(random_positions(1000, seed)).reshape(-1, 9)
+    return lambda: bb.check_victory_batch(boards), len(boards)
+
+
+@benchmark("board_random_games")
+def bench_board_random_games(seed):
+    rng = random.Random(seed)
+    moves = [rng.random() for _ in range(9 * 1000)]
+    board = bd.Board(3, 3)
+
+    def run():
+        # every game is played to the end and then taken back, on the same board
+        for game in range(1000):
+            ply = 0
+            while board.result == bb.NONE:
+                board.play(board.empty[int(moves[9 * game + ply] * len(board.empty))])
+                ply += 1
+            while board.history:
+                board.undo()
+    return run, 1000
+
+
+@benchmark("minimax_empty_board")
+def bench_minimax_empty_board(seed):
+    grid = np.zeros((3, 3))
+
+    def run():
+        ai.clear_transposition_table()
+        ai.minimax(grid, 9, True, use_table=False)
+    return run, 1
+
+
+@benchmark("minimax_3x3")
+def bench_minimax_3x3(seed):
+    positions = random_positions(200, seed)
+
+    def run():
+        ai.clear_transposition_table()
+        for grid in positions:
+            ai.make_move_minimax(grid, white_to_move(grid))
+    return run, len(positions)
+
+
+@benchmark("perfect_solve")
+def bench_perfect_solve(seed):
+    return perfect.solve, 2 * bb.NUM_STATES
+
+
+@benchmark("perfect_lookup")
+def bench_perfect_lookup(seed):
+    boards = np.array(random_positions(1000, seed)).reshape(-1, 9)
+    perfect.get_table()
+    return lambda: perfect.lookup(boards), len(boards)
+
+
+@benchmark("mcts_7x7_playouts")
+def bench_mcts_7x7(seed):
+    positions = random_positions(5, seed, 7, 7, 5, min_empty=30)
+    playouts = 500
+
+    def run():
+        for grid in positions:
+            # a new tree for every run, seeded, so every run plays the same playouts
+            mcts.Tree(7, 7, 5, seed=seed).search(*bb.geometry(7, 7, 5).pack(grid), white_to_move(grid), playouts)
+    return run, len(positions) * playouts
+
+
+@benchmark("minimax_7x7_depth3")
+def bench_minimax_7x7(seed):
+    positions = random_positions(5, seed, 7, 7, 5, min_empty=30)
+
+    def run():
+        ai.clear_transposition_table()
+        for grid in positions:
+            # the depth limits the search, and the time limit is only there to make it deterministic
+            ai.minimax(grid, 3, white_to_move(grid), 5, time_limit=3600)
+    return run, len(positions)
+
+
+def bench_agent_move(agent, seed):
+    positions = [grid for grid in random_positions(300, seed) if white_to_move(grid) == agent.first_move]
+
+    def run():
+        for grid in positions:
+            agent.make_optimal_move(grid)
+    return run, len(positions)
+
+
+@benchmark("qagent_move")
+def bench_qagent_move(seed):
+    return bench_agent_move(rl.QAgent(True), seed)
+
+
+@benchmark("deepagent_move")
+def bench_deepagent_move(seed):
+    require_keras()
+    agent = rl.DeepAgent(True)
+    run, items = bench_agent_move(agent, seed)
+
+    def run_uncached():
+        # every run pays for the forward passes, not only the first one
+        agent.cache.clear()
+        run()
+    return run_uncached, items
+
+
+@benchmark("deepagent_select_moves")
+def bench_deepagent_select_moves(seed):
+    require_keras()
+    agent = rl.DeepAgent(True)
+    states = np.array([grid.reshape(9) for grid in random_positions(300, seed) if white_to_move(grid)])
+
+    def run():
+        agent.cache.clear()
+        agent.select_moves(states)
+    return run, len(states)
+
+
+@benchmark("qagent_load_values")
+def bench_qagent_load_values(seed):
+    agent = rl.QAgent(True)
+    agent.save_values()  # the values are loaded from the binary table, even if a csv file was found
+    return agent.load_values, 1
+
+
+@benchmark("qagent_save_values")
+def bench_qagent_save_values(seed):
+    agent = rl.QAgent(True)
+    return agent.save_values, 1
+
+
+@benchmark("nn_train_model")
+def bench_nn_train_model(seed):
+    require_keras()
+    import nn
+    movelog.ensure_log()
+    records = movelog.count_records()
+    model = nn.create_model()
+    return lambda: nn.train_model(model, 1), records
+
+
+@benchmark("movelog_compact")
+def bench_movelog_compact(seed):
+    movelog.ensure_log()
+    path = os.path.join(tempfile.mkdtemp(), "moves_counts.bin")
+
+    def run():
+        # a new compacted log every run, so every run reads the whole log
+        if os.path.isfile(path):
+            os.remove(path)
+        movelog.compact(counts_path=path)
+    return run, movelog.count_records()
+
+
+@benchmark("nn_make_move")
+def bench_nn_make_move(seed):
+    require_keras()
+    import nn
+    # the moves are played by the numpy copy of the network, as in the game
+    model = dense.from_keras(nn.create_model())
+    positions = random_positions(100, seed)
+
+    def run():
+        for grid in positions:
+            nn.make_move(model, grid, white_to_move(grid))
+    return run, len(positions)
+
+
+@benchmark("dense_predict")
+def bench_dense_predict(seed):
+    # a network of the shape of the one of nn.py, with random weights
+    rng = np.random.default_rng(seed)
+    sizes = (9, 18, 18, 9, 9)
+    network = dense.DenseNetwork([rng.normal(size=(a, b)) for a, b in zip(sizes, sizes[1:])],
+                                 [rng.normal(size=b) for b in sizes[1:]], ["relu", "relu", "relu", "softmax"])
+    boards = np.array(random_positions(100, seed)).reshape(-1, 9)
+
+    def run():
+        for board in boards:
+            network.predict(board)
+    return run, len(boards)
+
+
+# returns a function that restores the files of the datasets directory to their current contents
+def snapshot_datasets():
+    contents = {}
+    for file in os.listdir("datasets"):
+        with open(os.path.join("datasets", file), "rb") as f:
+            contents[file] = f.read()
+
+    def restore():
+        for file in os.listdir("datasets"):
+            if file not in contents:
+                os.remove(os.path.join("datasets", file))
+        for file, data in contents.items():
+            with open(os.path.join("datasets", file), "wb") as f:
+                f.write(data)
+    return restore
+
+
+def bench_self_play(ai_type, games, num_envs=None):
+    # the values saved at the end of a run are discarded, so that every run starts from the same values
+    run = lambda: train.train(ai_type, games, batch_size=games, checkpoint_every=10 ** 9, num_envs=num_envs)
+    return run, games, snapshot_datasets()
+
+
+@benchmark("self_play_qagent")
+def bench_self_play_qagent(seed):
+    return bench_self_play("qagent", 200)
+
+
+@benchmark("self_play_qagent_vecenv")
+def bench_self_play_qagent_vecenv(seed):
+    return bench_self_play("qagent", 4096, num_envs=1024)
+
+
+@benchmark("self_play_deeprl")
+def bench_self_play_deeprl(seed):
+    require_keras()
+    return bench_self_play("deeprl", 10)
+
+
+# times repeat runs of a benchmark, after a warm-up run, and measures the peak memory of one more run
+def measure(setup, seed, repeat):
+    seed_all(seed)
+    run, items, before = (setup(seed) + (None,))[:3]
+    before = before or (lambda: None)
+    before()
+    seed_all(seed)
+    run()
+
+    times = []
+    for _ in range(repeat):
+        before()
+        seed_all(seed)
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+
+    before()
+    seed_all(seed)
+    tracemalloc.start()
+    run()
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    median = float(np.median(times))
+    return {
+        "median": median,
+        "p95": float(np.percentile(times, 95)),
+        "throughput": items / median if median > 0 else None,
+        "items": items,
+        "repeat": repeat,
+        "peak_memory": peak_memory,
+    }
+
+
+'''
+    Runs the benchmarks in names (every benchmark if None) in a temporary copy of the datasets and
+    returns the results, as a dictionary that is also the format of the result and baseline files.
+'''
+def run_benchmarks(names=None, repeat=5, seed=0, log=print):
+    names = list(BENCHMARKS) if names is None else names
+    for name in names:
+        if name not in BENCHMARKS:
+            raise ValueError("unknown benchmark: " + name)
+
+    source = os.path.abspath("datasets")
+    cwd = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix="tictaitoe-bench-")
+    results = {}
+    try:
+        os.mkdir(os.path.join(workdir, "datasets"))
+        for file in DATASET_FILES:
+            if os.path.isfile(os.path.join(source, file)):
+                shutil.copy(os.path.join(source, file), os.path.join(workdir, "datasets", file))
+        os.chdir(workdir)
+        for name in names:
+            try:
+                # the agents print when they load and save their values
+                with contextlib.redirect_stdout(io.StringIO()):
+                    results[name] = measure(BENCHMARKS[name], seed, repeat)
+            except Skip as e:
+                results[name] = {"skipped": str(e)}
+            log(format_result(name, results[name]))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "seed": seed,
+        "benchmarks": results,
+    }
+
+
+def format_result(name, result):
+    if "skipped" in result:
+        return "%-26s skipped: %s" % (name, result["skipped"])
+    line = "%-26s median %10.3f ms   p95 %10.3f ms   %12.1f items/s   peak %9.1f KiB" % (
+        name, result["median"] * 1000, result["p95"] * 1000, result["throughput"] or 0, result["peak_memory"] / 1024)
+    if "median_ratio" in result:
+        line += "   x%.2f time, x%.2f memory vs baseline" % (result["median_ratio"], result["memory_ratio"])
+    return line
+
+
+'''
+    Compares the results with a baseline. The ratios to the baseline are added to every result, and
+    the names of the benchmarks whose median time or peak memory grew by more than threshold (0.25
+    means 25%) are returned.
+'''
+def compare(results, baseline, threshold=DEFAULT_THRESHOLD):
+    regressions = []
+    for name, result in results["benchmarks"].items():
+        base = baseline["benchmarks"].get(name)
+        if base is None or "skipped" in result or "skipped" in base:
+            continue
+        result["median_ratio"] = result["median"] / base["median"] if base["median"] > 0 else 1.0
+        result["memory_ratio"] = result["peak_memory"] / base["peak_memory"] if base["peak_memory"] > 0 else 1.0
+        if result["median_ratio"] > 1 + threshold or result["memory_ratio"] > 1 + threshold:
+            regressions.append(name)
+    return regressions
+
+
+def save_results(path, results):
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2)
+
+
+def load_results(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmarks the hot paths of the engines.")
+    parser.add_argument("names", nargs="*", help="benchmarks to run, all of them by default")
+    parser.add_argument("--list", action="store_true", help="list the benchmarks and exit")
+    parser.add_argument("--repeat", type=int, default=5, help="timed runs of every benchmark")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the positions and of the random generators")
+    parser.add_argument("--output", default=RESULTS_PATH, help="JSON file for the results")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="JSON file of the baseline results")
+    parser.add_argument("--save-baseline", action="store_true", help="store the results as the new baseline")
+    parser.add_argument("--require-baseline", action="store_true",
+                        help="fail with status 2 when there is no baseline to compare with")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="relative growth of the time or memory of a benchmark that fails the run")
+    args = parser.parse_args()
+
+    if args.list:
+        print("\n".join(BENCHMARKS))
+        sys.exit(0)
+
+    compared = not args.save_baseline and os.path.isfile(args.baseline)
+    if not args.save_baseline and not compared:
+        if args.require_baseline:
+            print("error: no baseline at " + args.baseline + ", run python bench.py --save-baseline first",
+                  file=sys.stderr)
+            sys.exit(2)
+        print("WARNING: no baseline at " + args.baseline + ", the results are not checked for regressions",
+              file=sys.stderr)
+
+    results = run_benchmarks(args.names or None, args.repeat, args.seed)
+    regressions = []
+    if compared:
+        regressions = compare(results, load_results(args.baseline), args.threshold)
+        for name in regressions:
+            print("regression:", format_result(name, results["benchmarks"][name]))
+    save_results(args.output, results)
+    if args.save_baseline:
+        save_results(args.baseline, results)
+        print("baseline saved to", args.baseline)
+    sys.exit(1 if regressions else 0)
@@ -0,0 +1,318 @@
+import numpy as np
+
+'''
+    Bitboard representation of the play grid. Each side is stored as a 9-bit mask in which bit
+    i is set when the cell i = 3 * row + column holds one of its pieces:
+
+    bit 0 | bit 1 | bit 2
+    bit 3 | bit 4 | bit 5
+    bit 6 | bit 7 | bit 8
+
+    A whole position can also be packed into a single integer as white | black << 9.
+'''
+NUM_CELLS = 9
+FULL_MASK = (1 << NUM_CELLS) - 1
+
+# the 8 winning lines of the 3x3 grid
+WIN_MASKS = (
+    0b000000111,  # top row
+    0b000111000,  # middle row
+    0b111000000,  # bottom row
+    0b001001001,  # left column
+    0b010010010,  # middle column
+    0b100100100,  # right column
+    0b100010001,  # main diagonal
+    0b001010100,  # anti diagonal
+)
+
+'''
+    Codes returned by winner and check_victory_batch:
+    NONE  = 0 -> Game has not ended
+    WHITE = 1 -> White has won
+    BLACK = 2 -> Black has won
+    DRAW  = 3 -> Game has ended in a draw
+'''
+NONE, WHITE, BLACK, DRAW = 0, 1, 2, 3
+VICTORY_NAMES = (None, "white", "black", "draw")
+
+# value of the bit of every cell, used to pack grids with a dot product
+CELL_BITS = 1 << np.arange(NUM_CELLS, dtype=np.int64)
+
+# lookup table telling if a 9-bit mask contains a winning line
+WIN_TABLE = np.array([any(m & w == w for w in WIN_MASKS) for m in range(1 << NUM_CELLS)])
+_win_table = WIN_TABLE.tolist()
+
+
+# the 8 symmetries of the grid (rotations and reflections), as functions of (row, column)
+SYMMETRIES = (
+    lambda r, c: (r, c),          # identity
+    lambda r, c: (c, 2 - r),      # rotation by 90 degrees
+    lambda r, c: (2 - r, 2 - c),  # rotation by 180 degrees
+    lambda r, c: (2 - c, r),      # rotation by 270 degrees
+    lambda r, c: (r, 2 - c),      # horizontal reflection
+    lambda r, c: (2 - r, c),      # vertical reflection
+    lambda r, c: (c, r),          # main diagonal reflection
+    lambda r, c: (2 - c, 2 - r),  # anti diagonal reflection
+)
+
+# PERMUTATIONS[t][i] is the cell that cell i is sent to by the symmetry t
+PERMUTATIONS = tuple(tuple(3 * s(i // 3, i % 3)[0] + s(i // 3, i % 3)[1] for i in range(NUM_CELLS))
+                     for s in SYMMETRIES)
+
+
+def _permute(mask, permutation):
+    return sum(1 << permutation[i] for i in range(NUM_CELLS) if mask >> i & 1)
+
+
+# lookup tables with the image of every 9-bit mask under each symmetry
+_sym_tables = [[_permute(m, p) for m in range(1 << NUM_CELLS)] for p in PERMUTATIONS]
+
+
+# returns the packed integer of the representative of the position among its 8 symmetries
+def canonical(white, black):
+    return min(t[white] | t[black] << NUM_CELLS for t in _sym_tables)
+
+
+'''
+    Base-3 index of a 3x3 state, in which every cell is a digit (0 = empty, 1 = white, 2 = black).
+'''
+# number of possible 3x3 states, counting the unreachable ones
+NUM_STATES = 3 ** 9
+
+# weight of every cell in the base-3 index of a state, the top-left cell being the most significant digit
+STATE_WEIGHTS = 3 ** np.arange(8, -1, -1)
+
+
+# returns the base-3 index (0..19682) of a 3x3 state
+def encode_state(state):
+    return int(state.reshape(9) @ STATE_WEIGHTS)
+
+
+# returns the base-3 indices of an array of states of shape (N, 3, 3) or (N, 9)
+def encode_states(states):
+    return states.reshape(-1, 9).astype(np.int64) @ STATE_WEIGHTS
+
+
+# returns the 3x3 state of a base-3 index
+def decode_state(index):
+    return np.array([index // w % 3 for w in STATE_WEIGHTS], dtype=float).reshape(3, 3)
+
+
+# returns the (N, 9) states of an array of base-3 indices
+def decode_states(indices):
+    return (np.asarray(indices, dtype=np.int64)[:, None] // STATE_WEIGHTS % 3).astype(float)
+
+
+'''
+    Symmetry classes of the 3x3 states. A state and its 7 rotations and reflections are equivalent,
+    so they share a single entry in the value tables. CANONICAL_STATE[i] is the smallest base-3
+    index among the symmetric versions of the state i, and CANONICAL_TRANSFORM[i] is the symmetry t
+    that sends the state i to it: the cell c of the state i is the cell PERMUTATIONS[t][c] of the
+    canonical state. The canonical states are numbered from 0 to NUM_CLASSES - 1 by CLASS_ID.
+'''
+def _canonical_tables():
+    cells = decode_states(np.arange(NUM_STATES))
+    images = np.empty((len(PERMUTATIONS), NUM_STATES), dtype=np.int64)
+    for t, permutation in enumerate(PERMUTATIONS):
+        image = np.empty_like(cells)
+        image[:, list(permutation)] = cells
+        images[t] = encode_states(image)
+    return images.min(axis=0), images.argmin(axis=0).astype(np.int8)
+
+
+CANONICAL_STATE, CANONICAL_TRANSFORM = _canonical_tables()
+CANONICAL_STATES = np.unique(CANONICAL_STATE)
+NUM_CLASSES = len(CANONICAL_STATES)
+CLASS_ID = np.searchsorted(CANONICAL_STATES, CANONICAL_STATE)
+
+# INVERSE_PERMUTATIONS[t][i] is the cell that is sent to cell i by the symmetry t
+INVERSE_PERMUTATIONS = tuple(tuple(p.index(i) for i in range(NUM_CELLS)) for p in PERMUTATIONS)
+
+
+# returns the symmetry class of the base-3 indices of the states
+def state_classes(indices):
+    return CLASS_ID[indices]
+
+
+# returns the base-3 index of the canonical version of a state and the symmetry that sends the state to it
+def canonicalize(state):
+    index = encode_state(state)
+    return int(CANONICAL_STATE[index]), int(CANONICAL_TRANSFORM[index])
+
+
+# returns the cell of the canonical state that corresponds to the cell of a state sent to it by the symmetry t
+def to_canonical_cell(cell, t):
+    return PERMUTATIONS[t][cell]
+
+
+# returns the cell of the real state that corresponds to the cell of its canonical state
+def from_canonical_cell(cell, t):
+    return INVERSE_PERMUTATIONS[t][cell]
+
+
+# converts a 3x3 grid into a pair of masks (white, black)
+def pack(grid):
+    cells = np.asarray(grid).reshape(NUM_CELLS)
+    return int(CELL_BITS @ (cells == 1)), int(CELL_BITS @ (cells == 2))
+
+
+# converts a 3x3 grid into a single integer
+def pack_int(grid):
+    white, black = pack(grid)
+    return white | black << NUM_CELLS
+
+
+# converts a pair of masks back into a 3x3 grid
+def unpack(white, black):
+    cells = np.zeros(NUM_CELLS)
+    cells[(white & CELL_BITS) != 0] = 1
+    cells[(black & CELL_BITS) != 0] = 2
+    return cells.reshape(3, 3)
+
+
+# returns the mask of the empty cells
+def empty_cells(white, black):
+    return FULL_MASK & ~(white | black)
+
+
+# returns the code of the result of the position (NONE, WHITE, BLACK or DRAW)
+def winner(white, black):
+    if _win_table[white]:
+        return WHITE
+    if _win_table[black]:
+        return BLACK
+    if white | black == FULL_MASK:
+        return DRAW
+    return NONE
+
+
+# checks the result of N positions at once
+def check_victory_batch(boards):
+    """
+        Returns an int8 array with the result code of each position.
+        boards: Either an (N, 9) or (N, 3, 3) array of cell values (0 = empty, 1 = white, 2 = black),
+                or an (N,) array of positions packed as white | black << 9.
+    """
+    boards = np.asarray(boards)
+    if boards.ndim == 1:
+        packed = boards.astype(np.int64)
+        white = packed & FULL_MASK
+        black = (packed >> NUM_CELLS) & FULL_MASK
+    else:
+        cells = boards.reshape(boards.shape[0], NUM_CELLS)
+        white = (cells == 1) @ CELL_BITS
+        black = (cells == 2) @ CELL_BITS
+
+    result = np.zeros(white.shape, dtype=np.int8)
+    result[(white | black) == FULL_MASK] = DRAW
+    result[WIN_TABLE[black]] = BLACK
+    result[WIN_TABLE[white]] = WHITE
+    return result
+
+
+'''
+    Generalisation of the bitboards to m,n,k boards: a grid of any number of rows and columns in
+    which k pieces in a row are needed to win. Cells are numbered row by row as in the 3x3 grid,
+    and the masks are plain python integers, so any board size is supported.
+'''
+class Geometry:
+    def __init__(self, rows, cols, k):
+        if not 1 <= k <= max(rows, cols):
+            raise ValueError("a win length of " + str(k) + " does not fit in a " + str(rows) + "x" + str(cols) +
+                             " grid")
+        self.rows = rows
+        self.cols = cols
+        self.k = k
+        self.num_cells = rows * cols
+        self.full_mask = (1 << self.num_cells) - 1
+
+        # every line of k cells, horizontal, vertical or diagonal
+        lines = []
+        for r in range(rows):
+            for c in range(cols):
+                for dr, dc in ((0, 1), (1, 0), (1, 1), (1, -1)):
+                    end_r, end_c = r + dr * (k - 1), c + dc * (k - 1)
+                    if 0 <= end_r < rows and 0 <= end_c < cols:
+                        lines.append(tuple((r + dr * i) * cols + c + dc * i for i in range(k)))
+        self.win_masks = tuple(sum(1 << i for i in line) for line in lines)
+        # winning lines that go through each cell
+        self.cell_masks = tuple(tuple(m for m in self.win_masks if m >> i & 1) for i in range(self.num_cells))
+
+        # cell permutations of the symmetries of the grid (8 for square grids, 4 otherwise)
+        transforms = [lambda r, c: (r, c), lambda r, c: (rows - 1 - r, cols - 1 - c),
+                      lambda r, c: (r, cols - 1 - c), lambda r, c: (rows - 1 - r, c)]
+        if rows == cols:
+            transforms += [lambda r, c: (c, rows - 1 - r), lambda r, c: (cols - 1 - c, r),
+                           lambda r, c: (c, r), lambda r, c: (cols - 1 - c, rows - 1 - r)]
+        self.permutations = tuple(tuple(t(i // cols, i % cols)[0] * cols + t(i // cols, i % cols)[1]
+                                        for i in range(self.num_cells)) for t in transforms)
+        # the masks are permuted a byte at a time through lookup tables
+        self._sym_tables = [[[sum(1 << p[start + i] for i in range(8) if b >> i & 1 and start + i < self.num_cells)
+                              for b in range(256)] for start in range(0, self.num_cells, 8)]
+                            for p in self.permutations]
+
+        # cells sorted by their distance to the center of the grid, used for move ordering
+        self.center_order = tuple(sorted(range(self.num_cells), key=lambda i: (abs(i // cols - (rows - 1) / 2) +
+                                                                                abs(i % cols - (cols - 1) / 2), i)))
+
+    # converts a grid into a pair of masks (white, black)
+    def pack(self, grid):
+        cells = np.asarray(grid).reshape(self.num_cells)
+        white = black = 0
+        for i in np.flatnonzero(cells == 1).tolist():
+            white |= 1 << i
+        for i in np.flatnonzero(cells == 2).tolist():
+            black |= 1 << i
+        return white, black
+
+    # converts a pair of masks back into a grid
+    def unpack(self, white, black):
+        cells = np.zeros(self.num_cells)
+        for i in range(self.num_cells):
+            if white >> i & 1:
+                cells[i] = 1
+            elif black >> i & 1:
+                cells[i] = 2
+        return cells.reshape(self.rows, self.cols)
+
+    # returns the code of the result of the position (NONE, WHITE, BLACK or DRAW)
+    def winner(self, white, black):
+        for m in self.win_masks:
+            if white & m == m:
+                return WHITE
+        for m in self.win_masks:
+            if black & m == m:
+                return BLACK
+        if white | black == self.full_mask:
+            return DRAW
+        return NONE
+
+    # tells if the pieces in mask form a line through cell, only the lines of the last move need to be checked
+    def wins_through(self, mask, cell):
+        for m in self.cell_masks[cell]:
+            if mask & m == m:
+                return True
+        return False
+
+    # returns the image of mask by the symmetry number t
+    def permute(self, mask, t):
+        result = 0
+        for table in self._sym_tables[t]:
+            result |= table[mask & 0xFF]
+            mask >>= 8
+        return result
+
+    # returns the representative of the position among its symmetries, as a tuple (white, black)
+    def canonical(self, white, black):
+        return min((self.permute(white, t), self.permute(black, t)) for t in range(len(self.permutations)))
+
+
+_geometries = {}
+
+
+# returns the (cached) geometry of a rows x cols grid with a win length of k
+def geometry(rows, cols, k):
+    key = (rows, cols, k)
+    if key not in _geometries:
+        _geometries[key] = Geometry(rows, cols, k)
+    return _geometries[key]
@@ -0,0 +1,138 @@
+import numpy as np
+
+import bitboard as bb
+
+
+'''
+    Mutable position of a game on a rows x cols grid with a win length of k. The moves are played
+    and taken back in place, so a game or a search does not allocate a new grid for every move:
+
+    board = Board(3, 3)
+    board.play(4)       # white takes the center
+    board.undo()
+
+    Everything is updated incrementally by play and undo:
+
+    cells       bytearray with the value of every cell, as in the play grid (0 empty, 1 white, 2 black)
+    white       mask of the white pieces, black the one of the black pieces (see bitboard.py)
+    empty       list of the empty cells, in no particular order
+    white_turn  side to move, history the cells played since the board was created
+    index       base-3 index of the position, the top-left cell being the most significant digit,
+                the same as bitboard.encode_state on the 3x3 grid
+    result      result code of the position (see bitboard.py), victory its name as in ai.check_victory
+
+    grid() is a numpy view of the cells and to_grid() a copy with the layout used by the rest of
+    the code, while from_grid creates the board of a numpy grid.
+'''
+class Board:
+    __slots__ = ("geo", "rows", "cols", "k", "cells", "white", "black", "white_turn", "empty", "slots", "history",
+                 "index", "result", "weights")
+
+    def __init__(self, rows=3, cols=3, k=None):
+        self.geo = bb.geometry(rows, cols, min(rows, cols) if k is None else k)
+        self.rows = rows
+        self.cols = cols
+        self.k = self.geo.k
+        self.weights = [3 ** (rows * cols - 1 - i) for i in range(rows * cols)]
+        self.reset()
+
+    # empties the board, white to move
+    def reset(self):
+        n = self.rows * self.cols
+        self.cells = bytearray(n)
+        self.white = self.black = 0
+        self.white_turn = True
+        self.empty = list(range(n))
+        # position of every empty cell in the list of empty cells
+        self.slots = list(range(n))
+        self.history = []
+        self.index = 0
+        self.result = bb.NONE
+
+    # places the piece of the side to move in cell, and passes the turn
+    def play(self, cell):
+        if self.result != bb.NONE:
+            raise ValueError("the game has already ended")
+        if self.cells[cell]:
+            raise ValueError("the cell " + str(cell) + " is not empty")
+        piece = 1 if self.white_turn else 2
+        self.cells[cell] = piece
+        # the last empty cell takes the place of the one played
+        last = self.empty.pop()
+        if last != cell:
+            self.empty[self.slots[cell]] = last
+            self.slots[last] = self.slots[cell]
+        self.history.append(cell)
+        self.index += piece * self.weights[cell]
+        if self.white_turn:
+            self.white |= 1 << cell
+            won = self.geo.wins_through(self.white, cell)
+        else:
+            self.black |= 1 << cell
+            won = self.geo.wins_through(self.black, cell)
+        if won:
+            self.result = bb.WHITE if self.white_turn else bb.BLACK
+        elif not self.empty:
+            self.result = bb.DRAW
+        self.white_turn = not self.white_turn
+
+    # takes back the last move played, and returns its cell
+    def undo(self):
+        cell = self.history.pop()
+        self.white_turn = not self.white_turn
+        piece = 1 if self.white_turn else 2
+        self.cells[cell] = 0
+        self.slots[cell] = len(self.empty)
+        self.empty.append(cell)
+        self.index -= piece * self.weights[cell]
+        if self.white_turn:
+            self.white &= ~(1 << cell)
+        else:
+            self.black &= ~(1 << cell)
+        # no move is played once the game has ended, so the position before a move had not ended
+        self.result = bb.NONE
+        return cell
+
+    @property
+    def victory(self):
+        return bb.VICTORY_NAMES[self.result]
+
+    def copy(self):
+        board = Board.__new__(Board)
+        for name in Board.__slots__:
+            setattr(board, name, getattr(self, name))
+        board.cells = bytearray(self.cells)
+        board.empty = list(self.empty)
+        board.slots = list(self.slots)
+        board.history = list(self.history)
+        return board
+
+    # returns an int8 (rows, cols) view of the cells, which changes with the board
+    def grid(self):
+        return np.frombuffer(self.cells, dtype=np.int8).reshape(self.rows, self.cols)
+
+    # returns a float copy of the cells, the grid used by the AIs that work with numpy arrays
+    def to_grid(self):
+        return self.grid().astype(float)
+
+    '''
+        Returns the board of a numpy grid of cell values. The pieces are placed without a history, so
+        they can not be taken back with undo.
+        k:          Number of pieces in a row needed to win, a full row by default.
+        white_turn: Side to move, by default white if both sides have the same number of pieces.
+    '''
+    @staticmethod
+    def from_grid(grid, k=None, white_turn=None):
+        grid = np.asarray(grid)
+        board = Board(grid.shape[0], grid.shape[1], k)
+        cells = grid.reshape(-1).astype(np.int8)
+        board.cells = bytearray(cells.tobytes())
+        board.white, board.black = board.geo.pack(cells)
+        board.empty = np.flatnonzero(cells == 0).tolist()
+        for slot, cell in enumerate(board.empty):
+            board.slots[cell] = slot
+        for cell in np.flatnonzero(cells).tolist():
+            board.index += int(cells[cell]) * board.weights[cell]
+        board.white_turn = bool((cells == 1).sum() == (cells == 2).sum()) if white_turn is None else white_turn
+        board.result = board.geo.winner(board.white, board.black)
+        return board
@@ -0,0 +1,127 @@
+import io
+import os
+import sys
+
+import numpy as np
+
+import storage
+
+
+'''
+    Inference of the small dense networks of the game (the imitation network of nn.py and the value
+    networks of the DeepAgent) with plain numpy, without importing keras. The weights of a keras
+    model are exported to an .npz file with one kernel, bias and activation per layer:
+
+    python dense.py                 # exports the models of the datasets directory
+    python dense.py model.h5 ...    # exports the given models, next to them
+
+    The forward pass works in float32 with buffers that are allocated once and reused by every
+    call, so predicting a few boards costs microseconds instead of a keras predict call.
+'''
+ACTIVATIONS = ("linear", "relu", "sigmoid", "tanh", "softmax")
+DEFAULT_MODELS = ("datasets/model_values_white.h5", "datasets/model_values_black.h5", "datasets/model_nn.h5")
+
+
+class DenseNetwork:
+    def __init__(self, kernels, biases, activations):
+        for activation in activations:
+            if activation not in ACTIVATIONS:
+                raise ValueError("unsupported activation: " + str(activation))
+        self.kernels = [np.ascontiguousarray(k, dtype=np.float32) for k in kernels]
+        self.biases = [np.asarray(b, dtype=np.float32) for b in biases]
+        self.activations = list(activations)
+        self.input_size = self.kernels[0].shape[0]
+        self.capacity = 0
+        self.buffers = []
+        self.input = None
+
+    # allocates the buffers of every layer for batches of up to n rows
+    def reserve(self, n):
+        if n <= self.capacity:
+            return
+        self.capacity = max(n, 2 * self.capacity, 64)
+        self.input = np.empty((self.capacity, self.input_size), dtype=np.float32)
+        self.buffers = [np.empty((self.capacity, k.shape[1]), dtype=np.float32) for k in self.kernels]
+
+    '''
+        Returns the outputs of the network for an (N, inputs) array. The result is a view of a
+        buffer of the network, which is overwritten by the next call, so it has to be copied to be
+        kept. The keyword arguments of keras (verbose...) are accepted and ignored.
+    '''
+    def predict(self, x, **kwargs):
+        x = np.asarray(x).reshape(-1, self.input_size)
+        n = len(x)
+        self.reserve(n)
+        out = self.input[:n]
+        out[...] = x
+        for kernel, bias, activation, buffer in zip(self.kernels, self.biases, self.activations, self.buffers):
+            layer = buffer[:n]
+            np.matmul(out, kernel, out=layer)
+            layer += bias
+            if activation == "relu":
+                np.maximum(layer, 0, out=layer)
+            elif activation == "sigmoid":
+                np.negative(layer, out=layer)
+                # exp overflows to inf for very negative inputs, whose sigmoid is then 0 as it should
+                with np.errstate(over="ignore"):
+                    np.exp(layer, out=layer)
+                layer += 1
+                np.reciprocal(layer, out=layer)
+            elif activation == "tanh":
+                np.tanh(layer, out=layer)
+            elif activation == "softmax":
+                layer -= layer.max(axis=1, keepdims=True)
+                np.exp(layer, out=layer)
+                layer /= layer.sum(axis=1, keepdims=True)
+            out = layer
+        return out
+
+
+# returns the network with the weights of a keras model of Dense layers
+def from_keras(model):
+    kernels, biases, activations = [], [], []
+    for layer in model.layers:
+        weights = layer.get_weights()
+        if not weights:
+            continue  # layers without weights, such as the input layer
+        kernels.append(weights[0])
+        biases.append(weights[1] if len(weights) > 1 else np.zeros(weights[0].shape[1]))
+        activations.append(layer.get_config().get("activation", "linear"))
+    return DenseNetwork(kernels, biases, activations)
+
+
+# saves the weights of the network to an .npz file, replacing it atomically
+def save(network, path):
+    arrays = {"activations": np.array(network.activations)}
+    for i, (kernel, bias) in enumerate(zip(network.kernels, network.biases)):
+        arrays["kernel_" + str(i)] = kernel
+        arrays["bias_" + str(i)] = bias
+    data = io.BytesIO()
+    np.savez(data, **arrays)
+    storage.atomic_write(path, [data.getvalue()])
+
+
+def load(path):
+    with np.load(path) as data:
+        activations = [str(a) for a in data["activations"]]
+        kernels = [data["kernel_" + str(i)] for i in range(len(activations))]
+        biases = [data["bias_" + str(i)] for i in range(len(activations))]
+    return DenseNetwork(kernels, biases, activations)
+
+
+# returns the path of the .npz file of the weights of a keras model file
+def npz_path(model_path):
+    return model_path.rsplit(".", 1)[0] + ".npz"
+
+
+# exports the weights of a keras model file to the .npz file next to it, and returns its path
+def export(model_path):
+    from keras.models import load_model
+    path = npz_path(model_path)
+    save(from_keras(load_model(model_path)), path)
+    return path
+
+
+if __name__ == '__main__':
+    for model_path in sys.argv[1:] or [p for p in DEFAULT_MODELS if os.path.isfile(p)]:
+        print("exported", export(model_path))
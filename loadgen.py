@@ -0,0 +1,120 @@
+import argparse
+import asyncio
+import json
+import time
+
+import numpy as np
+
+import bitboard as bb
+import server
+
+
+'''
+    Load generator for server.py. Every client opens its own connection and keeps a number of
+    requests in flight (--pipeline), sending the positions of a fixed set reached by random play:
+
+    python loadgen.py --ai nn --clients 64 --requests 20000
+
+    The requests per second and the latency percentiles are reported at the end.
+'''
+
+
+# returns n positions of a 3x3 grid reached by random play in which the game has not ended
+def random_boards(n, seed):
+    rng = np.random.default_rng(seed)
+    boards = []
+    while len(boards) < n:
+        grids = np.zeros((n, 9), dtype=int)
+        for i in range(n):
+            for ply in range(rng.integers(0, 8)):
+                grids[i, rng.choice(np.flatnonzero(grids[i] == 0))] = 1 if ply % 2 == 0 else 2
+        # the results of the server, which rejects the positions of the games that have ended
+        grids = grids[bb.check_victory_batch(grids) == bb.NONE]
+        boards.extend(grids.reshape(-1, 3, 3).tolist())
+    return boards[:n]
+
+
+async def client(reader, writer, ai_type, boards, count, pipeline, latencies, errors):
+    sent = {}
+    next_id = 0
+
+    async def send():
+        nonlocal next_id
+        board = boards[next_id % len(boards)]
+        sent[next_id] = time.perf_counter()
+        writer.write((json.dumps({"id": next_id, "ai": ai_type, "board": board}) + "\n").encode())
+        next_id += 1
+
+    for _ in range(min(pipeline, count)):
+        await send()
+    await writer.drain()
+    received = 0
+    while received < count:
+        response = json.loads(await reader.readline())
+        latencies.append(time.perf_counter() - sent.pop(response["id"]))
+        if "error" in response:
+            errors.append(response["error"])
+        received += 1
+        if next_id < count:
+            await send()
+            await writer.drain()
+    writer.close()
+
+
+async def run(ai_type, clients, requests, pipeline, host, port, unix_path, seed):
+    boards = random_boards(1000, seed)
+    latencies, errors = [], []
+    connections = []
+    for _ in range(clients):
+        if unix_path is not None:
+            connections.append(await asyncio.open_unix_connection(unix_path))
+        else:
+            connections.append(await asyncio.open_connection(host, port))
+
+    start = time.perf_counter()
+    per_client = [requests // clients + (i < requests % clients) for i in range(clients)]
+    await asyncio.gather(*[client(reader, writer, ai_type, boards, count, pipeline, latencies, errors)
+                           for (reader, writer), count in zip(connections, per_client)])
+    elapsed = time.perf_counter() - start
+
+    latencies = np.array(latencies)
+    return {
+        "ai": ai_type,
+        "clients": clients,
+        "pipeline": pipeline,
+        "requests": len(latencies),
+        "errors": len(errors),
+        "first_error": errors[0] if errors else None,
+        "elapsed": elapsed,
+        "requests_per_second": len(latencies) / elapsed,
+        "p50": float(np.percentile(latencies, 50)),
+        "p95": float(np.percentile(latencies, 95)),
+        "p99": float(np.percentile(latencies, 99)),
+        "max": float(latencies.max()),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Measures the throughput and latency of server.py.")
+    parser.add_argument("--ai", choices=server.AI_TYPES, default="minimax", help="AI asked for the moves")
+    parser.add_argument("--clients", type=int, default=16, help="number of concurrent connections")
+    parser.add_argument("--requests", type=int, default=10000, help="total number of requests")
+    parser.add_argument("--pipeline", type=int, default=1, help="requests in flight on every connection")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=server.DEFAULT_PORT)
+    parser.add_argument("--unix", default=None, help="path of the Unix socket of the server")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the positions")
+    parser.add_argument("--output", default=None, help="JSON file for the results")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args.ai, args.clients, args.requests, args.pipeline, args.host, args.port, args.unix,
+                             args.seed))
+    print("%d requests in %.2f s: %.1f requests/s, %d errors" % (report["requests"], report["elapsed"],
+                                                                 report["requests_per_second"], report["errors"]))
+    if report["first_error"] is not None:
+        print("first error:", report["first_error"])
+    print("latency p50 %.2f ms, p95 %.2f ms, p99 %.2f ms, max %.2f ms" % (
+        report["p50"] * 1000, report["p95"] * 1000, report["p99"] * 1000, report["max"] * 1000))
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
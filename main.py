@@ -1,14 +1,64 @@
-import os.path
+import json
+import os
 import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-import numpy as np
 import pygame as pg
 
 import ai
-import nn
+import board as bd
+import dense
+import mcts
+import movelog
 import rl
+import stats
+import train
 import utils as ut
 
+# the neural network module loads keras, so it is imported in the background by init_network
+nn = None
+
+FPS = 60  # maximum frame rate of the game window
+IDLE_TIMEOUT = 500  # milliseconds the game waits for an event while nothing happens
+
+STARTUP_LOG = "datasets/startup_times.jsonl"
+
+MCTS_TIME = 1.0  # seconds of every move of the Monte Carlo tree search
+MCTS_WORKERS = max(1, (os.cpu_count() or 1) // 2)  # processes of the Monte Carlo tree search
+
+
+# prints the time elapsed since the game was launched until an event of the start-up, and records it in STARTUP_LOG
+def report_startup(event):
+    seconds = time.perf_counter() - startTime
+    print("startup: " + event + " after %.3f s" % seconds)
+    with open(STARTUP_LOG, "a") as f:
+        f.write(json.dumps({"event": event, "seconds": seconds, "time": time.time()}) + "\n")
+
+
+# imports the neural network module and trains the network with the new samples, run in a background thread
+def init_network():
+    global nn, model, playModel, modelHistory, modelTrained, networkError
+    try:
+        import nn
+        model, trained = nn.load_warm_model()  # the network trained in previous runs, if any
+        # a minimum of 50 training samples is required to begin training the network
+        if trainingCount >= 50:
+            if trained:
+                model, modelHistory = nn.train_incremental(model, 20, moveLog.flushed_records())
+            else:
+                model, modelHistory = nn.full_retrain(200, moveLog.flushed_records())
+            trained = True
+        modelTrained = trained
+        playModel = dense.from_keras(model)
+        report_startup("neural network ready")
+    except Exception as e:
+        networkError = str(e)
+        print("the neural network could not be loaded:", e)
+    networkReady.set()
+
 
 # returns a rect object that is centered on x and y
 def center_rect(x, y, w, h):
@@ -17,42 +67,111 @@ def center_rect(x, y, w, h):
     return rect
 
 
-# trains the selected RL-based AI by making it play against itself for num_iterations matches
+# trains the selected RL-based AI by making it play against itself for num_iterations matches, in the background
 def rl_train(num_iterations):
-    global grid
+    global trainingFuture, trainingGames, trainingTotal
+    # the button calls this function on every frame it is held down
+    if trainingFuture is not None and not trainingFuture.done():
+        return
+    trainingStop.clear()
+    trainingGames, trainingTotal = 0, num_iterations
+    trainingFuture = trainer.submit(train.train, aiType, num_iterations, batch_size=10, stop_event=trainingStop,
+                                    progress=training_progress)
+
 
-    if aiType == "qagent":
-        white_agent = rl.QAgent(True, 0.8)
-        black_agent = rl.QAgent(False, 0.8)
+def training_progress(games):
+    global trainingGames
+    trainingGames = games
+
+
+# stops the training at the end of the current batch of games
+def cancel_training():
+    trainingStop.set()
+
+
+# tells if a training started with rl_train is still running
+def training_running():
+    return trainingFuture is not None and not trainingFuture.done()
+
+
+# shows the progress of the training and the button to cancel it, in place of the buttons of the title screen
+def show_training_progress():
+    if trainingStop.is_set():
+        ut.display_text("stopping the training...", mediumFont, white, width // 2 + 150, height // 2 - 60, screen)
     else:
-        white_agent = rl.DeepAgent(True, 0.8)
-        black_agent = rl.DeepAgent(False, 0.8)
-
-    for i in range(num_iterations):
-        if i % 20 == 0:
-            print("iteration: ", i)
-        slim_restart()
-        while ai.check_victory(grid) is None:
-            grid = white_agent.make_move_and_learn(grid, None)
-            if ai.check_victory(grid) is not None:
-                break
-            grid = black_agent.make_move_and_learn(grid, None)
-
-        # update last state
-        white_agent.make_move_and_learn(grid, ai.check_victory(grid))
-        black_agent.make_move_and_learn(grid, ai.check_victory(grid))
-        # update winning state
-        white_agent.make_move_and_learn(grid, ai.check_victory(grid))
-        black_agent.make_move_and_learn(grid, ai.check_victory(grid))
-
-    white_agent.save_values()
-    black_agent.save_values()
-
-
-# updates the AI type to play against
+        ut.display_text("training: " + str(trainingGames) + "/" + str(trainingTotal) + " matches", mediumFont, white,
+                        width // 2 + 150, height // 2 - 60, screen)
+    ut.button("cancel training", center_rect(width // 2 + 150, height // 2 + 120, 175, 50), (120, 0, 255),
+              (140, 40, 255), white, screen, mouse, action=cancel_training)
+
+
+'''
+    The following functions run in the worker thread, so the game loop keeps processing events while
+    they run. The worker runs one task at a time in the order they were submitted, so a move is
+    always computed after the agent of its game has been created. The tasks submitted for a game
+    that has been restarted since then are skipped.
+'''
+
+
+# creates the agent of the AI and trains the neural network with the new samples
+def prepare_game(game, ai_type, agent_first):
+    global q_agent, deep_agent, model, playModel, modelHistory, modelTrained
+    if game != gameId:
+        return
+    if ai_type == "qagent":
+        q_agent = rl.QAgent(agent_first)
+    if ai_type == "deeprl":
+        deep_agent = rl.DeepAgent(agent_first)
+    if ai_type == "nn" and networkReady.is_set() and (modelTrained or not modelTrained and trainingCount >= 50):
+        # the network is fine-tuned on the compacted log when moves have been logged since its last training
+        model, history = nn.train_incremental(model, 20, moveLog.flushed_records())
+        if history is not None:
+            modelHistory = history
+            playModel = dense.from_keras(model)
+        modelTrained = True
+
+
+# returns the Monte Carlo tree search agent of a colour, the agents and their pools of processes are kept for every game
+def get_mcts_agent(first_move):
+    if first_move not in mcts_agents:
+        mcts_agents[first_move] = mcts.MCTSAgent(first_move, rows, columns, winLength, time_limit=MCTS_TIME,
+                                                 workers=MCTS_WORKERS)
+    return mcts_agents[first_move]
+
+
+# returns the cell of the move of the AI in a copy of the board and the result of the minimax search, or None if the
+# game was restarted
+def compute_ai_move(game, ai_type, board):
+    if game != gameId:
+        return None
+    best = None
+    with stats.timer("main.ai_move"):
+        if ai_type == "nn":
+            cell = nn.choose_move(playModel, board.grid())
+        elif ai_type == "minimax":
+            best = ai.minimax_board(board)
+            cell = best[0] * board.cols + best[1]
+        elif ai_type == "qagent":
+            cell = q_agent.choose_move_and_learn(board)
+        elif ai_type == "deeprl":
+            cell = deep_agent.choose_move_and_learn(board)
+        elif ai_type == "mcts":
+            cell = get_mcts_agent(board.white_turn).choose_move_and_learn(board)
+    return cell, best
+
+
+# lets the agent learn from the end of the game and saves its values
+def save_agent(ai_type, grid, victory):
+    agent = q_agent if ai_type == "qagent" else deep_agent
+    agent.make_move_and_learn(grid, victory)
+    agent.save_values()
+
+
+# updates the AI type to play against, the AIs based on learning only know the classic 3x3 game
 def change_ai(text):
     global aiType
-    aiType = text
+    if classicGame or text in ("minimax", "mcts"):
+        aiType = text
 
 
 # updates the global gameState with the text provided
@@ -68,56 +187,109 @@ def set_logging(log):
     logging = log
 
 
+# shows or hides the statistics overlay, the statistics are recorded from the first time it is shown
+def toggle_stats():
+    global showStats
+    showStats = not showStats
+    if showStats:
+        stats.enable()
+
+
+# shows the latency of the last move of the AI and the nodes expanded by the last minimax search
+def show_stats_overlay():
+    snapshot = stats.get_stats()
+    move = snapshot["timers"].get("main.ai_move")
+    latency = "-" if move is None else "%.1f ms" % (move["last"] * 1000)
+    nodes = snapshot["gauges"].get("ai.last_nodes")
+    depth = snapshot["gauges"].get("ai.last_depth")
+    ut.display_text("last AI move: " + latency, mediumFont, white, 100, height - 60, screen)
+    ut.display_text("nodes: " + ("-" if nodes is None else str(nodes) + " (depth " + str(depth) + ")"),
+                    mediumFont, white, 100, height - 35, screen)
+
+
 # restarts the game
 def restart():
-    global model, modelHistory, modelTrained, trainingCount, best, q_agent, q_values_saved, deep_agent, \
-        deep_values_saved, white_turn, player_turn, player_first
+    global best, q_values_saved, deep_values_saved, player_turn, player_first, gameId, aiFuture, aiError
     slim_restart()
     best = None  # used for playing against the minimax AI
-    white_turn = True
     player_turn = bool(random.getrandbits(1))
     player_first = player_turn
+    gameId = gameId + 1
+    aiFuture = None  # the move of the previous game is discarded
+    aiError = None
+
+    # the moves logged so far are written before the network is trained with them
+    moveLog.flush()
 
     if gameState == "aiGame":
-        if aiType == "qagent":
-            q_agent = rl.QAgent(not player_first)
-            q_values_saved = False
+        q_values_saved = False
+        deep_values_saved = False
+        worker.submit(prepare_game, gameId, aiType, not player_first)
 
-        if aiType == "deeprl":
-            deep_agent = rl.DeepAgent(not player_first)
-            deep_values_saved = False
 
-        if aiType == "nn" and (modelTrained or not modelTrained and trainingCount >= 50):
-            model, modelHistory = nn.train_model(model, 100)
-            modelTrained = True
+# exits the game, writing the moves that have not been logged yet
+def quit_game():
+    trainingStop.set()
+    worker.shutdown(wait=True)
+    trainer.shutdown(wait=True)
+    for agent in mcts_agents.values():
+        agent.close()
+    moveLog.close()
+    stats.stop_dump()
+    pg.quit()
+    quit()
 
 
 # only initializes the parameters needed for carrying out a game
 def slim_restart():
-    global grid, victory
-    grid = np.zeros((grid.shape[0], grid.shape[1]))
+    global victory
+    board.reset()
     victory = None
 
 
 if __name__ == '__main__':
+    startTime = time.perf_counter()
     pg.init()
-    model = nn.create_model()
-    trainingCount = 0  # number of training samples for the neural network
+    model = None
+    playModel = None  # numpy copy of the weights of the model, which plays the moves
+    modelHistory = None
     modelTrained = False
+    networkError = None
+    networkReady = threading.Event()  # set when init_network has finished
     logging = True
-
-    # check if the files containing the training samples exist
-    if os.path.isfile("datasets/xvalues.txt") and os.path.isfile("datasets/yvalues.txt"):
-        with open('datasets/xvalues.txt') as file:
-            trainingCount = sum(1 for line in file)
-            # a minimum of 50 training samples is required to begin training the network
-            if trainingCount >= 50:
-                model, modelHistory = nn.train_model(model, 200)
-                modelTrained = True
+    showStats = False  # statistics overlay, toggled with F3
+    stats.configure_from_env()
+
+    # the samples of the text files of previous versions are imported into the move log the first time
+    movelog.ensure_log()
+    moveLog = movelog.MoveLogger()  # logs the moves of the players, see movelog.py
+    trainingCount = movelog.count_records()  # number of training samples for the neural network
+
+    # the title screen is shown while the network is loaded and trained, the other AI types can be played meanwhile
+    threading.Thread(target=init_network, daemon=True).start()
+
+    worker = ThreadPoolExecutor(max_workers=1)  # computes the moves of the AI and saves its values
+    trainer = ThreadPoolExecutor(max_workers=1)  # trains the RL-based AIs
+    gameId = 0  # incremented on every restart
+    aiFuture = None  # move of the AI being computed
+    aiError = None  # error of the last move of the AI, which stops the game until it is restarted
+    trainingFuture = None  # training started with rl_train
+    trainingStop = threading.Event()  # set to cancel the training
+    trainingGames, trainingTotal = 0, 0
+    mcts_agents = {}  # Monte Carlo tree search agents, by colour
+
+    # the size of the grid and the number of pieces in a row needed to win can be given as arguments:
+    # python main.py rows columns win_length
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    columns = int(sys.argv[2]) if len(sys.argv) > 2 else rows
+    winLength = int(sys.argv[3]) if len(sys.argv) > 3 else min(rows, columns)
+    classicGame = (rows, columns, winLength) == (3, 3, 3)
 
     size = width, height = 1024, 600  # size of the screen
     screen = pg.display.set_mode(size)
     pg.display.set_caption('tictAItoe')  # title of the game window
+    # only the changed parts of the frames are shown, and the loop sleeps while nothing happens
+    renderer = ut.Renderer(screen, FPS, IDLE_TIMEOUT)
 
     '''
         The possible gameStates are the following:
@@ -135,8 +307,9 @@ if __name__ == '__main__':
         aiType = "minimax"  -> AI based on the minimax algorithm, intended to be unbeatable
         aiType = "qagent"   -> AI based on Q-learning
         aiType = "deeprl"   -> AI based on Reinforcement Learning with a Neural Network
+        aiType = "mcts"     -> AI based on Monte Carlo tree search, which also plays on larger grids
     '''
-    aiType = "nn"
+    aiType = "nn" if classicGame else "minimax"
 
     '''
         The possible victory values are the following:
@@ -148,77 +321,81 @@ if __name__ == '__main__':
     '''
     victory = None
 
-    largeFont = pg.font.Font(None, 48)
-    mediumFont = pg.font.Font(None, 24)
+    largeFont = ut.get_font(48)
+    mediumFont = ut.get_font(24)
 
     white = (255, 255, 255)  # constant for white color
     black = (0, 0, 0)  # constant for black color
 
     '''
-        The play grid is a 3x3 matrix. The cell values mean the following:
+        The play grid is a rows x columns board (see board.py), 3x3 by default, which also keeps the side
+        to move. The cell values mean the following:
         cell = 0 -> Empty cell
         cell = 1 -> White cell
         cell = 2 -> Black cell
     '''
-    grid = np.zeros((3, 3))
-    cellMargin = 20  # Margin between cells
-    grid_W = 80  # Width of each cell
-    grid_H = 80  # Height of each cell
-    margin_X = width // 2 - ((cellMargin + grid_W) * grid.shape[1] + cellMargin) / 2  # Horizontal margin of the grid
-    margin_Y = height // 2 - ((cellMargin + grid_H) * grid.shape[0] + cellMargin) / 2  # Vertical margin of the grid
-    white_turn = True  # Indicates if it's White's turn
+    board = bd.Board(rows, columns, winLength)
+    grid_W = min(80, (height - 240) // max(rows, columns) * 4 // 5)  # Width of each cell
+    grid_H = grid_W  # Height of each cell
+    cellMargin = grid_W // 4  # Margin between cells
+    margin_X = width // 2 - ((cellMargin + grid_W) * columns + cellMargin) / 2  # Horizontal margin of the grid
+    margin_Y = height // 2 - ((cellMargin + grid_H) * rows + cellMargin) / 2  # Vertical margin of the grid
     player_turn = True  # Indicates if it's the player's turn (in a game vs AI)
     player_first = player_turn
 
+    firstFrame = True
+
     # game loop
     while True:
         mouse = pg.mouse.get_pos()  # mouse position
         screen.fill((66, 134, 244))  # set screen background color
 
-        for event in pg.event.get():
+        # the loop keeps running at full frame rate while the AI thinks or something is loaded in the background
+        busy = (gameState == "aiGame" and not player_turn and victory is None) or training_running() or \
+            (gameState == "title" and not networkReady.is_set())
+        for event in renderer.events(busy):
             if event.type == pg.QUIT:
                 # exit the game
-                pg.quit()
-                quit()
+                quit_game()
+            elif event.type == pg.KEYDOWN and event.key == pg.K_F3:
+                toggle_stats()
             elif event.type == pg.MOUSEBUTTONDOWN:
                 # a click has been registered
                 if gameState == "twoPlayerGame" or (gameState == "aiGame" and player_turn):
                     # detect which cell the user has clicked
-                    row = (mouse[1] - margin_Y) // (grid_H + cellMargin)
-                    column = (mouse[0] - margin_X) // (grid_W + cellMargin)
+                    row = int((mouse[1] - margin_Y) // (grid_H + cellMargin))
+                    column = int((mouse[0] - margin_X) // (grid_W + cellMargin))
                     # check if it's an empty cell inside the grid and if the game has not finished yet
-                    if 0 <= row < grid.shape[0] and 0 <= column < grid.shape[1] and grid[int(row)][int(column)] == 0 \
+                    if 0 <= row < rows and 0 <= column < columns and board.cells[row * columns + column] == 0 \
                             and victory is None:
-                        if logging:
-                            # log current grid state
-                            with open('datasets/xvalues.txt', 'a+') as outfile:
-                                grid.tofile(outfile, sep=" ")
-                                outfile.write("\n")
-                        if white_turn:
-                            grid[int(row)][int(column)] = 1
-                        else:
-                            grid[int(row)][int(column)] = 2
-                        if logging:
-                            # log player move
-                            with open('datasets/yvalues.txt', 'a+') as outfile:
-                                outfile.write(str(3 * row + column))
-                                outfile.write("\n")
+                        if logging and classicGame:
+                            # log current grid state and player move
+                            moveLog.log(board.grid(), row * columns + column)
+                        board.play(row * columns + column)  # The turn passes to the other player
                         trainingCount = trainingCount + 1
-                        white_turn = not white_turn  # The turn passes to the other player
                         player_turn = not player_turn  # The turn passes to the AI
-                        victory = ai.check_victory(grid)  # Check if the game has ended
+                        victory = board.victory  # Check if the game has ended
+                        if victory is not None:
+                            moveLog.flush()
 
         if gameState == "title":
             ut.display_text("tictAItoe", largeFont, (0, 0, 255), width // 2, height // 4, screen)
 
             if aiType == "nn":
-                if modelTrained:
+                if not networkReady.is_set():
+                    ut.display_text("the neural network is being trained...", mediumFont, white, width // 2,
+                                    height // 2 - 65, screen)
+                elif networkError is not None:
+                    ut.display_text("the neural network could not be loaded: " + networkError, mediumFont, white,
+                                    width // 2, height // 2 - 65, screen)
+                elif modelTrained:
                     ut.button("play against the AI", center_rect(width // 2 + 150, height // 2 - 60, 175, 50),
                               (0, 195, 255), (18, 206, 255), white, screen, mouse, action=update_game_state,
                               arg="aiGame")
-                    ut.button("plot training results", center_rect(width // 2 + 150, height // 2 + 120, 175, 50),
-                              (120, 0, 255), (140, 40, 255), white, screen, mouse,action=nn.plot_training,
-                              arg=modelHistory)
+                    if modelHistory is not None:
+                        ut.button("plot training results", center_rect(width // 2 + 150, height // 2 + 120, 175, 50),
+                                  (120, 0, 255), (140, 40, 255), white, screen, mouse, action=nn.plot_training,
+                                  arg=modelHistory)
                 else:
                     ut.display_text("there are not enough training samples to train the network!", mediumFont, white,
                                     width // 2, height // 2 - 65, screen)
@@ -244,18 +421,32 @@ if __name__ == '__main__':
                           (0, 195, 255), (18, 206, 255), white, screen, mouse, action=update_game_state, arg="aiGame")
                 ut.display_text("AI based on the minimax algorithm, intended to be unbeatable.", mediumFont, white,
                                 width // 2, height - 65, screen)
-            if aiType == "qagent":
+            if aiType == "mcts":
                 ut.button("play against the AI", center_rect(width // 2 + 150, height // 2 - 60, 175, 50),
                           (0, 195, 255), (18, 206, 255), white, screen, mouse, action=update_game_state, arg="aiGame")
-                ut.button("train AI", center_rect(width // 2 + 150, height // 2 + 120, 175, 50),
-                          (120, 0, 255), (140, 40, 255), white, screen, mouse, action=rl_train, arg=200)
+                ut.display_text("AI based on Monte Carlo tree search, thinks for " + str(MCTS_TIME) +
+                                " s per move with " + str(MCTS_WORKERS) + " processes.", mediumFont, white, width // 2,
+                                height - 65, screen)
+            if aiType == "qagent":
+                if training_running():
+                    show_training_progress()
+                else:
+                    ut.button("play against the AI", center_rect(width // 2 + 150, height // 2 - 60, 175, 50),
+                              (0, 195, 255), (18, 206, 255), white, screen, mouse, action=update_game_state,
+                              arg="aiGame")
+                    ut.button("train AI", center_rect(width // 2 + 150, height // 2 + 120, 175, 50),
+                              (120, 0, 255), (140, 40, 255), white, screen, mouse, action=rl_train, arg=200)
                 ut.display_text("AI based on Q-learning. Select 'train AI' to make the AI play against itself for 200 "
                                 "matches.", mediumFont, white, width // 2, height - 65, screen)
             if aiType == "deeprl":
-                ut.button("play against the AI", center_rect(width // 2 + 150, height // 2 - 60, 175, 50),
-                          (0, 195, 255), (18, 206, 255), white, screen, mouse, action=update_game_state, arg="aiGame")
-                ut.button("train AI", center_rect(width // 2 + 150, height // 2 + 120, 175, 50),
-                          (120, 0, 255), (140, 40, 255), white, screen, mouse, action=rl_train, arg=50)
+                if training_running():
+                    show_training_progress()
+                else:
+                    ut.button("play against the AI", center_rect(width // 2 + 150, height // 2 - 60, 175, 50),
+                              (0, 195, 255), (18, 206, 255), white, screen, mouse, action=update_game_state,
+                              arg="aiGame")
+                    ut.button("train AI", center_rect(width // 2 + 150, height // 2 + 120, 175, 50),
+                              (120, 0, 255), (140, 40, 255), white, screen, mouse, action=rl_train, arg=50)
                 ut.display_text("AI based on Reinforcement Learning with a Neural Network.", mediumFont, white,
                                 width // 2, height - 65, screen)
                 ut.display_text("Select 'train AI' to make the AI play against itself for 50 matches.", mediumFont,
@@ -264,16 +455,21 @@ if __name__ == '__main__':
             ut.button("play against a friend", center_rect(width // 2 + 150, height // 2, 175, 50), (0, 0, 215),
                       (0, 0, 255), white, screen, mouse, action=update_game_state, arg="twoPlayerGame")
             ut.button("quit", center_rect(width // 2 + 150, height // 2 + 60, 175, 50), (120, 0, 255), (140, 40, 255),
-                      white, screen, mouse, action=quit)
-            ut.button("Neural Network", center_rect(width // 2 - 150, height // 2 - 60, 175, 50), (0, 0, 215),
+                      white, screen, mouse, action=quit_game)
+            ut.button("Neural Network", center_rect(width // 2 - 150, height // 2 - 90, 175, 50), (0, 0, 215),
                       (0, 0, 255), white, screen, mouse, bc=white, bw=1, action=change_ai, arg="nn")
-            ut.button("Minimax", center_rect(width // 2 - 150, height // 2, 175, 50), (0, 0, 215), (0, 0, 255), white,
-                      screen, mouse, bc=white, bw=1, action=change_ai, arg="minimax")
-            ut.button("Q-learning", center_rect(width // 2 - 150, height // 2 + 60, 175, 50), (0, 0, 215), (0, 0, 255),
+            ut.button("Minimax", center_rect(width // 2 - 150, height // 2 - 30, 175, 50), (0, 0, 215), (0, 0, 255),
+                      white, screen, mouse, bc=white, bw=1, action=change_ai, arg="minimax")
+            ut.button("Q-learning", center_rect(width // 2 - 150, height // 2 + 30, 175, 50), (0, 0, 215), (0, 0, 255),
                       white, screen, mouse, bc=white, bw=1, action=change_ai, arg="qagent")
-            ut.button("Deep RL", center_rect(width // 2 - 150, height // 2 + 120, 175, 50), (0, 0, 215), (0, 0, 255),
+            ut.button("Deep RL", center_rect(width // 2 - 150, height // 2 + 90, 175, 50), (0, 0, 215), (0, 0, 255),
                       white, screen, mouse, bc=white, bw=1, action=change_ai, arg="deeprl")
-            ut.display_text("AI type", mediumFont, white, width // 2 - 150, height // 2 - 105, screen)
+            ut.button("MCTS", center_rect(width // 2 - 150, height // 2 + 150, 175, 50), (0, 0, 215), (0, 0, 255),
+                      white, screen, mouse, bc=white, bw=1, action=change_ai, arg="mcts")
+            ut.display_text("AI type", mediumFont, white, width // 2 - 150, height // 2 - 135, screen)
+            if not classicGame:
+                ut.display_text("only minimax and MCTS play on a " + str(rows) + "x" + str(columns) + " grid with " +
+                                str(winLength) + " in a row", mediumFont, white, width // 2, height - 30, screen)
 
         elif gameState == "twoPlayerGame" or gameState == "aiGame":
             if victory is not None:
@@ -287,19 +483,17 @@ if __name__ == '__main__':
                     turnMsgColor = (0, 0, 255)
 
                 if gameState == "aiGame" and aiType == "qagent" and not q_values_saved:
-                    q_agent.make_move_and_learn(grid, ai.check_victory(grid))
-                    q_agent.save_values()
+                    worker.submit(save_agent, aiType, board.to_grid(), victory)
                     q_values_saved = not q_values_saved
                 if gameState == "aiGame" and aiType == "deeprl" and not deep_values_saved:
-                    deep_agent.make_move_and_learn(grid, ai.check_victory(grid))
-                    deep_agent.save_values()
+                    worker.submit(save_agent, aiType, board.to_grid(), victory)
                     deep_values_saved = not deep_values_saved
 
                 ut.button("restart", center_rect(width // 2, height - 110, 175, 50), (0, 0, 215), (0, 0, 255), white,
                           screen, mouse, action=restart)
                 ut.button("back to main menu", center_rect(width // 2, height - 50, 175, 50), (120, 0, 215),
                           (140, 40, 255), white, screen, mouse, action=update_game_state, arg="title")
-            elif white_turn:
+            elif board.white_turn:
                 turnMsg = "it's White's turn"
                 turnMsgColor = white
             else:
@@ -327,19 +521,37 @@ if __name__ == '__main__':
                         ut.display_text("The AI thinks that you will win", mediumFont, white, width // 2, height - 110,
                                         screen)
 
-                if not player_turn and victory is None:
-                    if aiType == "nn":
-                        grid = nn.make_move(model, grid, white_turn)
-                    elif aiType == "minimax":
-                        grid, best = ai.make_move_minimax(grid, white_turn)
-                    elif aiType == "qagent":
-                        grid = q_agent.make_move_and_learn(grid, ai.check_victory(grid))
-                    elif aiType == "deeprl":
-                        grid = deep_agent.make_move_and_learn(grid, ai.check_victory(grid))
-                    white_turn = not white_turn  # The turn passes to the other player
-                    player_turn = not player_turn  # The turn passes to the human
-                    victory = ai.check_victory(grid)  # Check if the game has ended
-
-            ut.display_grid(grid, screen, mouse, cellMargin, grid_W, grid_H, margin_X, margin_Y)
-
-        pg.display.flip()
+                if not player_turn and victory is None and aiError is not None:
+                    ut.display_text("the AI could not play its move: " + aiError, mediumFont, white, width // 2, 70,
+                                    screen)
+                elif not player_turn and victory is None:
+                    if aiFuture is None:
+                        aiFuture = worker.submit(compute_ai_move, gameId, aiType, board.copy())
+                    if aiFuture.done():
+                        try:
+                            result = aiFuture.result()
+                        except Exception as e:
+                            print("the AI could not play its move:", repr(e))
+                            aiError = str(e) or type(e).__name__
+                            result = None
+                        aiFuture = None
+                        if result is not None:
+                            cell, aiBest = result
+                            if aiType == "minimax":
+                                best = aiBest
+                            board.play(cell)  # The turn passes to the other player
+                            player_turn = not player_turn  # The turn passes to the human
+                            victory = board.victory  # Check if the game has ended
+                    else:
+                        ut.display_text("the AI is thinking" + "." * (int(time.time() * 3) % 4), mediumFont, white,
+                                        width // 2, 70, screen)
+
+            ut.display_grid(board, screen, mouse, cellMargin, grid_W, grid_H, margin_X, margin_Y)
+
+        if showStats:
+            show_stats_overlay()
+
+        renderer.present()
+        if firstFrame:
+            report_startup("first frame")
+            firstFrame = False
@@ -0,0 +1,354 @@
+import contextlib
+import io
+import math
+import multiprocessing
+import os
+import random
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+
+import bitboard as bb
+import rl
+import stats
+
+
+'''
+    Monte Carlo tree search with UCT selection, for grids of any size. Instead of searching every
+    move to the end of the game, it plays random games (playouts) from the positions of a tree that
+    grows towards the most promising moves, so it plays better the more playouts it is given, and
+    it plays on the grids that minimax can not search to the end.
+
+    The tree is kept between moves: the next search starts from the node of the new position, two
+    plies below the previous root, with the playouts of the previous search. With several workers,
+    every worker of a process pool searches its own tree from the same position (root
+    parallelisation) and the visits of the moves of the roots are added up.
+
+    On the 3x3 grid, the values learned by the QAgent or the DeepAgent can guide the playouts: every
+    move of a playout is the one that the agent of the side to move would play, looking ahead at the
+    replies of the opponent (see rl.Agent.make_optimal_move), or a random one with a probability of
+    GUIDE_EPSILON. The agents only have values for the positions in which they are to move, so the
+    positions right after their own moves can not be valued directly.
+'''
+# exploration constant of UCT
+UCT_C = math.sqrt(2)
+
+# playouts of a search when neither the number of playouts nor the time are given
+DEFAULT_PLAYOUTS = 2000
+
+# probability of a random move in the playouts guided by the values of an agent
+GUIDE_EPSILON = 0.2
+
+GUIDES = ("qagent", "deeprl")
+
+# seconds that a worker waits for the others to start the search of a move
+BARRIER_TIMEOUT = 60
+
+# upper bounds of the buckets of the histogram of the playouts kept from the previous search
+REUSE_BOUNDS = (0, 10, 100, 1000, 10000, 100000)
+
+
+class Node:
+    __slots__ = ("move", "parent", "children", "untried", "visits", "wins", "white", "black", "white_turn", "result")
+
+    def __init__(self, move, parent, white, black, white_turn, result, untried):
+        self.move = move
+        self.parent = parent
+        self.children = []
+        # moves that do not have a child yet, in random order
+        self.untried = untried
+        self.visits = 0
+        # sum of the rewards of the playouts for the player who made move: 1 for a win, 0.5 for a draw
+        self.wins = 0.0
+        self.white = white
+        self.black = black
+        self.white_turn = white_turn
+        self.result = result
+
+    # returns the child with the highest upper confidence bound
+    def select(self, c):
+        log_visits = math.log(self.visits)
+        return max(self.children, key=lambda n: n.wins / n.visits + c * math.sqrt(log_visits / n.visits))
+
+
+# creates the agents (white, black) of a guide, without exploration
+def load_guides(guide):
+    if guide not in GUIDES:
+        raise ValueError("unknown guide: " + str(guide) + ", the guides are " + ", ".join(GUIDES))
+    # the agents print when they load their values
+    with contextlib.redirect_stdout(io.StringIO()):
+        if guide == "qagent":
+            return rl.QAgent(True), rl.QAgent(False)
+        return rl.DeepAgent(True, play_only=True), rl.DeepAgent(False, play_only=True)
+
+
+class Tree:
+    '''
+        rows, cols, k:  Geometry of the grid.
+        guide:          "qagent" or "deeprl" to guide the playouts with the values of the agents, only on 3x3.
+        seed:           Seed of the random generator, None to use the generator of the random module.
+    '''
+    def __init__(self, rows=3, cols=3, k=3, c=UCT_C, guide=None, seed=None):
+        self.geo = bb.geometry(rows, cols, k)
+        self.c = c
+        if guide is not None and (rows, cols, k) != (3, 3, 3):
+            raise ValueError("the values of the agents only guide the playouts of the 3x3 grid")
+        self.guides = load_guides(guide) if guide is not None else None
+        self.rng = random.Random(seed) if seed is not None else random
+        self.root = None
+
+    def new_node(self, move, parent, white, black, white_turn, result):
+        untried = []
+        if result == bb.NONE:
+            empty = self.geo.full_mask & ~(white | black)
+            untried = [x for x in range(self.geo.num_cells) if empty >> x & 1]
+            self.rng.shuffle(untried)
+        return Node(move, parent, white, black, white_turn, result, untried)
+
+    # returns the node of the position, found among the grandchildren of the previous root or created
+    def find_root(self, white, black, white_turn):
+        if self.root is not None:
+            children = self.root.children
+            grandchildren = [grandchild for child in children for grandchild in child.children]
+            for node in [self.root] + children + grandchildren:
+                if (node.white, node.black, node.white_turn) == (white, black, white_turn):
+                    node.parent = None
+                    stats.observe("mcts.reused_playouts", node.visits, REUSE_BOUNDS)
+                    return node
+        stats.observe("mcts.reused_playouts", 0, REUSE_BOUNDS)
+        return self.new_node(None, None, white, black, white_turn, self.geo.winner(white, black))
+
+    # plays random moves, or the moves of the guides, until the end of the game and returns the result code
+    def playout(self, node):
+        if node.result != bb.NONE:
+            return node.result
+        if self.guides is not None:
+            return self.guided_playout(node.white, node.black, node.white_turn)
+        white, black, white_turn = node.white, node.black, node.white_turn
+        empty = self.geo.full_mask & ~(white | black)
+        moves = [x for x in range(self.geo.num_cells) if empty >> x & 1]
+        # playing the empty cells in a random order is the same as choosing every move at random
+        self.rng.shuffle(moves)
+        for x in moves:
+            if white_turn:
+                white |= 1 << x
+                if self.geo.wins_through(white, x):
+                    return bb.WHITE
+            else:
+                black |= 1 << x
+                if self.geo.wins_through(black, x):
+                    return bb.BLACK
+            white_turn = not white_turn
+        return bb.DRAW
+
+    # returns the cell that the guide of the side to move plays in a (3, 3) state, with its own lookahead
+    def guide_move(self, state, white_turn):
+        new_state = self.guides[0 if white_turn else 1].make_optimal_move(state)
+        return int(np.flatnonzero(new_state != state)[0])
+
+    def guided_playout(self, white, black, white_turn):
+        state = bb.unpack(white, black)
+        while True:
+            if self.rng.random() < GUIDE_EPSILON:
+                moves = np.flatnonzero(state == 0)
+                cell = moves[self.rng.randrange(len(moves))]
+            else:
+                cell = self.guide_move(state, white_turn)
+            state.flat[cell] = 1 if white_turn else 2
+            result = bb.winner(*bb.pack(state))
+            if result != bb.NONE:
+                return result
+            white_turn = not white_turn
+
+    # adds the result of a playout to the node and its ancestors, from the point of view of who moved into each
+    @staticmethod
+    def backpropagate(node, result):
+        while node is not None:
+            node.visits += 1
+            if result == bb.DRAW:
+                node.wins += 0.5
+            elif (result == bb.WHITE) != node.white_turn:
+                node.wins += 1
+            node = node.parent
+
+    # selects a leaf with UCT, expands one of its moves, plays out from it and backpropagates the result
+    def iterate(self, root):
+        node = root
+        while not node.untried and node.children:
+            node = node.select(self.c)
+        if node.untried:
+            x = node.untried.pop()
+            bit = 1 << x
+            if node.white_turn:
+                white, black = node.white | bit, node.black
+                won = self.geo.wins_through(white, x)
+            else:
+                white, black = node.white, node.black | bit
+                won = self.geo.wins_through(black, x)
+            if won:
+                result = bb.WHITE if node.white_turn else bb.BLACK
+            elif white | black == self.geo.full_mask:
+                result = bb.DRAW
+            else:
+                result = bb.NONE
+            child = self.new_node(x, node, white, black, not node.white_turn, result)
+            node.children.append(child)
+            node = child
+        self.backpropagate(node, self.playout(node))
+
+    '''
+        Searches the position and returns the visits and the wins of every move of the root, as a
+        dict {cell: (visits, wins)}.
+        playouts:   Number of playouts, counting the ones kept from the previous search.
+        time_limit: Seconds of the search. Without playouts nor time limit, DEFAULT_PLAYOUTS are played.
+    '''
+    def search(self, white, black, white_turn, playouts=None, time_limit=None):
+        root = self.find_root(white, black, white_turn)
+        self.root = root
+        if root.result != bb.NONE:
+            return {}
+        if playouts is None and time_limit is None:
+            playouts = DEFAULT_PLAYOUTS
+        deadline = None if time_limit is None else time.perf_counter() + time_limit
+        done = 0
+        while playouts is None or root.visits < playouts:
+            self.iterate(root)
+            done += 1
+            if deadline is not None and done & 63 == 0 and time.perf_counter() > deadline:
+                break
+        stats.count("mcts.playouts", done)
+        return {child.move: (child.visits, child.wins) for child in root.children}
+
+
+_worker_trees = {}
+_worker_barrier = None
+
+
+# keeps the barrier shared by the workers of the pool
+def init_worker(barrier):
+    global _worker_barrier
+    _worker_barrier = barrier
+
+
+'''
+    Searches a position in a worker of the pool, with a tree of the worker that is kept for its next
+    searches. Every search of a move waits at the barrier until all the workers have taken one, so
+    each worker searches its own tree once instead of a worker taking several searches in a row.
+    Returns the id of the worker's process with the visits and wins of the moves of the root.
+'''
+def search_in_worker(geometry, guide, white, black, white_turn, playouts, time_limit):
+    if _worker_barrier is not None:
+        _worker_barrier.wait(BARRIER_TIMEOUT)
+    if (geometry, guide) not in _worker_trees:
+        _worker_trees[(geometry, guide)] = Tree(*geometry, guide=guide)
+    return os.getpid(), _worker_trees[(geometry, guide)].search(white, black, white_turn, playouts, time_limit)
+
+
+# adds up the root statistics of (pid, moves) results, counting the tree of every process once
+def merge_results(results):
+    moves = {}
+    for _, worker_moves in dict(results).items():
+        for cell, (visits, wins) in worker_moves.items():
+            total = moves.get(cell, (0, 0.0))
+            moves[cell] = (total[0] + visits, total[1] + wins)
+    return moves
+
+
+# returns the move with the most visits of the merged root statistics, as (cell, expected reward)
+def best_move(moves):
+    cell = max(moves, key=lambda x: moves[x][0])
+    visits, wins = moves[cell]
+    return cell, wins / visits
+
+
+'''
+    Agent that plays the moves of a Monte Carlo tree search, through the interface of rl.Agent. It
+    does not learn, and it plays on any grid.
+    playouts:   Playouts of every move, added up across the workers.
+    time_limit: Seconds of every move. Without playouts nor time limit, DEFAULT_PLAYOUTS are played.
+    workers:    Processes searching the position at once, 1 to search in the calling thread.
+    guide:      "qagent" or "deeprl" to guide the playouts with the values of the agents (3x3 only).
+'''
+class MCTSAgent(rl.Agent):
+    def __init__(self, first_move, rows=3, cols=3, k=3, playouts=None, time_limit=None, workers=1, guide=None,
+                 seed=None):
+        super().__init__(first_move)
+        self.geometry = (rows, cols, k)
+        self.playouts = playouts
+        self.time_limit = time_limit
+        self.workers = workers
+        self.guide = guide
+        self.geo = bb.geometry(rows, cols, k)
+        self.tree = Tree(rows, cols, k, guide=guide, seed=seed) if workers == 1 else None
+        self.pool = None
+        self.barrier = None  # barrier of the workers of the pool, see search_in_worker
+        # expected reward of the last move played, 1 for a sure win and 0 for a sure loss
+        self.last_value = None
+
+    def choose_move(self, state):
+        return self.search_move(*self.geo.pack(state))
+
+    # the search does not learn, and a board.Board already has the masks of its position
+    def choose_move_and_learn(self, board):
+        return self.search_move(board.white, board.black)
+
+    # returns the cell of the move for a position, searching it with the tree or with the pool of workers
+    def search_move(self, white, black):
+        with stats.timer("mcts.search"):
+            if self.workers == 1:
+                moves = self.tree.search(white, black, self.first_move, self.playouts, self.time_limit)
+            else:
+                try:
+                    moves = merge_results(self.search_in_pool(white, black))
+                except (threading.BrokenBarrierError, BrokenProcessPool, TimeoutError) as e:
+                    # a worker that timed out or died breaks the barrier of the pool for good, so the pool is
+                    # replaced on the next move and this one is searched in the calling thread
+                    print("the workers of the search failed, searching in a single process:", repr(e))
+                    stats.count("mcts.pool_failures")
+                    self.close(wait=False)
+                    if self.tree is None:
+                        self.tree = Tree(*self.geometry, guide=self.guide)
+                    moves = self.tree.search(white, black, self.first_move, self.playouts, self.time_limit)
+        cell, self.last_value = best_move(moves)
+        return cell
+
+    # searches a position with every worker of the pool, and returns their (pid, moves) results
+    def search_in_pool(self, white, black):
+        if self.pool is None:
+            # forked workers would inherit the threads and the window of the game
+            context = multiprocessing.get_context("spawn")
+            self.barrier = context.Barrier(self.workers)
+            self.pool = ProcessPoolExecutor(self.workers, mp_context=context, initializer=init_worker,
+                                            initargs=(self.barrier,))
+        playouts = None if self.playouts is None else -(-self.playouts // self.workers)
+        if playouts is None and self.time_limit is None:
+            playouts = -(-DEFAULT_PLAYOUTS // self.workers)
+        futures = [self.pool.submit(search_in_worker, self.geometry, self.guide, white, black, self.first_move,
+                                    playouts, self.time_limit) for _ in range(self.workers)]
+        return [future.result() for future in futures]
+
+    def make_optimal_move(self, state):
+        new_state = np.copy(state)
+        new_state.flat[self.choose_move(state)] = 1 if self.first_move else 2
+        return new_state
+
+    # chooses the moves of an (N, cells) array of states one at a time, exploring as rl.Agent.select_moves
+    def select_moves(self, states):
+        rows, cols, _ = self.geometry
+        moves = np.array([self.choose_move(s.reshape(rows, cols)) for s in states], dtype=int)
+        explore = np.random.random(len(states)) >= self.exp_factor
+        for i in np.flatnonzero(explore):
+            moves[i] = np.random.choice(np.flatnonzero(states[i] == 0))
+        return moves
+
+    # the search does not learn anything, so there is nothing to save
+    def save_values(self):
+        pass
+
+    def close(self, wait=True):
+        if self.pool is not None:
+            self.pool.shutdown(wait=wait, cancel_futures=True)
+            self.pool = None
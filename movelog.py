@@ -0,0 +1,317 @@
+import argparse
+import os
+import threading
+
+import numpy as np
+
+import bitboard as bb
+import storage
+
+LOG_PATH = "datasets/moves.log"
+X_TEXT_PATH = "datasets/xvalues.txt"
+Y_TEXT_PATH = "datasets/yvalues.txt"
+COUNTS_PATH = "datasets/moves_counts.bin"
+
+'''
+    Append-only binary log of the moves of the human players, used to train the neural network.
+    The file starts with an 8 byte header (b'TTML' and the uint32 FORMAT_VERSION) followed by
+    fixed-size records of 8 bytes:
+
+    board   (uint16)    base-3 index of the grid before the move (see bitboard.encode_state)
+    cell    (uint8)     cell selected, 0 is the top-left cell and 8 the bottom-right cell
+    flags   (uint8)     reserved, 0
+    check   (uint32)    checksum of board and cell, to detect records that were not fully written
+
+    All the integers are little-endian.
+'''
+MAGIC = b"TTML"
+FORMAT_VERSION = 1
+HEADER = np.dtype([("magic", "S4"), ("version", "<u4")])
+RECORD = np.dtype([("board", "<u2"), ("cell", "u1"), ("flags", "u1"), ("check", "<u4")])
+CHECK_SEED = 0x5BD1E995
+
+'''
+    Compacted form of the log, written by compact: one record per distinct board with the number of
+    times each cell was selected in it, so its size depends on the number of distinct boards and not
+    on the length of the log. The file has the header of storage.py (b'TTMC', with FLAG_SYMMETRIC in
+    the flags if the symmetric boards have been folded into their canonical board, see
+    bitboard.CANONICAL_STATE), followed by
+
+    cursor  (uint64)    number of records of the log that have been compacted
+    moves   (uint64)    number of moves counted, the sum of all the counts
+    records (count)     board (uint16) and counts (9 uint32)
+'''
+COUNTS_MAGIC = b"TTMC"
+FLAG_SYMMETRIC = 1
+COUNTS_HEADER = np.dtype([("cursor", "<u8"), ("moves", "<u8")])
+COUNTS_RECORD = np.dtype([("board", "<u2"), ("counts", "<u4", (9,))])
+
+
+# returns the checksums of arrays of boards and cells, the checksum of an all-zero record is never 0
+def checksum(boards, cells):
+    boards = np.atleast_1d(boards).astype(np.uint32)
+    cells = np.atleast_1d(cells).astype(np.uint32)
+    return (boards * np.uint32(0x9E3779B1)) ^ (cells * np.uint32(0x85EBCA6B)) ^ np.uint32(CHECK_SEED)
+
+
+def make_records(boards, cells):
+    records = np.zeros(len(boards), dtype=RECORD)
+    records["board"] = boards
+    records["cell"] = cells
+    records["check"] = checksum(boards, cells)
+    return records
+
+
+# returns the number of records of the log, including the ones with a wrong checksum
+def count_records(path=LOG_PATH):
+    if not os.path.isfile(path):
+        return 0
+    return max(0, (os.path.getsize(path) - HEADER.itemsize) // RECORD.itemsize)
+
+
+# creates the log if it does not exist, and truncates the partial record left by an interrupted write
+def repair(path=LOG_PATH):
+    if not os.path.isfile(path) or os.path.getsize(path) < HEADER.itemsize:
+        header = np.zeros(1, dtype=HEADER)
+        header["magic"] = MAGIC
+        header["version"] = FORMAT_VERSION
+        with open(path, "wb") as f:
+            f.write(header.tobytes())
+        return
+    header = np.fromfile(path, dtype=HEADER, count=1)[0]
+    if header["magic"] != MAGIC or header["version"] != FORMAT_VERSION:
+        raise ValueError(path + " is not a move log")
+    size = HEADER.itemsize + count_records(path) * RECORD.itemsize
+    if os.path.getsize(path) != size:
+        os.truncate(path, size)
+
+
+'''
+    Reads the records of the log from the record number start up to stop (by default, the end of the
+    log). Returns (x, y, end): the boards as an (N, 9) array and the cells as an (N,) array, in the
+    format used by nn.train_model, and the number of the record from which the next read can start.
+    Records with a wrong checksum are skipped. The file is memory-mapped, so only the records read
+    are loaded.
+'''
+def read_log(path=LOG_PATH, start=0, stop=None):
+    boards, cells, end = read_records(path, start, stop)
+    return bb.decode_states(boards), cells.astype(float), end
+
+
+# returns the base-3 boards and the cells of the valid records from start up to stop, and the next record to read
+def read_records(path=LOG_PATH, start=0, stop=None):
+    end = count_records(path)
+    if stop is not None:
+        end = min(end, stop)
+    if end <= start:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), max(start, end)
+    records = np.memmap(path, dtype=RECORD, mode="r", offset=HEADER.itemsize, shape=(end,))[start:]
+    valid = records["check"] == checksum(records["board"], records["cell"])
+    return records["board"][valid].astype(np.int64), records["cell"][valid].astype(np.int64), end
+
+
+# iterates over the log in chunks of chunk_size records, yielding the arrays (x, y) of every chunk
+def stream_log(path=LOG_PATH, chunk_size=65536):
+    start, end = 0, count_records(path)
+    while start < end:
+        x, y, start = read_log(path, start, start + chunk_size)
+        yield x, y
+
+
+# converts the text sample files of previous versions (xvalues.txt and yvalues.txt) into records of the log
+def migrate_text_logs(x_path=X_TEXT_PATH, y_path=Y_TEXT_PATH, path=LOG_PATH):
+    x = np.loadtxt(x_path, ndmin=2)
+    y = np.loadtxt(y_path, ndmin=1)
+    n = min(len(x), len(y))  # the files could have drifted out of sync
+    repair(path)
+    with open(path, "ab") as f:
+        f.write(make_records(bb.encode_states(x[:n]), y[:n].astype(int)).tobytes())
+    return n
+
+
+# creates the log from the text sample files the first time it is needed
+def ensure_log(path=LOG_PATH):
+    if not os.path.isfile(path) and os.path.isfile(X_TEXT_PATH) and os.path.isfile(Y_TEXT_PATH):
+        migrate_text_logs(path=path)
+
+
+'''
+    Logs moves in memory and appends them to the log in a background thread every flush_interval
+    seconds, or when flush is called. The log is repaired once, before the thread starts, and
+    flushed tells the number of records of the log that have been completely written, so the log
+    can be read while the thread appends to it.
+'''
+class MoveLogger:
+    def __init__(self, path=LOG_PATH, flush_interval=2.0):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.boards = []
+        self.cells = []
+        self.lock = threading.Lock()
+        self.closed = threading.Event()
+        repair(path)
+        self.flushed = count_records(path)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.closed.wait(self.flush_interval):
+            self.flush()
+
+    # logs the grid before the move and the cell selected
+    def log(self, grid, cell):
+        with self.lock:
+            self.boards.append(bb.encode_state(grid))
+            self.cells.append(int(cell))
+
+    # number of moves that have not been written yet
+    def pending(self):
+        with self.lock:
+            return len(self.boards)
+
+    def flush(self):
+        with self.lock:
+            if not self.boards:
+                return
+            records = make_records(np.array(self.boards), np.array(self.cells))
+            self.boards, self.cells = [], []
+            with open(self.path, "ab") as f:
+                f.write(records.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            self.flushed += len(records)
+
+    # number of records of the log that have been completely written
+    def flushed_records(self):
+        with self.lock:
+            return self.flushed
+
+    def close(self):
+        self.closed.set()
+        self.thread.join()
+        self.flush()
+
+
+# returns the header (cursor, moves), the flags and the records of a compacted log, memory-mapped
+def load_counts(counts_path=COUNTS_PATH):
+    header = storage.read_header(counts_path, COUNTS_MAGIC)
+    count = int(header["count"])
+    offset = storage.HEADER.itemsize + COUNTS_HEADER.itemsize
+    if os.path.getsize(counts_path) != offset + count * COUNTS_RECORD.itemsize:
+        raise storage.StorageError(counts_path + " does not have " + str(count) + " records")
+    info = np.fromfile(counts_path, dtype=COUNTS_HEADER, count=1, offset=storage.HEADER.itemsize)[0]
+    records = np.memmap(counts_path, dtype=COUNTS_RECORD, mode="r", offset=offset, shape=(count,))
+    return info, int(header["flags"]), records
+
+
+'''
+    Adds the records of the log that have not been compacted yet to the compacted log, and returns
+    the number of distinct boards. The counts are accumulated in a table of every possible board,
+    so the memory used does not depend on the length of the log either. The compacted log is built
+    again from the start if it does not match the log (the log is shorter than its cursor) or if it
+    was compacted with a different symmetric option.
+    symmetric:  Counts the moves of symmetric boards together, in their canonical board and cell.
+    stop:       Number of records of the log to compact, by default all of them. While a MoveLogger
+                appends to the log, its flushed_records, so a record being written is never read.
+'''
+def compact(path=LOG_PATH, counts_path=COUNTS_PATH, symmetric=False, chunk_size=65536, stop=None):
+    flags = FLAG_SYMMETRIC if symmetric else 0
+    totals = np.zeros((bb.NUM_STATES, 9), dtype=np.uint32)
+    cursor = 0
+    try:
+        info, old_flags, records = load_counts(counts_path)
+        if old_flags == flags and int(info["cursor"]) <= count_records(path):
+            cursor = int(info["cursor"])
+            totals[records["board"]] = records["counts"]
+        del records
+    except (OSError, storage.StorageError):
+        pass
+
+    start, end = cursor, count_records(path)
+    if stop is not None:
+        end = max(start, min(end, stop))
+    if start == end and cursor > 0:
+        return len(np.flatnonzero(totals.any(axis=1)))
+    permutations = np.array(bb.PERMUTATIONS)
+    while start < end:
+        boards, cells, start = read_records(path, start, min(start + chunk_size, end))
+        if symmetric:
+            cells = permutations[bb.CANONICAL_TRANSFORM[boards], cells]
+            boards = bb.CANONICAL_STATE[boards]
+        np.add.at(totals, (boards, cells), 1)
+
+    boards = np.flatnonzero(totals.any(axis=1))
+    records = np.zeros(len(boards), dtype=COUNTS_RECORD)
+    records["board"] = boards
+    records["counts"] = totals[boards]
+    info = np.zeros(1, dtype=COUNTS_HEADER)
+    info["cursor"] = end
+    info["moves"] = totals.sum(dtype=np.uint64)
+    header = np.zeros(1, dtype=storage.HEADER)
+    header["magic"] = COUNTS_MAGIC
+    header["version"] = storage.FORMAT_VERSION
+    header["count"] = len(records)
+    header["flags"] = flags
+    storage.atomic_write(counts_path, [header.tobytes(), info.tobytes(), records.tobytes()])
+    return len(records)
+
+
+'''
+    Returns the distinct symmetric versions of canonical boards: (states, y, w, source), source being
+    the number of the board of every version. The moves follow the symmetry of their board, and the
+    weight of a board is shared by its versions.
+'''
+def expand_symmetries(states, y, w):
+    permutations = np.array(bb.PERMUTATIONS)
+    # the cell c of the version t is the cell permutations[t][c] of the canonical board
+    versions = states[:, permutations]
+    indices = bb.encode_states(versions.reshape(-1, 9)).reshape(len(states), -1)
+    # the first of every group of equal versions is kept
+    keep = np.ones(indices.shape, dtype=bool)
+    for t in range(1, len(permutations)):
+        keep[:, t] = (indices[:, :t] != indices[:, t:t + 1]).all(axis=1)
+    source, t = np.nonzero(keep)
+    share = keep.sum(axis=1)
+    moves = np.take_along_axis(y[source], permutations[t], axis=1)
+    return versions[source, t], moves, w[source] / share[source], source
+
+
+'''
+    Iterates over a compacted log in chunks of chunk_size boards, yielding the arrays (x, y, w) of
+    every chunk: the boards as an (N, 9) array, the fraction of the moves of every board played in
+    each cell as an (N, 9) array, to be used as soft targets, and the weight of every board, its
+    number of moves relative to the mean number of moves of a board. The boards of a symmetric log
+    are expanded into their distinct symmetric versions, which share the weight of their board.
+'''
+def stream_counts(counts_path=COUNTS_PATH, chunk_size=4096):
+    info, flags, records = load_counts(counts_path)
+    if len(records) == 0:
+        return
+    mean = int(info["moves"]) / len(records)
+    for start in range(0, len(records), chunk_size):
+        chunk = records[start:start + chunk_size]
+        counts = chunk["counts"].astype(float)
+        moves = counts.sum(axis=1)
+        x, y, w = bb.decode_states(chunk["board"]), counts / moves[:, None], moves / mean
+        if flags & FLAG_SYMMETRIC:
+            x, y, w, _ = expand_symmetries(x, y, w)
+        yield x, y, w
+
+
+# returns the arrays (x, y, w) of stream_counts for the whole compacted log, with the weights scaled to a mean of 1
+def read_counts(counts_path=COUNTS_PATH):
+    chunks = list(stream_counts(counts_path))
+    if not chunks:
+        return np.zeros((0, 9)), np.zeros((0, 9)), np.zeros(0)
+    x, y, w = (np.concatenate(arrays) for arrays in zip(*chunks))
+    return x, y, w / w.mean()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compacts the move log into the counts of every distinct board.")
+    parser.add_argument("--symmetric", action="store_true", help="fold the symmetric boards together")
+    args = parser.parse_args()
+
+    ensure_log()
+    boards = compact(symmetric=args.symmetric)
+    print(count_records(), "moves compacted into", boards, "distinct boards, saved to", COUNTS_PATH)
@@ -1,11 +1,40 @@
-import matplotlib.pyplot as plt
+import io
+import os
+
 import numpy as np
-from keras.layers import Dense
-from keras.models import Sequential
-from keras.utils import to_categorical
+
+import dense
+import movelog
+import stats
+import storage
+
+'''
+    The network is trained with the moves of the human players, read from the move log (see
+    movelog.py) after compacting it into the counts of the moves played in every distinct board.
+    Every board is a single sample, whose target is the distribution of the moves played in it and
+    whose weight is the number of moves played in it, so an epoch costs the same however many times
+    the players have repeated a board. With FOLD_SYMMETRIES, the moves of the symmetric versions of
+    a board are counted together.
+
+    The network is kept warm across restarts: it is saved to MODEL_PATH after every training, and
+    TRAINING_STATE_PATH keeps the number of records of the log that it has been trained on.
+
+    The weights are also exported to PLAY_MODEL_PATH for the numpy forward pass of dense.py, which
+    is what plays the moves. keras is only imported to train the network, so playing does not need it.
+'''
+MODEL_PATH = "datasets/model_nn.h5"
+PLAY_MODEL_PATH = dense.npz_path(MODEL_PATH)
+TRAINING_STATE_PATH = "datasets/model_nn_state.npz"
+FOLD_SYMMETRIES = False
+
+# upper bounds of the buckets of the histogram of the ranks of the moves played among the predictions
+RANK_BOUNDS = tuple(range(1, 10))
 
 
 def create_model():
+    from keras.layers import Dense
+    from keras.models import Sequential
+
     model = Sequential()
     model.add(Dense(18, input_shape=(9,), activation="relu"))
     model.add(Dense(18, activation="relu"))
@@ -17,39 +46,134 @@ def create_model():
     return model
 
 
-def train_model(model, epochs):
-    x_train = np.loadtxt("datasets/xvalues.txt")
-    y_train = to_categorical(np.loadtxt("datasets/yvalues.txt"))
+# fits the model to the samples, recording the time of the training
+def fit_model(model, x, y, epochs, sample_weight=None):
+    stats.count("nn.fit_calls")
+    with stats.timer("nn.fit"):
+        return model.fit(x, y, epochs=epochs, verbose=0, shuffle=True, sample_weight=sample_weight)
+
+
+'''
+    Compacts the new records of the move log, and returns the samples (x, y, w) of every distinct board
+    and the number of records of the log they come from. The log is not repaired here, the MoveLogger
+    repairs it before it starts appending to it.
+    stop:   Number of records of the log to read, the flushed_records of the MoveLogger of the game.
+'''
+def read_samples(stop=None):
+    movelog.ensure_log()
+    movelog.compact(symmetric=FOLD_SYMMETRIES, stop=stop)
+    cursor = int(movelog.load_counts()[0]["cursor"])
+    return movelog.read_counts() + (cursor,)
 
-    model_history = model.fit(x_train, y_train, epochs=epochs, verbose=0, shuffle=True)
+
+def train_model(model, epochs, stop=None):
+    x_train, y_train, w_train, _ = read_samples(stop)
+    model_history = fit_model(model, x_train, y_train, epochs, w_train)
 
     return model, model_history
 
 
+def empty_training_state():
+    return {"cursor": 0}
+
+
+def load_training_state():
+    if not os.path.isfile(TRAINING_STATE_PATH):
+        return empty_training_state()
+    with np.load(TRAINING_STATE_PATH) as data:
+        if "cursor" not in data:
+            # state of the text sample files of previous versions
+            return empty_training_state()
+        return {"cursor": int(data["cursor"])}
+
+
+@stats.timed("nn.save_training_state")
+def save_training_state(model, state):
+    # the model is written to a temporary file first, so a crash never leaves a broken model
+    model.save(MODEL_PATH + ".tmp.h5")
+    os.replace(MODEL_PATH + ".tmp.h5", MODEL_PATH)
+    data = io.BytesIO()
+    np.savez(data, **state)
+    storage.atomic_write(TRAINING_STATE_PATH, [data.getvalue()])
+    dense.save(dense.from_keras(model), PLAY_MODEL_PATH)
+
+
+# returns the model trained in a previous run and True, or a new model and False if there is none
+@stats.timed("nn.load_warm_model")
+def load_warm_model():
+    if os.path.isfile(MODEL_PATH) and os.path.isfile(TRAINING_STATE_PATH):
+        from keras.models import load_model
+        return load_model(MODEL_PATH), True
+    return create_model(), False
+
+
+# returns the network that plays the moves: the exported weights if there are any, without importing keras
+def load_play_model():
+    if os.path.isfile(PLAY_MODEL_PATH):
+        return dense.load(PLAY_MODEL_PATH)
+    return dense.from_keras(load_warm_model()[0])
+
+
+'''
+    Fine-tunes the model when moves have been logged since its last training. The model is fitted
+    to every distinct board, so the cost depends on the number of distinct boards and not on the
+    length of the log. Returns the model and the training history, which is None if there were no
+    new moves. stop is the number of records of the log to read, as in read_samples.
+'''
+def train_incremental(model, epochs, stop=None):
+    state = load_training_state()
+    x_train, y_train, w_train, cursor = read_samples(stop)
+    if cursor == state["cursor"] or len(x_train) == 0:
+        return model, None
+
+    model_history = fit_model(model, x_train, y_train, epochs, w_train)
+    state["cursor"] = cursor
+    save_training_state(model, state)
+    return model, model_history
+
+
+# trains a new model from scratch with every distinct board, and resets the incremental training to it
+def full_retrain(epochs, stop=None):
+    x, y, w, cursor = read_samples(stop)
+    state = {"cursor": cursor}
+    model = create_model()
+    model_history = fit_model(model, x, y, epochs, w)
+
+    save_training_state(model, state)
+    return model, model_history
+
+
+# model is either a keras model or a dense.DenseNetwork
 def make_prediction(model, x):
-    return model.predict(x)
+    stats.count("nn.predict_calls")
+    with stats.timer("nn.predict"):
+        return model.predict(x)
+
+
+'''
+    Returns the cell of the most probable empty cell of a 3x3 grid, or of the int8 view of a board.Board.
+    The rank of the cell among the predictions of the network is recorded in the histogram
+    nn.prediction_rank, 1 when the network predicted a legal move.
+'''
+@stats.timed("nn.make_move")
+def choose_move(model, grid):
+    cells = grid.reshape(9)
+    prediction = np.argsort(-make_prediction(model, cells.reshape(1, 9))[0])
+    for rank, cell in enumerate(prediction.tolist()):
+        if cells[cell] == 0:
+            stats.observe("nn.prediction_rank", rank + 1, RANK_BOUNDS)
+            return cell
 
 
 def make_move(model, grid, white_turn):
-    raw_prediction = make_prediction(model, grid.reshape(1, 9))
-    prediction = np.argsort(-raw_prediction)
-    aux = 0
     new_grid = np.copy(grid)
-    for i in prediction[0]:
-        aux = aux + 1
-        row = i // 3
-        column = i % 3
-        if new_grid[int(row)][int(column)] == 0:
-            if white_turn:
-                new_grid[int(row)][int(column)] = 1
-            else:
-                new_grid[int(row)][int(column)] = 2
-            break
-    print("Prediction number", aux, "selected.")
+    new_grid.flat[choose_move(model, grid)] = 1 if white_turn else 2
     return new_grid
 
 
 def plot_training(model_history):
+    import matplotlib.pyplot as plt  # only needed for the plots, which are rarely shown
+
     # summarize history for accuracy
     plt.plot(model_history.history['acc'])
     plt.title('model accuracy')
@@ -65,3 +189,9 @@ def plot_training(model_history):
     plt.xlabel('epoch')
     plt.legend(['train', 'test'], loc='upper left')
     plt.show()
+
+
+if __name__ == '__main__':
+    # python nn.py retrains the network from scratch with every logged sample
+    full_retrain(200)
+    print("Network retrained with every sample.")
@@ -0,0 +1,201 @@
+import argparse
+import time
+
+import numpy as np
+
+import bitboard as bb
+import storage
+from bitboard import NUM_STATES, STATE_WEIGHTS
+
+
+'''
+    Perfect play of the classic 3x3 game. Every position is solved once, offline:
+
+    python perfect.py
+
+    and the solution is kept in datasets/perfect_play.bin, a table of fixed-size records indexed by
+    the side to move (0 white, 1 black) and the base-3 index of the state (see bitboard.py):
+
+    value       (int8)      +1 if white wins with perfect play, -1 if black wins, 0 if it is a draw
+    distance    (uint8)     plies until the end of the game, the winner winning as fast as possible
+                            and the loser losing as slowly as possible
+    best        (int8)      cell of the move of make_move_minimax, -1 if the game has ended
+    moves       (uint16)    mask of the cells whose moves keep the value of the position
+
+    The table is memory-mapped read-only, so its pages are shared by every process that uses it, and
+    it is solved and saved again when the file is missing or invalid. Every state is solved for both
+    sides to move, even the unreachable ones, so any grid has an answer.
+
+    The lookup functions also serve as an oracle for the training and the evaluation of the agents:
+    values gives the result of positions with perfect play, is_optimal tells whether moves keep it,
+    and optimal_move_rate measures the fraction of the legal positions in which an agent plays
+    a move that keeps it.
+'''
+TABLE_PATH = "datasets/perfect_play.bin"
+MAGIC = b"TTPP"
+RECORD = np.dtype([("value", "i1"), ("distance", "u1"), ("best", "i1"), ("moves", "<u2")])
+
+# value of each result code (see bitboard.py)
+RESULT_VALUES = np.array([0, 1, -1, 0], dtype=np.int8)
+
+# cells in the order in which the minimax search tries them, so the best moves of both match
+CENTER_ORDER = np.array(bb.geometry(3, 3, 3).center_order)
+
+_table = None
+
+
+'''
+    Solves every state for both sides to move, and returns the (2, NUM_STATES) array of records.
+    The states are solved by number of empty cells, from the full boards up, so the states after
+    every move are always solved before the states they come from.
+'''
+def solve():
+    table = np.zeros((2, NUM_STATES), dtype=RECORD)
+    states = bb.decode_states(np.arange(NUM_STATES))
+    empty = states == 0
+    num_empty = empty.sum(axis=1)
+    results = bb.check_victory_batch(states)
+    ended = results != bb.NONE
+
+    table["value"] = RESULT_VALUES[results]
+    table["best"] = -1
+    for e in range(1, bb.NUM_CELLS + 1):
+        layer = np.flatnonzero((num_empty == e) & ~ended)
+        free = empty[layer]
+        for side in (0, 1):
+            sign = 1 if side == 0 else -1
+            # children[i, c] is the state after the move in the cell c of the state layer[i]
+            children = layer[:, None] + (side + 1) * STATE_WEIGHTS[None, :]
+            children[~free] = 0
+            child = table[1 - side][children]
+            outcome = sign * child["value"].astype(int)
+            distance = child["distance"].astype(int)
+            # faster wins and slower losses are preferred, as in the scores of ai.Search
+            preference = np.where(outcome > 0, 100 - distance, np.where(outcome < 0, distance - 100, 0))
+            preference[~free] = -1000
+            ordered = preference[:, CENTER_ORDER]
+            best = CENTER_ORDER[ordered.argmax(axis=1)]
+            rows = np.arange(len(layer))
+            value = outcome[rows, best]
+
+            records = table[side]
+            records["value"][layer] = sign * value
+            records["distance"][layer] = distance[rows, best] + 1
+            records["best"][layer] = best
+            records["moves"][layer] = ((outcome == value[:, None]) & free) @ (1 << np.arange(bb.NUM_CELLS))
+    return table
+
+
+def save(table, path=TABLE_PATH):
+    storage.save_records(path, table.reshape(-1), MAGIC)
+
+
+def load(path=TABLE_PATH):
+    records = storage.load_records(path, RECORD, MAGIC)
+    if len(records) != 2 * NUM_STATES:
+        raise storage.StorageError(path + " has " + str(len(records)) + " records instead of " + str(2 * NUM_STATES))
+    return records.reshape(2, NUM_STATES)
+
+
+# returns the table, loaded the first time it is needed, or solved and saved if the file can not be loaded
+def get_table():
+    global _table
+    if _table is None:
+        try:
+            _table = load()
+        except (OSError, storage.StorageError):
+            _table = solve()
+            try:
+                save(_table)
+            except OSError:
+                pass  # the table is still usable, it will be solved again by the next process
+    return _table
+
+
+# returns 0 where white is to move and 1 where black is, from the number of pieces of (N, 9) states
+def sides_to_move(states):
+    return ((states == 1).sum(axis=1) > (states == 2).sum(axis=1)).astype(int)
+
+
+'''
+    Returns the records of an array of states of shape (N, 9) or (N, 3, 3).
+    white_turn: Side to move, a bool or an (N,) array. By default it follows from the number of pieces.
+'''
+def lookup(states, white_turn=None):
+    states = np.asarray(states).reshape(-1, bb.NUM_CELLS)
+    if white_turn is None:
+        sides = sides_to_move(states)
+    else:
+        sides = np.where(white_turn, 0, 1)
+    return get_table()[sides, bb.encode_states(states)]
+
+
+# returns the values of states with perfect play: +1 if white wins, -1 if black wins, 0 for a draw
+def values(states, white_turn=None):
+    return lookup(states, white_turn)["value"].astype(int)
+
+
+# returns the cells of the moves that keep the value of a 3x3 state, none if the game has ended
+def optimal_moves(state, white_turn=None):
+    moves = int(lookup(state, white_turn)["moves"][0])
+    return [c for c in range(bb.NUM_CELLS) if moves >> c & 1]
+
+
+# tells whether the move in cells[i] keeps the value of states[i], for arrays of states and cells
+def is_optimal(states, cells, white_turn=None):
+    moves = lookup(states, white_turn)["moves"].astype(int)
+    return (moves >> np.asarray(cells)) & 1 == 1
+
+
+# returns the best move of the 3x3 state with the given base-3 index as [row, col, score], as ai.minimax would
+def best_move(index, white_turn):
+    record = get_table()[0 if white_turn else 1, index]
+    return [int(record["best"]) // 3, int(record["best"]) % 3, int(record["value"])]
+
+
+# returns the base-3 indices of the positions that can be reached by legal play from the empty board
+def legal_states():
+    layer = np.array([0])
+    reached = [layer]
+    for ply in range(bb.NUM_CELLS):
+        states = bb.decode_states(layer)
+        layer = layer[bb.check_victory_batch(states) == bb.NONE]
+        free = bb.decode_states(layer) == 0
+        children = layer[:, None] + (ply % 2 + 1) * STATE_WEIGHTS[None, :]
+        layer = np.unique(children[free])
+        reached.append(layer)
+    return np.concatenate(reached)
+
+
+'''
+    Returns the fraction of the legal positions in which the agent, without exploring, plays a move
+    that keeps the value of the position. Only the positions in which the agent is to move, the game
+    has not ended and there is more than one move are counted.
+'''
+def optimal_move_rate(agent, batch_size=256):
+    states = bb.decode_states(legal_states())
+    free = (states == 0).sum(axis=1)
+    states = states[(bb.check_victory_batch(states) == bb.NONE) & (free > 1) &
+                    (sides_to_move(states) == (0 if agent.first_move else 1))]
+    exp_factor = agent.exp_factor
+    agent.exp_factor = 1
+    try:
+        cells = np.concatenate([agent.select_moves(states[i:i + batch_size])
+                                for i in range(0, len(states), batch_size)])
+    finally:
+        agent.exp_factor = exp_factor
+    return float(is_optimal(states, cells).mean())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Solves every 3x3 position and saves the perfect-play table.")
+    parser.add_argument("--output", default=TABLE_PATH, help="file of the table")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    solution = solve()
+    save(solution, args.output)
+    legal = legal_states()
+    print("solved %d states in %.2f s, %d legal positions, saved to %s" % (
+        2 * NUM_STATES, time.perf_counter() - start, len(legal), args.output))
+    print("value of the empty board:", int(solution[0, 0]["value"]))
@@ -1,11 +1,26 @@
 import csv
 import os
 import random
+from collections import OrderedDict
 from pathlib import Path
 
 import numpy as np
-from keras.layers import Dense
-from keras.models import Sequential, load_model
+
+import bitboard as bb
+import dense
+import stats
+import storage
+from bitboard import CANONICAL_STATES, CLASS_ID, NUM_CLASSES, NUM_STATES, decode_state, encode_state, encode_states
+
+
+# converts a state key of the csv files, such as '[010002000]', into its index
+def key_to_index(key):
+    return int(key.strip("[]"), 3)
+
+
+# converts an index into the state key of the csv files
+def index_to_key(index):
+    return "[" + np.base_repr(index, 3).zfill(9) + "]"
 
 
 class Agent:
@@ -16,13 +31,35 @@ class Agent:
         self.state = None
         self.first_move = first_move
         self.exp_factor = exploration_factor
+        # sum of the absolute changes of the values learned, and number of updates, since the last reset
+        self.value_change = 0.0
+        self.value_updates = 0
+        # values of the moves chosen by the last call to select_moves
+        self.last_values = None
 
     def calc_value(self, state):
         pass
 
+    # returns the values of an array of states of shape (N, 9), NaN for the states without a value
+    def calc_value_batch(self, states):
+        values = [self.calc_value(x) for x in states]
+        return np.array([np.nan if x is None else float(x) for x in values])
+
+    # returns the values of an array of base-3 state indices (see bitboard.encode_state), NaN where there is none
+    def calc_value_indices(self, indices):
+        return self.calc_value_batch(bb.decode_states(indices))
+
     def learn_state(self, state, winner):
         pass
 
+    # returns the mean absolute change of the learned values since the last call, None if nothing was learned
+    def mean_value_change(self):
+        mean = self.value_change / self.value_updates if self.value_updates else None
+        self.value_change = 0.0
+        self.value_updates = 0
+        return mean
+
+    @stats.timed("rl.make_move")
     def make_move(self, state, winner):
         self.state = state
 
@@ -36,13 +73,8 @@ class Agent:
             new_state = self.make_optimal_move(state)
         else:
             # exploration
-            moves = [s for s, v in np.ndenumerate(state) if v == 0]
-            r = random.choice(moves)
             new_state = np.copy(state)
-            if self.first_move:
-                new_state[r] = 1
-            else:
-                new_state[r] = 2
+            new_state.flat[random.choice(np.flatnonzero(state == 0))] = 1 if self.first_move else 2
 
         return new_state
 
@@ -51,61 +83,126 @@ class Agent:
 
         return self.make_move(state, winner)
 
+    # learns from the position of a board.Board and returns the cell of the move of the agent in it
+    def choose_move_and_learn(self, board):
+        self.learn_board(board)
+        return self.board_move(board)
+
+    # learns from the position of a board.Board, by default through learn_state with a copy of its grid
+    def learn_board(self, board):
+        self.learn_state(board.to_grid(), board.victory)
+
+    '''
+        Chooses the move of the agent in the position of a board.Board, with the same lookahead and the
+        same exploration as make_move, but without building any grid: the states after every pair
+        (move, reply) are the base-3 index of the board plus the weights of both cells, evaluated in
+        one call to calc_value_indices.
+    '''
+    @stats.timed("rl.make_move")
+    def board_move(self, board):
+        # the empty cells in the order of the grid, so the random choices are those of make_move
+        moves = np.sort(board.empty)
+        if random.uniform(0, 1) >= self.exp_factor:
+            # exploration
+            return int(random.choice(moves))
+        k = len(moves)
+        if k == 1:
+            return int(moves[0])
+
+        me, op = (1, 2) if self.first_move else (2, 1)
+        weights = np.array(board.weights)[moves]
+        # successors[i, j] is the index of the state after the move i of the agent and the reply j of the opponent
+        successors = board.index + me * weights[:, None] + op * weights[None, :]
+        valid = ~np.eye(k, dtype=bool)
+
+        v = np.full((k, k), np.nan)
+        v[valid] = self.calc_value_indices(successors[valid])
+
+        unknown = np.isnan(v)
+        # the worst reply for the agent, 1 if no reply has a value
+        v_min = np.where(unknown, np.inf, v).min(axis=1)
+        v_min[unknown.all(axis=1)] = 1
+
+        best = np.flatnonzero(v_min == v_min.max())
+        return int(moves[random.choice(best)])
+
+    '''
+        Chooses the move that maximizes the value of the worst reply of the opponent. The states after
+        every pair (move, reply) are built in a single (k, k, 9) array and evaluated in one call to
+        calc_value_batch. Moves whose replies all lack a value are given a value of 1 to encourage
+        exploration, and ties are broken randomly.
+    '''
     def make_optimal_move(self, state):
-        moves = [s for s, v in np.ndenumerate(state) if v == 0]
+        me, op = (1, 2) if self.first_move else (2, 1)
+        moves = np.flatnonzero(state.reshape(9) == 0)
+        k = len(moves)
+        new_state = np.copy(state)
 
-        if len(moves) == 1:
+        if k == 1:
             # there is only one move possible
-            new_state = np.copy(state)
-            if self.first_move:
-                new_state[moves[0]] = 1
-            else:
-                new_state[moves[0]] = 2
+            new_state.flat[moves[0]] = me
             return new_state
 
-        temp_state_list = []
-        v = -float('Inf')
+        # successors[i, j] is the state after the move i of the agent and the reply j of the opponent
+        rows, cols = np.arange(k)[:, None], np.arange(k)[None, :]
+        successors = np.broadcast_to(state.reshape(9), (k, k, 9)).copy()
+        successors[rows, cols, moves[:, None]] = me
+        successors[rows, cols, moves[None, :]] = op
+        # the opponent can not reply in the cell that has just been taken
+        valid = rows != cols
 
-        for x in moves:
-            v_temp = []
-            temp_state = np.copy(state)
-            if self.first_move:
-                temp_state[x] = 1
-            else:
-                temp_state[x] = 2
-
-            moves_op = [s for s, v in np.ndenumerate(state) if v == 0]
-            for y in moves_op:
-                temp_state_op = np.copy(temp_state)
-                if not self.first_move:
-                    temp_state_op[y] = 1
-                else:
-                    temp_state_op[y] = 2
-                v_temp.append(self.calc_value(temp_state_op))
-
-            # deletes Nones
-            v_temp = list(filter(None.__ne__, v_temp))
-
-            if len(v_temp) != 0:
-                v_temp = np.min(v_temp)
-            else:
-                # encourage exploration
-                v_temp = 1
-
-            if v_temp > v:
-                temp_state_list = [temp_state]
-                v = v_temp
-            elif v_temp == v:
-                temp_state_list.append(temp_state)
+        v = np.full((k, k), np.nan)
+        v[valid] = self.calc_value_batch(successors[valid])
 
-        try:
-            new_state = random.choice(temp_state_list)
-        except ValueError:
-            print('temp state:', temp_state_list)
-            raise Exception('temp state empty')
+        unknown = np.isnan(v)
+        # the worst reply for the agent, 1 if no reply has a value
+        v_min = np.where(unknown, np.inf, v).min(axis=1)
+        v_min[unknown.all(axis=1)] = 1
 
+        best = np.flatnonzero(v_min == v_min.max())
+        new_state.flat[moves[random.choice(best)]] = me
         return new_state
 
+    '''
+        Chooses a move for every state of an (N, 9) array at once, with the same lookahead and the same
+        exploration as make_move. Returns the (N,) array of the cells chosen, and keeps the values that
+        the lookahead gave them in last_values. The states after every (move, reply) pair of every game
+        are evaluated in a single call to calc_value_batch.
+    '''
+    def select_moves(self, states):
+        me, op = (1, 2) if self.first_move else (2, 1)
+        n = len(states)
+        empty = states == 0
+        cells = np.arange(9)
+
+        # successors[g, i, j] is the state of the game g after the move i of the agent and the reply j
+        successors = np.broadcast_to(states[:, None, None, :], (n, 9, 9, 9)).copy()
+        successors[:, cells[:, None], cells[None, :], cells[:, None]] = me
+        successors[:, cells[:, None], cells[None, :], cells[None, :]] = op
+        valid = empty[:, :, None] & empty[:, None, :] & (cells[:, None] != cells[None, :])
+
+        v = np.full((n, 9, 9), np.nan)
+        v[valid] = self.calc_value_batch(successors[valid])
+
+        unknown = np.isnan(v)
+        # the worst reply for the agent, 1 if no reply has a value
+        v_min = np.where(unknown, np.inf, v).min(axis=2)
+        known = np.where(unknown.all(axis=2), np.nan, v_min)
+        v_min[unknown.all(axis=2)] = 1
+        v_min[~empty] = -np.inf
+
+        # ties are broken randomly, by choosing the tied move with the highest random number
+        noise = np.random.random((n, 9))
+        ties = v_min == v_min.max(axis=1, keepdims=True)
+        moves = np.where(ties, noise, -1).argmax(axis=1)
+
+        # exploration
+        explore = np.random.random(n) >= self.exp_factor
+        moves[explore] = np.where(empty, noise, -1)[explore].argmax(axis=1)
+        # the value of the worst reply to every move chosen, NaN if none of its replies has a value
+        self.last_values = known[np.arange(n), moves]
+        return moves
+
     def reward(self, winner):
         if winner == "white":
             if self.first_move:
@@ -123,78 +220,338 @@ class Agent:
             r = 0.5
         return r
 
-
+    # returns the rewards of an array of result codes (see bitboard.py)
+    def reward_batch(self, winners):
+        return np.array([self.reward(w) for w in bb.VICTORY_NAMES])[winners]
+
+    '''
+        Learns from N transitions at once. prev_states and states are (N, 9) arrays, and winners the
+        result codes of states (see bitboard.py). By default every transition goes through learn_state.
+    '''
+    def learn_batch(self, prev_states, states, winners):
+        for prev_state, state, winner in zip(prev_states, states, winners):
+            self.prev_state = prev_state.reshape(3, 3)
+            self.learn_state(state.reshape(3, 3), bb.VICTORY_NAMES[winner])
+
+
+# returns the round of every transition of a batch, given the classes of its previous and next states
+# and whether its next state is read. The rounds are learned one after the other, every round reading
+# its values before writing them, so a transition goes after the transitions before it that write its
+# class or the class it reads, and not before the ones that read its class.
+def batch_rounds(prev_indices, next_indices, reads):
+    if not np.isin(next_indices[reads], prev_indices).any():
+        # no transition reads a class written by the batch, the k-th transition of every class is
+        # learned in the round k
+        order = np.argsort(prev_indices, kind="stable")
+        sorted_indices = prev_indices[order]
+        first = np.flatnonzero(np.r_[True, sorted_indices[1:] != sorted_indices[:-1]])
+        rank = np.empty(len(order), dtype=int)
+        rank[order] = np.arange(len(order)) - np.repeat(first, np.diff(np.r_[first, len(order)]))
+        return rank
+    last_write, last_read = {}, {}
+    rounds = []
+    for p, n, read in zip(prev_indices.tolist(), next_indices.tolist(), reads.tolist()):
+        r = max(last_write.get(p, -1) + 1, last_read.get(p, 0))
+        if read:
+            r = max(r, last_write.get(n, -1) + 1)
+            last_read[n] = max(last_read.get(n, 0), r)
+        last_write[p] = r
+        rounds.append(r)
+    return np.array(rounds, dtype=int)
+
+
+'''
+    The 8 rotations and reflections of a state have the same value, so the QAgent keeps a single
+    value for each of them: its values are stored in an array indexed by the symmetry class of the
+    state (see bitboard.CLASS_ID), and visited tells which classes have a learned value. The values
+    of the classes that have not been visited are always 0. Every lookup and update goes through
+    the class of the state, so whatever is learned for a state is known for its symmetric versions.
+
+    The values are saved in <directory>/qvalues_<color>.bin (see storage.py), datasets by default. The csv files and the
+    tables indexed by state of previous versions are imported when loading, merging the values of
+    the symmetric versions of every state.
+'''
 class QAgent(Agent):
-    def __init__(self, first_move, exploration_factor=1):
+    def __init__(self, first_move, exploration_factor=1, directory="datasets"):
         super().__init__(first_move, exploration_factor)
-        self.values = dict()
+        self.directory = directory
+        self.values = np.zeros(NUM_CLASSES)
+        self.visited = np.zeros(NUM_CLASSES, dtype=bool)
+        self.dirty = np.zeros(NUM_CLASSES, dtype=bool)  # classes changed since the last save
         self.load_values()
 
+    # the previous state is kept as its base-3 index, so the positions of a board.Board are learned without a grid
+    @property
+    def prev_state(self):
+        return decode_state(self.prev_index)
+
+    @prev_state.setter
+    def prev_state(self, state):
+        self.prev_index = encode_state(state)
+
     def learn_state(self, state, winner):
-        prev_state_str = np.array2string(self.prev_state.reshape(9).astype(int), separator='')
-        state_str = np.array2string(state.reshape(9).astype(int), separator='')
-        aux = '1' if self.first_move else '2'
-        if aux in state_str:
-            if prev_state_str in self.values.keys():
-                v_s = self.values[prev_state_str]
-            else:
-                v_s = int(0)
+        aux = 1 if self.first_move else 2
+        self.learn_index(encode_state(state), aux in state, winner)
+
+    def learn_board(self, board):
+        self.learn_index(board.index, (board.white if self.first_move else board.black) != 0, board.victory)
+
+    # learns the transition from the previous state to the state with the given index, if the agent has moved
+    def learn_index(self, index, moved, winner):
+        if moved:
+            prev_index = CLASS_ID[self.prev_index]
+            v_s = self.values[prev_index]
 
             r = self.reward(winner)
 
-            if state_str in self.values.keys() and winner is None:
-                v_s_tag = self.values[state_str]
+            if winner is None:
+                v_s_tag = self.values[CLASS_ID[index]]
             else:
-                v_s_tag = int(0)
-
-            self.values[prev_state_str] = v_s + self.alpha*(r + v_s_tag - v_s)
+                v_s_tag = 0
 
-        self.prev_state = state
+            self.values[prev_index] = v_s + self.alpha*(r + v_s_tag - v_s)
+            self.visited[prev_index] = True
+            self.dirty[prev_index] = True
+            self.value_change += abs(self.alpha*(r + v_s_tag - v_s))
+            self.value_updates += 1
+
+        self.prev_index = index
+
+    '''
+        The transitions are learned in rounds, every round at once (see batch_rounds): a transition
+        comes after the ones before it in the batch that update its class or the class of its next
+        state, so the values are those of consecutive calls to learn_state, even when the next
+        state of a transition is the previous state of another one.
+    '''
+    def learn_batch(self, prev_states, states, winners):
+        prev_indices = CLASS_ID[encode_states(prev_states)]
+        next_indices = CLASS_ID[encode_states(states)]
+        ongoing = winners == bb.NONE
+        rewards = self.reward_batch(winners)
+        rounds = batch_rounds(prev_indices, next_indices, ongoing)
+
+        # the transitions sorted by round, bounds[r]:bounds[r + 1] being the ones of the round r
+        by_round = np.argsort(rounds, kind="stable")
+        bounds = np.r_[0, np.cumsum(np.bincount(rounds))]
+        # a plain view of the table, indexing a memory map is much slower
+        values = np.asarray(self.values)
+        next_weights = ongoing.astype(float)
+        deltas = np.zeros(len(prev_indices))
+        for r in range(len(bounds) - 1):
+            batch = by_round[bounds[r]:bounds[r + 1]]
+            indices = prev_indices[batch]
+            v_s = values[indices]
+            delta = self.alpha * (rewards[batch] + next_weights[batch] * values[next_indices[batch]] - v_s)
+            values[indices] = v_s + delta
+            deltas[batch] = delta
+        self.value_change += float(np.abs(deltas).sum())
+        self.visited[prev_indices] = True
+        self.dirty[prev_indices] = True
+        self.value_updates += len(prev_indices)
 
     def calc_value(self, state):
-        state_str = np.array2string(state.reshape(9).astype(int), separator='')
-        if state_str in self.values.keys():
-            return self.values[state_str]
-
-    def load_values(self):
+        index = CLASS_ID[encode_state(state)]
+        stats.count("rl.qagent.lookups")
+        if self.visited[index]:
+            return float(self.values[index])
+        stats.count("rl.qagent.misses")
+
+    def calc_value_batch(self, states):
+        return self.calc_value_indices(encode_states(states))
+
+    def calc_value_indices(self, indices):
+        indices = CLASS_ID[indices]
+        visited = self.visited[indices]
+        if stats.enabled:
+            stats.count("rl.qagent.lookups", len(indices))
+            stats.count("rl.qagent.misses", len(indices) - int(visited.sum()))
+        return np.where(visited, self.values[indices], np.nan)
+
+    def values_path(self, extension):
         aux = 'white' if self.first_move else 'black'
-        s = 'datasets/qvalues_' + aux + '.csv'
+        return os.path.join(self.directory, 'qvalues_' + aux + extension)
+
+    # loads the values of the files of the agent, or of the given files
+    @stats.timed("rl.qagent.load_values")
+    def load_values(self, bin_path=None, csv_path=None):
+        s = bin_path if bin_path is not None else self.values_path('.bin')
+        csv_path = csv_path if csv_path is not None else self.values_path('.csv')
+        self.values = np.zeros(NUM_CLASSES)
+        self.visited = np.zeros(NUM_CLASSES, dtype=bool)
         try:
-            value_csv = csv.reader(open(s, 'r'))
-            for row in value_csv:
-                k, v = row
-                self.values[k] = float(v)
-        except:
-            pass
+            if os.path.isfile(s) and storage.read_header(s)["flags"] & storage.FLAG_CANONICAL:
+                values, visited = storage.load_table(s)
+                if len(values) != NUM_CLASSES:
+                    raise storage.StorageError(s + " has " + str(len(values)) + " classes instead of " +
+                                               str(NUM_CLASSES))
+                self.values, self.visited = values, visited
+            elif os.path.isfile(s):
+                # table indexed by state of a previous version
+                values, visited = storage.load_table(s)
+                self.merge_states(np.flatnonzero(visited), np.asarray(values)[visited])
+            else:
+                self.import_csv(csv_path)
+        except storage.StorageError as e:
+            # an unreadable table is replaced by the next save
+            print("the q_agent values could not be loaded (" + str(e) + "), importing " + csv_path)
+            self.values = np.zeros(NUM_CLASSES)
+            self.visited = np.zeros(NUM_CLASSES, dtype=bool)
+            self.import_csv(csv_path)
+        self.dirty[:] = False
         print("Loaded q_agent values.")
 
+    # sets the values of states given by their base-3 indices, the values of symmetric states are averaged
+    def merge_states(self, indices, values):
+        classes = CLASS_ID[np.asarray(indices, dtype=np.int64)]
+        counts = np.bincount(classes, minlength=NUM_CLASSES)
+        sums = np.bincount(classes, weights=values, minlength=NUM_CLASSES)
+        merged = counts > 0
+        self.values[merged] = sums[merged] / counts[merged]
+        self.visited[merged] = True
+        self.dirty[merged] = True
+
+    # saves the whole table, replacing the file atomically
+    @stats.timed("rl.qagent.save_values")
     def save_values(self):
-        aux = 'white' if self.first_move else 'black'
-        s = 'datasets/qvalues_' + aux + '.csv'
-        try:
-            os.remove(s)
-        except:
-            pass
-        a = csv.writer(open(s, 'a', newline=''))
-
-        for v, k in self.values.items():
-            a.writerow([v, k])
+        # the memory maps of the file are released first, it can not be replaced while mapped on some systems
+        self.values, self.visited = np.array(self.values), np.array(self.visited)
+        storage.save_table(self.values_path('.bin'), self.values, self.visited, storage.FLAG_CANONICAL)
+        self.dirty[:] = False
         print("Saved q_agent values.")
 
-
+    # saves only the values that changed since the last save
+    @stats.timed("rl.qagent.flush_values")
+    def flush_values(self):
+        s = self.values_path('.bin')
+        try:
+            canonical = os.path.isfile(s) and storage.read_header(s)["flags"] & storage.FLAG_CANONICAL
+            if canonical:
+                storage.flush_table(s, self.values, self.visited, np.flatnonzero(self.dirty))
+        except storage.StorageError:
+            canonical = False
+        if not canonical:
+            self.save_values()
+            return
+        self.dirty[:] = False
+
+    # imports a csv file of states and values, the values of symmetric states are averaged
+    def import_csv(self, s):
+        indices, values = [], []
+        try:
+            with open(s, 'r', newline='') as f:
+                for row in csv.reader(f):
+                    k, v = row
+                    indices.append(key_to_index(k))
+                    values.append(float(v))
+        except FileNotFoundError:
+            pass
+        self.merge_states(indices, values)
+
+    # exports the values to a csv file, with one row for every class, keyed by its canonical state
+    def export_csv(self, s):
+        with open(s, 'w', newline='') as f:
+            a = csv.writer(f)
+            for index in np.flatnonzero(self.visited):
+                a.writerow([index_to_key(CANONICAL_STATES[index]), self.values[index]])
+
+
+'''
+    The values predicted by the network are kept in an LRU cache keyed by the base-3 index of the
+    state (see encode_state), which is emptied every time the network is trained. The states that
+    are not cached are predicted together in a single forward pass, done in numpy by a copy of the
+    weights of the network (see dense.py) that is refreshed after every training.
+
+    The transitions (prev_state, reward, state, terminal) are stored in a replay buffer, and every
+    train_freq transitions the network is trained with a minibatch sampled from it.
+    buffer_size:    Number of transitions kept in the replay buffer.
+    batch_size:     Number of transitions of every minibatch.
+    train_freq:     Number of transitions between two minibatches.
+    target_update:  Number of minibatches between two copies of the network into a frozen target
+                    network, used to calculate v(s'). None to calculate v(s') with the network itself.
+                    Ignored with play_only.
+    play_only:      If True, the agent only plays, with the weights exported to model_values_<color>.npz,
+                    and neither learns nor imports keras (unless the weights have not been exported yet).
+    directory:      Directory of the files of the network.
+'''
 class DeepAgent(Agent):
-    def __init__(self, first_move, exploration_factor=1):
+    def __init__(self, first_move, exploration_factor=1, cache_size=NUM_STATES, buffer_size=10000, batch_size=32,
+                 train_freq=4, target_update=None, play_only=False, directory="datasets"):
         super().__init__(first_move, exploration_factor)
-        self.value_model = self.load_model()
+        self.directory = directory
+        if play_only and os.path.isfile(self.model_path('.npz')):
+            self.value_model = None
+            self.network = dense.load(self.model_path('.npz'))
+        elif play_only:
+            self.value_model = None
+            self.network = dense.from_keras(self.load_model())
+        else:
+            self.value_model = self.load_model()
+            self.network = dense.from_keras(self.value_model)
+        self.target_model = None
+        # an agent that only plays never trains, so it has no target network
+        if target_update is not None and not play_only:
+            from keras.models import clone_model
+            self.target_model = clone_model(self.value_model)
+            self.target_model.set_weights(self.value_model.get_weights())
+        self.target_update = target_update
+
+        # replay buffer, stored in ring arrays
+        self.buffer_size = buffer_size
+        self.batch_size = batch_size
+        self.train_freq = train_freq
+        self.buffer_prev = np.zeros((buffer_size, 9), dtype=np.int8)
+        self.buffer_reward = np.zeros(buffer_size)
+        self.buffer_next = np.zeros((buffer_size, 9), dtype=np.int8)
+        self.buffer_terminal = np.zeros(buffer_size, dtype=bool)
+        self.buffer_count = 0  # number of transitions in the buffer
+        self.buffer_pos = 0  # position of the next transition
+        self.transitions = 0
+        self.train_steps = 0
+
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.predict_calls = 0
+        self.predicted_states = 0
 
     def learn_state(self, state, winner):
-        target = self.calc_target(state, winner)
-        self.train_model(target, 10)
+        aux = 1 if self.first_move else 2
+        if aux in state:
+            self.remember(self.prev_state, self.reward(winner), state, winner is not None)
+            if self.transitions % self.train_freq == 0 and self.buffer_count >= self.batch_size:
+                self.replay()
         self.prev_state = state
 
-    def load_model(self):
+    def learn_batch(self, prev_states, states, winners):
+        rewards = self.reward_batch(winners)
+        for i in range(len(states)):
+            self.remember(prev_states[i], rewards[i], states[i], winners[i] != bb.NONE)
+            if self.transitions % self.train_freq == 0 and self.buffer_count >= self.batch_size:
+                self.replay()
+
+    # adds a transition to the replay buffer, replacing the oldest one when it is full
+    def remember(self, prev_state, reward, state, terminal):
+        i = self.buffer_pos
+        self.buffer_prev[i] = prev_state.reshape(9)
+        self.buffer_reward[i] = reward
+        self.buffer_next[i] = state.reshape(9)
+        self.buffer_terminal[i] = terminal
+        self.buffer_pos = (i + 1) % self.buffer_size
+        self.buffer_count = min(self.buffer_count + 1, self.buffer_size)
+        self.transitions += 1
+
+    def model_path(self, extension):
         aux = 'white' if self.first_move else 'black'
-        s = 'datasets/model_values_' + aux + '.h5'
+        return os.path.join(self.directory, 'model_values_' + aux + extension)
+
+    # keras is only imported by the DeepAgent, so the QAgent can be used without loading it
+    @stats.timed("rl.deep.load_model")
+    def load_model(self):
+        from keras.layers import Dense
+        from keras.models import Sequential, load_model
+
+        s = self.model_path('.h5')
         model_file = Path(s)
         if model_file.is_file():
             model = load_model(s)
@@ -210,32 +567,98 @@ class DeepAgent(Agent):
         return model
 
     def calc_value(self, state):
-        return self.value_model.predict(state.reshape(1, 9))
-
-    def calc_target(self, state, winner):
-        aux = 1 if self.first_move else 2
-        if aux in state:
-            v_s = self.calc_value(self.prev_state)
-            r = self.reward(winner)
-
-            if winner is None:
-                v_s_tag = self.calc_value(state)
+        return self.calc_value_batch(state.reshape(1, 9))[0]
+
+    def calc_value_batch(self, states):
+        states = states.reshape(-1, 9)
+        return self.calc_value_indices(encode_states(states), states)
+
+    # the states are only decoded from their indices when they are not cached, unless they are given
+    def calc_value_indices(self, indices, states=None):
+        keys = np.asarray(indices).tolist()
+        values = np.empty(len(keys))
+        missing = []
+        for i, key in enumerate(keys):
+            v = self.cache.get(key)
+            if v is None:
+                missing.append(i)
             else:
-                v_s_tag = 0
+                values[i] = v
+                self.cache.move_to_end(key)
+        self.cache_hits += len(keys) - len(missing)
+        self.cache_misses += len(missing)
+        if stats.enabled:
+            stats.count("rl.deep.cache_hits", len(keys) - len(missing))
+            stats.count("rl.deep.cache_misses", len(missing))
+
+        if missing:
+            # every distinct state is predicted once
+            unique_keys, first, inverse = np.unique(np.array(keys)[missing], return_index=True, return_inverse=True)
+            batch = bb.decode_states(unique_keys) if states is None else states[missing][first]
+            with stats.timer("rl.deep.predict"):
+                predictions = self.network.predict(batch).reshape(-1).astype(float)
+            self.predict_calls += 1
+            self.predicted_states += len(unique_keys)
+            stats.count("rl.deep.predict_calls")
+            stats.count("rl.deep.predicted_states", len(unique_keys))
+            values[missing] = predictions[inverse.reshape(-1)]
+            for key, v in zip(unique_keys.tolist(), predictions.tolist()):
+                self.cache[key] = v
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+        return values
+
+    # returns the hit rate of the cache and the mean number of states of every forward pass
+    def cache_stats(self):
+        lookups = self.cache_hits + self.cache_misses
+        return {
+            "cache_hit_rate": self.cache_hits / lookups if lookups else 0.0,
+            "mean_batch_size": self.predicted_states / self.predict_calls if self.predict_calls else 0.0,
+            "predict_calls": self.predict_calls,
+        }
+
+    '''
+        Trains the network with a minibatch of the replay buffer. For every transition the target is
+        target = v(s) + α(v(s') + R - v(s)), with v(s') = 0 for terminal transitions.
+    '''
+    def replay(self, epochs=1):
+        if self.value_model is None:
+            return  # play-only agents do not learn
+        batch = np.random.randint(0, self.buffer_count, self.batch_size)
+        prev_states = self.buffer_prev[batch].astype(float)
+        next_states = self.buffer_next[batch].astype(float)
+        terminal = self.buffer_terminal[batch]
+
+        v_s = self.calc_value_batch(prev_states)
+        if self.target_model is not None:
+            v_s_tag = self.target_model.predict(next_states, verbose=0).reshape(-1)
+            stats.count("rl.deep.predict_calls")
+        else:
+            v_s_tag = self.calc_value_batch(next_states)
+        v_s_tag[terminal] = 0
 
-            target = np.array(v_s + self.alpha * (r + v_s_tag - v_s))
+        target = v_s + self.alpha * (self.buffer_reward[batch] + v_s_tag - v_s)
+        self.value_change += float(np.abs(target - v_s).sum())
+        self.value_updates += len(batch)
 
-            return target
+        with stats.timer("rl.deep.fit"):
+            self.value_model.fit(prev_states, target, epochs=epochs, batch_size=self.batch_size, verbose=0)
+        stats.count("rl.deep.fit_calls")
+        # the weights used for the predictions and the cached values are no longer the ones of the network
+        self.network = dense.from_keras(self.value_model)
+        self.cache.clear()
 
-    def train_model(self, target, epochs):
-        if target is not None:
-            self.value_model.fit(self.prev_state.reshape(1, 9), target, epochs=epochs, verbose=0)
+        self.train_steps += 1
+        if self.target_model is not None and self.train_steps % self.target_update == 0:
+            self.target_model.set_weights(self.value_model.get_weights())
 
+    @stats.timed("rl.deep.save_values")
     def save_values(self):
-        aux = 'white' if self.first_move else 'black'
-        s = 'datasets/model_values_' + aux + '.h5'
-        try:
-            os.remove(s)
-        except:
-            pass
-        self.value_model.save(s)
+        if self.value_model is None:
+            return
+        # the model is written to a temporary file first, so a crash never leaves a broken model
+        tmp = self.model_path('.tmp.h5')
+        self.value_model.save(tmp)
+        os.replace(tmp, self.model_path('.h5'))
+        dense.save(self.network, self.model_path('.npz'))
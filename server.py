@@ -0,0 +1,272 @@
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import ai
+import rl
+import stats
+
+
+'''
+    Local server that answers the moves of the AIs to other processes, so they do not need to embed
+    pygame or keras:
+
+    python server.py --port 8765
+    python server.py --unix /tmp/tictaitoe.sock
+
+    The protocol is one JSON object per line in both directions. A request is
+
+    {"id": 1, "ai": "minimax", "board": [[0, 1, 0], [0, 2, 0], [0, 0, 0]], "white_turn": true}
+
+    where the board uses the values of the play grid (0 empty, 1 white, 2 black), "white_turn" can
+    be omitted when it follows from the number of pieces, and minimax also accepts larger boards
+    with the win length in "k" and a "time_limit" in seconds. The answer echoes the id:
+
+    {"id": 1, "move": [2, 0], "score": 0}
+
+    with the score of minimax (+1 white wins, -1 black wins, 0 draw), the "policy" of the network
+    for nn and the "value" for qagent and deeprl, or an "error". The value is the one with which the
+    agent chose the move: the value of the position after the worst reply of the opponent, null if
+    the agent has no value for any reply.
+    Requests of a connection are answered as soon as they are ready, so a client can send several
+    before reading the answers.
+
+    The requests to the networks that arrive within a small window are coalesced into a single
+    batched forward pass, and the results of minimax are kept in a cache shared by every client.
+'''
+AI_TYPES = ("minimax", "nn", "qagent", "deeprl")
+DEFAULT_PORT = 8765
+
+
+'''
+    Coalesces the items submitted within window seconds, or until max_batch items are waiting,
+    into a single call of function, which receives the list of items and returns the list of
+    results. The function runs in executor, so the event loop keeps serving meanwhile.
+'''
+class Batcher:
+    def __init__(self, name, function, executor, window=0.002, max_batch=256):
+        self.name = name
+        self.function = function
+        self.executor = executor
+        self.window = window
+        self.max_batch = max_batch
+        self.pending = []
+        self.timer = None
+
+    async def submit(self, item):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((item, future))
+        if len(self.pending) >= self.max_batch:
+            self.flush()
+        elif self.timer is None:
+            self.timer = loop.call_later(self.window, self.flush)
+        return await future
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batch, self.pending = self.pending, []
+        if not batch:
+            return
+        stats.count("server." + self.name + ".batches")
+        stats.count("server." + self.name + ".items", len(batch))
+        stats.observe("server." + self.name + ".batch_size", len(batch), (1, 2, 4, 8, 16, 32, 64, 128, 256))
+        task = asyncio.get_running_loop().run_in_executor(self.executor, self.function, [item for item, _ in batch])
+        task.add_done_callback(lambda t: self.resolve(batch, t))
+
+    # passes the results of the batch to the futures of its items, the requests cancelled meanwhile are skipped
+    @staticmethod
+    def resolve(batch, task):
+        for i, (_, future) in enumerate(batch):
+            if future.done():
+                continue
+            if task.cancelled():
+                future.cancel()
+            elif task.exception() is not None:
+                future.set_exception(task.exception())
+            else:
+                future.set_result(task.result()[i])
+
+
+class RequestError(Exception):
+    pass
+
+
+class MoveServer:
+    def __init__(self, window=0.002, max_batch=256, cache_size=100000):
+        self.window = window
+        self.max_batch = max_batch
+        self.cache_size = cache_size
+        # keras and the agents are used from a single thread, and so is the minimax search
+        self.model_executor = ThreadPoolExecutor(max_workers=1)
+        self.search_executor = ThreadPoolExecutor(max_workers=1)
+        self.batchers = {}
+        self.minimax_cache = OrderedDict()
+        self.model = None
+        self.agents = {}
+
+    # returns the batcher of name, created the first time with the function returned by create
+    def batcher(self, name, create):
+        if name not in self.batchers:
+            self.batchers[name] = Batcher(name, create(), self.model_executor, self.window, self.max_batch)
+        return self.batchers[name]
+
+    def agent(self, ai_type, first_move):
+        key = (ai_type, first_move)
+        if key not in self.agents:
+            # the agents print when they load their values
+            with contextlib.redirect_stdout(io.StringIO()):
+                if ai_type == "qagent":
+                    self.agents[key] = rl.QAgent(first_move)
+                else:
+                    self.agents[key] = rl.DeepAgent(first_move, play_only=True)
+        return self.agents[key]
+
+    # returns the function that predicts the moves of a batch of boards with the imitation network
+    def network_moves(self):
+        def run(boards):
+            if self.model is None:
+                import nn
+                self.model = nn.load_play_model()
+            boards = np.array(boards).reshape(-1, 9)
+            policies = self.model.predict(boards)
+            stats.count("server.nn.predict_calls")
+            # the most probable legal move, as in nn.make_move
+            cells = np.where(boards == 0, policies, -np.inf).argmax(axis=1)
+            return [(int(cell), policy.tolist()) for cell, policy in zip(cells, policies)]
+        return run
+
+    # returns the function that chooses the moves of a batch of boards with the agents of ai_type
+    def agent_moves(self, ai_type, first_move):
+        def run(boards):
+            agent = self.agent(ai_type, first_move)
+            states = np.array(boards).reshape(-1, 9)
+            # the agents of the server never explore
+            agent.exp_factor = 1
+            cells = agent.select_moves(states)
+            # the value of the worst reply to every move, with which the lookahead of the agent chose it
+            values = agent.last_values
+            return [(int(cell), None if np.isnan(value) else float(value)) for cell, value in zip(cells, values)]
+        return run
+
+    # runs minimax in the search thread, or answers from the cache if the position has already been searched
+    async def minimax(self, board, white_turn, k, time_limit):
+        key = (board.shape, board.tobytes(), white_turn, k, time_limit)
+        if key in self.minimax_cache:
+            self.minimax_cache.move_to_end(key)
+            stats.count("server.minimax.cache_hits")
+            return self.minimax_cache[key]
+        stats.count("server.minimax.cache_misses")
+
+        def run():
+            best = ai.minimax(board, int((board == 0).sum()), white_turn, k, time_limit)
+            return best, ai.search_stats["nodes"]
+        result = await asyncio.get_running_loop().run_in_executor(self.search_executor, run)
+        self.minimax_cache[key] = result
+        while len(self.minimax_cache) > self.cache_size:
+            self.minimax_cache.popitem(last=False)
+        return result
+
+    async def answer(self, request):
+        ai_type = request.get("ai", "minimax")
+        if ai_type not in AI_TYPES:
+            raise RequestError("unknown ai: " + str(ai_type) + ", the AIs are " + ", ".join(AI_TYPES))
+        try:
+            board = np.array(request["board"], dtype=float)
+        except (KeyError, TypeError, ValueError):
+            raise RequestError("the request needs a board, as a list of rows")
+        if board.ndim != 2 or not np.isin(board, (0, 1, 2)).all():
+            raise RequestError("the board must be a list of rows of 0, 1 or 2")
+        if ai_type != "minimax" and board.shape != (3, 3):
+            raise RequestError(ai_type + " only plays on a 3x3 board")
+        white_turn = request.get("white_turn")
+        if white_turn is None:
+            white_turn = bool((board == 1).sum() == (board == 2).sum())
+        k = request.get("k")
+        if ai.check_victory(board, k) is not None:
+            raise RequestError("the game has already ended")
+
+        if ai_type == "minimax":
+            (row, column, score), nodes = await self.minimax(board, bool(white_turn), k, request.get("time_limit"))
+            return {"move": [int(row), int(column)], "score": score, "nodes": nodes}
+        if ai_type == "nn":
+            cell, policy = await self.batcher("nn", self.network_moves).submit(board)
+            return {"move": [cell // 3, cell % 3], "policy": policy}
+        name = ai_type + ("_white" if white_turn else "_black")
+        cell, value = await self.batcher(name, lambda: self.agent_moves(ai_type, bool(white_turn))).submit(board)
+        return {"move": [cell // 3, cell % 3], "value": value}
+
+    async def handle_line(self, line, writer, lock):
+        request_id = None
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise RequestError("the request must be a JSON object")
+            request_id = request.get("id")
+            with stats.timer("server.request"):
+                response = await self.answer(request)
+        except (RequestError, ValueError) as e:
+            response = {"error": str(e)}
+        except Exception as e:
+            response = {"error": type(e).__name__ + ": " + str(e)}
+        response["id"] = request_id
+        async with lock:
+            writer.write((json.dumps(response) + "\n").encode())
+            await writer.drain()
+
+    async def handle_connection(self, reader, writer):
+        lock = asyncio.Lock()
+        tasks = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                task = asyncio.create_task(self.handle_line(line, writer, lock))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host="127.0.0.1", port=DEFAULT_PORT, unix_path=None):
+        if unix_path is not None:
+            server = await asyncio.start_unix_server(self.handle_connection, unix_path)
+        else:
+            server = await asyncio.start_server(self.handle_connection, host, port)
+        async with server:
+            await server.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serves the moves of the AIs on localhost.")
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="TCP port to listen on")
+    parser.add_argument("--unix", default=None, help="path of a Unix socket to listen on instead of TCP")
+    parser.add_argument("--window-ms", type=float, default=2.0,
+                        help="milliseconds the requests to a network are collected before a forward pass")
+    parser.add_argument("--max-batch", type=int, default=256, help="maximum number of boards of a forward pass")
+    parser.add_argument("--cache-size", type=int, default=100000, help="positions kept in the minimax cache")
+    args = parser.parse_args()
+
+    stats.configure_from_env()
+    move_server = MoveServer(args.window_ms / 1000, args.max_batch, args.cache_size)
+    try:
+        asyncio.run(move_server.serve(args.host, args.port, args.unix))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stats.stop_dump()
@@ -0,0 +1,199 @@
+import functools
+import json
+import os
+import threading
+import time
+
+
+'''
+    Lightweight instrumentation of the hot paths: counters, gauges (last value), timers and
+    histograms. It is disabled by default; while disabled every function returns right away, and the
+    callers that need extra work to compute a value check stats.enabled first:
+
+    if stats.enabled:
+        stats.count("rl.qagent.misses", int(np.isnan(values).sum()))
+
+    The names are dotted, starting with the module that records them. get_stats() returns a snapshot
+    that can be serialised to JSON, and start_dump appends one to a JSONL file periodically. Setting
+    the TICTAITOE_STATS environment variable enables the statistics from the start, and
+    TICTAITOE_STATS_DUMP names the file of the periodic dump (see configure_from_env).
+'''
+enabled = False
+
+# upper bounds of the buckets of the latency histograms, in seconds. The last bucket has no bound
+LATENCY_BOUNDS = (0.0001, 0.0003, 0.001, 0.003, 0.01, 0.03, 0.1, 0.3, 1, 3, 10)
+
+_lock = threading.Lock()
+_counters = {}
+_gauges = {}
+_timers = {}  # name -> [count, total, max, last]
+_histograms = {}  # name -> (bounds, counts)
+_dump_thread = None
+_dump_stop = threading.Event()
+
+
+def enable():
+    global enabled
+    enabled = True
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+# forgets everything recorded so far
+def reset():
+    with _lock:
+        _counters.clear()
+        _gauges.clear()
+        _timers.clear()
+        _histograms.clear()
+
+
+# adds n to a counter
+def count(name, n=1):
+    if not enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+
+
+# sets the last value of a gauge
+def gauge(name, value):
+    if not enabled:
+        return
+    _gauges[name] = value
+
+
+# adds a value to a histogram with the given bucket bounds, the bounds of its first value are kept
+def observe(name, value, bounds=LATENCY_BOUNDS):
+    if not enabled:
+        return
+    with _lock:
+        _observe(name, value, bounds)
+
+
+def _observe(name, value, bounds):
+    if name not in _histograms:
+        _histograms[name] = (bounds, [0] * (len(bounds) + 1))
+    bounds, counts = _histograms[name]
+    i = 0
+    while i < len(bounds) and value > bounds[i]:
+        i += 1
+    counts[i] += 1
+
+
+# records a duration in seconds in a timer, which also keeps a histogram of the durations
+def record_time(name, seconds):
+    if not enabled:
+        return
+    with _lock:
+        t = _timers.get(name)
+        if t is None:
+            t = _timers[name] = [0, 0.0, 0.0, 0.0]
+        t[0] += 1
+        t[1] += seconds
+        t[2] = max(t[2], seconds)
+        t[3] = seconds
+        _observe(name, seconds, LATENCY_BOUNDS)
+
+
+class _Timer:
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        record_time(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_null_timer = _NullTimer()
+
+
+# context manager that records the time of its block: with stats.timer("ai.minimax"): ...
+def timer(name):
+    return _Timer(name) if enabled else _null_timer
+
+
+# decorator that records the time of every call of a function
+def timed(name):
+    def decorate(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return f(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                record_time(name, time.perf_counter() - start)
+        return wrapper
+    return decorate
+
+
+# returns a snapshot of every statistic, as a dictionary that can be serialised to JSON
+def get_stats():
+    with _lock:
+        return {
+            "time": time.time(),
+            "enabled": enabled,
+            "counters": dict(_counters),
+            "gauges": dict(_gauges),
+            "timers": {name: {"count": t[0], "total": t[1], "mean": t[1] / t[0], "max": t[2], "last": t[3]}
+                       for name, t in _timers.items()},
+            "histograms": {name: {"bounds": list(bounds), "counts": list(counts)}
+                           for name, (bounds, counts) in _histograms.items()},
+        }
+
+
+# appends a snapshot to a JSONL file
+def dump(path):
+    with open(path, "a") as f:
+        f.write(json.dumps(get_stats()) + "\n")
+
+
+# appends a snapshot to a JSONL file every interval seconds, from a background thread, until stop_dump is called
+def start_dump(path, interval=10.0):
+    global _dump_thread
+    stop_dump()
+    _dump_stop.clear()
+
+    def run():
+        while not _dump_stop.wait(interval):
+            dump(path)
+        dump(path)  # the last snapshot is written when the dump is stopped
+
+    _dump_thread = threading.Thread(target=run, daemon=True)
+    _dump_thread.start()
+
+
+def stop_dump():
+    global _dump_thread
+    if _dump_thread is not None:
+        _dump_stop.set()
+        _dump_thread.join()
+        _dump_thread = None
+
+
+# enables the statistics and the periodic dump from the TICTAITOE_STATS and TICTAITOE_STATS_DUMP variables
+def configure_from_env():
+    if os.environ.get("TICTAITOE_STATS") or os.environ.get("TICTAITOE_STATS_DUMP"):
+        enable()
+    if os.environ.get("TICTAITOE_STATS_DUMP"):
+        interval = float(os.environ.get("TICTAITOE_STATS_INTERVAL", "10"))
+        start_dump(os.environ["TICTAITOE_STATS_DUMP"], interval)
@@ -0,0 +1,106 @@
+import os
+
+import numpy as np
+
+'''
+    Binary storage of value tables. A table file has a 16 byte header followed by the raw arrays:
+
+    magic   (4 bytes)   b'TTQV'
+    version (uint32)    FORMAT_VERSION
+    count   (uint32)    number of entries
+    flags   (uint32)    FLAG_CANONICAL if the entries are symmetry classes (see bitboard.CLASS_ID)
+                        instead of base-3 state indices
+    values  (count float64)
+    visited (count uint8)
+
+    All the integers and floats are little-endian. Other tables, such as the perfect-play table of
+    perfect.py, use the same header with their own magic, followed by an array of fixed-size records.
+'''
+MAGIC = b"TTQV"
+FORMAT_VERSION = 1
+FLAG_CANONICAL = 1
+HEADER = np.dtype([("magic", "S4"), ("version", "<u4"), ("count", "<u4"), ("flags", "<u4")])
+
+
+class StorageError(Exception):
+    pass
+
+
+# writes data to path through a temporary file, so the file is either the old one or the new one after a crash
+def atomic_write(path, data):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        for chunk in data:
+            f.write(chunk)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def read_header(path, magic=MAGIC):
+    header = np.fromfile(path, dtype=HEADER, count=1)
+    if len(header) != 1 or header["magic"][0] != magic:
+        raise StorageError(path + " is not a " + ("value table" if magic == MAGIC else magic.decode() + " table"))
+    if header["version"][0] != FORMAT_VERSION:
+        raise StorageError(path + " has an unsupported version: " + str(header["version"][0]))
+    return header[0]
+
+
+# saves a whole table atomically
+def save_table(path, values, visited, flags=0):
+    header = np.zeros(1, dtype=HEADER)
+    header["magic"] = MAGIC
+    header["version"] = FORMAT_VERSION
+    header["count"] = len(values)
+    header["flags"] = flags
+    atomic_write(path, [header.tobytes(), np.asarray(values, dtype="<f8").tobytes(),
+                        np.asarray(visited, dtype=np.uint8).tobytes()])
+
+
+'''
+    Loads a table as copy-on-write memory maps, so the start-up cost does not depend on the size of
+    the table: the pages are read when they are first accessed, and the changes made to the arrays
+    are never written back to the file. Returns the arrays (values, visited).
+'''
+def load_table(path):
+    count = int(read_header(path)["count"])
+    if os.path.getsize(path) != HEADER.itemsize + 9 * count:
+        raise StorageError(path + " does not have " + str(count) + " entries")
+    values = np.memmap(path, dtype="<f8", mode="c", offset=HEADER.itemsize, shape=(count,))
+    visited = np.memmap(path, dtype=np.bool_, mode="c", offset=HEADER.itemsize + 8 * count, shape=(count,))
+    return values, visited
+
+
+'''
+    Writes only the given entries of the table into an existing file of the same size. Every entry
+    is a fixed-size slot, so the rest of the file is left untouched.
+'''
+def flush_table(path, values, visited, indices):
+    count = int(read_header(path)["count"])
+    if count != len(values):
+        raise StorageError(path + " has " + str(count) + " entries instead of " + str(len(values)))
+    file_values = np.memmap(path, dtype="<f8", mode="r+", offset=HEADER.itemsize, shape=(count,))
+    file_visited = np.memmap(path, dtype=np.bool_, mode="r+", offset=HEADER.itemsize + 8 * count, shape=(count,))
+    file_values[indices] = values[indices]
+    file_visited[indices] = visited[indices]
+    file_values.flush()
+    file_visited.flush()
+    del file_values, file_visited
+
+
+# saves an array of records of a structured dtype atomically, after a header with the given magic
+def save_records(path, records, magic, flags=0):
+    header = np.zeros(1, dtype=HEADER)
+    header["magic"] = magic
+    header["version"] = FORMAT_VERSION
+    header["count"] = len(records)
+    header["flags"] = flags
+    atomic_write(path, [header.tobytes(), np.ascontiguousarray(records).tobytes()])
+
+
+# loads an array of records saved by save_records as a read-only memory map
+def load_records(path, dtype, magic):
+    count = int(read_header(path, magic)["count"])
+    if os.path.getsize(path) != HEADER.itemsize + count * dtype.itemsize:
+        raise StorageError(path + " does not have " + str(count) + " records of " + str(dtype.itemsize) + " bytes")
+    return np.memmap(path, dtype=dtype, mode="r", offset=HEADER.itemsize, shape=(count,))
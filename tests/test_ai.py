@@ -0,0 +1,11 @@
+import ai
+
+
+def test_transposition_table_is_bounded_without_changing_the_search(monkeypatch):
+    full = ai.Search(3, 3, 3)
+    expected = full.search(0, 0, True)
+    monkeypatch.setattr(ai, "MAX_TABLE_ENTRIES", 50)
+    bounded = ai.Search(3, 3, 3)
+    assert len(full.table) > 50
+    assert bounded.search(0, 0, True)[0] == expected[0]
+    assert len(bounded.table) <= 50
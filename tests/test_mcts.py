@@ -0,0 +1,123 @@
+import random
+
+import numpy as np
+
+import arena
+import bitboard as bb
+import mcts
+import perfect
+
+
+# the positions of the 3x3 game reachable by legal play in which the game has not ended
+def open_positions():
+    states = bb.decode_states(perfect.legal_states())
+    return states[bb.check_victory_batch(states) == bb.NONE]
+
+
+def test_guide_does_not_play_the_first_empty_cell():
+    random.seed(0)
+    tree = mcts.Tree(guide="qagent", seed=0)
+    states = open_positions()
+    first_empty = same = 0
+    for state in states:
+        white_turn = bool((state == 1).sum() == (state == 2).sum())
+        cell = tree.guide_move(state.reshape(3, 3).astype(float), white_turn)
+        assert state[cell] == 0
+        same += cell == np.flatnonzero(state == 0)[0]
+        first_empty += 1
+    assert same < first_empty // 2
+
+
+def test_guided_playout_plays_the_moves_of_the_guide(monkeypatch):
+    random.seed(0)
+    monkeypatch.setattr(mcts, "GUIDE_EPSILON", 0)
+    tree = mcts.Tree(guide="qagent", seed=0)
+    played = []
+    guide_move = tree.guide_move
+
+    def record(state, white_turn):
+        cell = guide_move(state, white_turn)
+        played.append(cell)
+        return cell
+
+    monkeypatch.setattr(tree, "guide_move", record)
+    tree.guided_playout(0, 0, True)
+    assert played != list(range(len(played)))
+
+
+def test_merge_results_counts_every_process_once():
+    results = [(1, {0: (10, 6.0), 4: (5, 2.5)}), (2, {0: (3, 1.0)}), (1, {0: (10, 6.0), 4: (5, 2.5)})]
+    assert mcts.merge_results(results) == {0: (13, 7.0), 4: (5, 2.5)}
+
+
+def test_every_worker_searches_once_per_move():
+    agent = mcts.MCTSAgent(True, 5, 5, 4, playouts=200, workers=2)
+    try:
+        for white, black in ((0, 0), (1 << 12, 1 << 6)):
+            pids = [pid for pid, _ in agent.search_in_pool(white, black)]
+            assert len(set(pids)) == len(pids) == 2
+    finally:
+        agent.close()
+
+
+def test_broken_pool_falls_back_to_a_local_search():
+    agent = mcts.MCTSAgent(True, 5, 5, 4, playouts=200, workers=2)
+    try:
+        agent.search_move(0, 0)
+        # what a worker that timed out at the barrier leaves behind
+        agent.barrier.abort()
+        assert agent.search_move(1 << 12, 1 << 6) not in (12, 6)
+        assert agent.pool is None
+        agent.search_move(1 << 12, 1 << 6)
+        assert agent.pool is not None
+    finally:
+        agent.close()
+
+
+# returns the masks (white, black) of the cells of each side
+def masks(white_cells, black_cells):
+    return sum(1 << c for c in white_cells), sum(1 << c for c in black_cells)
+
+
+def test_plays_the_winning_move():
+    tree = mcts.Tree(seed=0)
+    moves = tree.search(*masks([0, 1], [3, 4]), True, playouts=500)
+    assert mcts.best_move(moves)[0] == 2
+
+
+def test_blocks_the_winning_move_of_the_opponent():
+    tree = mcts.Tree(seed=0)
+    moves = tree.search(*masks([0, 8], [3, 4]), True, playouts=500)
+    assert mcts.best_move(moves)[0] == 5
+
+
+def test_select_maximises_the_upper_confidence_bound():
+    parent = mcts.Node(None, None, 0, 0, True, bb.NONE, [])
+    parent.visits = 100
+    for move, (visits, wins) in enumerate([(50, 30.0), (40, 28.0), (10, 4.0)]):
+        child = mcts.Node(move, parent, 1 << move, 0, False, bb.NONE, [])
+        child.visits, child.wins = visits, wins
+        parent.children.append(child)
+    # the best mean reward wins without exploration, the least visited move with a lot of it
+    assert parent.select(0).move == 1
+    assert parent.select(10).move == 2
+
+
+def test_find_root_keeps_the_subtree_of_the_position_two_moves_later():
+    tree = mcts.Tree(seed=0)
+    tree.search(0, 0, True, playouts=300)
+    child = max(tree.root.children, key=lambda n: n.visits)
+    grandchild = max(child.children, key=lambda n: n.visits)
+    visits = grandchild.visits
+    root = tree.find_root(grandchild.white, grandchild.black, True)
+    assert root is grandchild
+    assert root.parent is None and root.visits == visits
+    tree.search(grandchild.white, grandchild.black, True, playouts=visits + 100)
+    assert tree.root is grandchild and grandchild.visits == visits + 100
+
+
+def test_arena_games_are_reproducible():
+    first = arena.run_tournament(["mcts:200", "random"], 4, workers=1, seed=0)
+    second = arena.run_tournament(["mcts:200", "random"], 4, workers=1, seed=0)
+    assert first["matches"] == second["matches"]
+    assert first["matches"][0]["losses"] == 0
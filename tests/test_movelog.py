@@ -0,0 +1,30 @@
+import threading
+
+import numpy as np
+
+import movelog
+
+
+def test_compact_counts_every_move_once_while_logging(tmp_path):
+    path, counts_path = str(tmp_path / "moves.log"), str(tmp_path / "moves_counts.bin")
+    logger = movelog.MoveLogger(path, flush_interval=0.001)
+    done = threading.Event()
+
+    def play():
+        rng = np.random.default_rng(0)
+        while not done.is_set():
+            logger.log(np.zeros((3, 3)), int(rng.integers(9)))
+
+    thread = threading.Thread(target=play)
+    thread.start()
+    try:
+        for _ in range(50):
+            movelog.compact(path, counts_path, chunk_size=64, stop=logger.flushed_records())
+    finally:
+        done.set()
+        thread.join()
+        logger.close()
+    movelog.compact(path, counts_path)
+    info, _, records = movelog.load_counts(counts_path)
+    assert int(info["cursor"]) == movelog.count_records(path)
+    assert int(info["moves"]) == int(records["counts"].sum()) == movelog.count_records(path)
@@ -0,0 +1,119 @@
+import contextlib
+import io
+import random
+
+import numpy as np
+
+import bitboard as bb
+import board
+import rl
+import storage
+
+
+def new_agent():
+    with contextlib.redirect_stdout(io.StringIO()):
+        agent = rl.QAgent(True)
+    # a copy in memory, so the table of the datasets is never modified
+    agent.values, agent.visited = np.array(agent.values), np.array(agent.visited)
+    return agent
+
+
+# transitions of white from boards with one piece of each side, repeating the same classes many times
+def transitions(n, seed):
+    rng = np.random.default_rng(seed)
+    prev_states = np.zeros((n, 9), dtype=int)
+    states = np.zeros((n, 9), dtype=int)
+    for i in range(n):
+        cells = rng.permutation(9)
+        prev_states[i, cells[:2]] = (1, 2)
+        states[i] = prev_states[i]
+        states[i, cells[2:4]] = (1, 2)
+    return prev_states, states
+
+
+def test_learn_batch_matches_learn_state_with_repeated_states():
+    prev_states, states = transitions(500, 0)
+    winners = np.full(len(states), bb.NONE)
+    batched, sequential = new_agent(), new_agent()
+    batched.learn_batch(prev_states, states, winners)
+    rl.Agent.learn_batch(sequential, prev_states, states, winners)
+    assert np.allclose(batched.values, sequential.values)
+    assert np.array_equal(batched.visited, sequential.visited)
+    assert np.isclose(batched.mean_value_change(), sequential.mean_value_change())
+
+
+def test_learn_batch_matches_learn_state_at_the_end_of_the_games():
+    prev_states, states = transitions(200, 1)
+    winners = np.random.default_rng(2).choice([bb.WHITE, bb.BLACK, bb.DRAW], len(states))
+    batched, sequential = new_agent(), new_agent()
+    batched.learn_batch(prev_states, states, winners)
+    rl.Agent.learn_batch(sequential, prev_states, states, winners)
+    assert np.allclose(batched.values, sequential.values)
+
+
+# transitions of white along random games of a few fixed openings, in a random order, so the next
+# state of many transitions is the previous state of others, before and after them in the batch
+def chained_transitions(n, seed):
+    rng = np.random.default_rng(seed)
+    openings = [rng.permutation(9) for _ in range(3)]
+    prev_states, states = [], []
+    for _ in range(n):
+        cells = openings[rng.integers(3)]
+        ply = 2 * rng.integers(3)
+        prev_state = np.zeros(9, dtype=int)
+        prev_state[cells[:ply:2]], prev_state[cells[1:ply:2]] = 1, 2
+        state = prev_state.copy()
+        state[cells[ply]], state[cells[ply + 1]] = 1, 2
+        prev_states.append(prev_state)
+        states.append(state)
+    return np.array(prev_states), np.array(states)
+
+
+def test_learn_batch_matches_learn_state_with_chained_states():
+    prev_states, states = chained_transitions(300, 3)
+    winners = bb.check_victory_batch(states)
+    batched, sequential = new_agent(), new_agent()
+    batched.learn_batch(prev_states, states, winners)
+    rl.Agent.learn_batch(sequential, prev_states, states, winners)
+    assert np.allclose(batched.values, sequential.values)
+    assert np.isclose(batched.mean_value_change(), sequential.mean_value_change())
+
+
+def test_board_moves_and_learning_match_the_grid_path():
+    on_board, on_grid = new_agent(), new_agent()
+    on_board.exp_factor = on_grid.exp_factor = 0.8
+    rng = random.Random(0)
+    for game in range(100):
+        position = board.Board(3, 3)
+        while position.result == bb.NONE:
+            if position.white_turn:
+                grid = position.to_grid()
+                seed = rng.getrandbits(32)
+                random.seed(seed)
+                cell = on_board.choose_move_and_learn(position)
+                random.seed(seed)
+                new_grid = on_grid.make_move_and_learn(grid, None)
+                assert new_grid.flat[cell] == 1 and (new_grid != grid).sum() == 1
+                position.play(cell)
+            else:
+                position.play(rng.choice(position.empty))
+        on_board.learn_board(position)
+        on_grid.learn_state(position.to_grid(), position.victory)
+    assert np.allclose(on_board.values, on_grid.values)
+
+
+def test_truncated_table_falls_back_to_the_csv_import(tmp_path):
+    agent = new_agent()
+    agent.values[:] = 0.25
+    agent.visited[:] = True
+    path = str(tmp_path / "values.bin")
+    storage.save_table(path, agent.values, agent.visited, storage.FLAG_CANONICAL)
+    with open(path, "r+b") as f:
+        f.truncate(100)
+    with open(tmp_path / "values.csv", "w") as f:
+        f.write("000000000,0.5\n")
+    with contextlib.redirect_stdout(io.StringIO()) as out:
+        agent.load_values(bin_path=path, csv_path=str(tmp_path / "values.csv"))
+    assert "could not be loaded" in out.getvalue()
+    assert agent.visited.sum() == 1
+    assert agent.values[rl.CLASS_ID[0]] == 0.5
@@ -0,0 +1,15 @@
+import asyncio
+
+import server
+
+
+def test_cancelled_batch_cancels_its_requests():
+    async def run():
+        loop = asyncio.get_running_loop()
+        waiting, answered = loop.create_future(), loop.create_future()
+        answered.set_result(0)
+        task = loop.create_future()
+        task.cancel()
+        server.Batcher.resolve([(1, waiting), (2, answered)], task)
+        return waiting.cancelled(), answered.result()
+    assert asyncio.run(run()) == (True, 0)
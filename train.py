@@ -0,0 +1,201 @@
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+import ai
+import perfect
+import rl
+import stats
+import vecenv
+
+
+'''
+    Headless self-play training of the RL-based AIs. It does not need a display, so it can run
+    for hours on a server:
+
+    python train.py qagent --games 1000000 --time 28800
+
+    The values are saved every checkpoint_every games, and the number of games already played is
+    kept in a state file, so an interrupted run resumes from its last checkpoint. Metrics of every
+    batch of games are appended to a JSONL file.
+'''
+
+
+# creates the pair of agents of the given AI type ("qagent" or "deeprl")
+def create_agents(ai_type, exploration_factor):
+    if ai_type == "qagent":
+        return rl.QAgent(True, exploration_factor), rl.QAgent(False, exploration_factor)
+    elif ai_type == "deeprl":
+        return rl.DeepAgent(True, exploration_factor), rl.DeepAgent(False, exploration_factor)
+    raise ValueError("unknown AI type: " + str(ai_type))
+
+
+# plays a full game between two agents that learn from it, and returns the winner
+def play_game(white_agent, black_agent):
+    grid = np.zeros((3, 3))
+    while ai.check_victory(grid) is None:
+        grid = white_agent.make_move_and_learn(grid, None)
+        if ai.check_victory(grid) is not None:
+            break
+        grid = black_agent.make_move_and_learn(grid, None)
+
+    winner = ai.check_victory(grid)
+    # update last state
+    white_agent.make_move_and_learn(grid, winner)
+    black_agent.make_move_and_learn(grid, winner)
+    # update winning state
+    white_agent.make_move_and_learn(grid, winner)
+    black_agent.make_move_and_learn(grid, winner)
+    return winner
+
+
+def load_state(state_path):
+    if state_path is not None and os.path.isfile(state_path):
+        with open(state_path) as f:
+            return json.load(f)
+    return {"games": 0, "elapsed": 0.0}
+
+
+def save_state(state_path, state):
+    if state_path is None:
+        return
+    tmp_path = state_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, state_path)
+
+
+'''
+    Trains the agents of ai_type by making them play against each other. Returns the number of games
+    played by this call.
+    num_games:          Stop after this many games in total (counting the resumed ones), None for no limit.
+    time_budget:        Stop after this many seconds of this call, None for no limit.
+    batch_size:         Number of games of every batch of metrics.
+    checkpoint_every:   Number of games between checkpoints of the values.
+    tolerance:          Stop when the mean absolute value change of a batch falls below it, None to disable.
+                        A batch in which no value was learned never stops the training.
+    metrics_path:       JSONL file where the metrics of every batch are appended, None to disable.
+    state_path:         File that keeps the progress of the run, so it can be resumed. None to disable.
+    stop_event:         threading.Event that stops the training when set.
+    num_envs:           Number of games played at once in a vecenv.VecEnv, None to play one game at a time.
+    progress:           Function called with the total number of games played after every batch.
+    eval_every:         Number of games between evaluations of the moves of the agents against the perfect-play
+                        table (see perfect.optimal_move_rate), added to the metrics. None to disable.
+'''
+def train(ai_type, num_games=None, time_budget=None, batch_size=100, checkpoint_every=1000, tolerance=None,
+          metrics_path=None, state_path=None, exploration_factor=0.8, stop_event=None, num_envs=None, progress=None,
+          eval_every=None):
+    white_agent, black_agent = create_agents(ai_type, exploration_factor)
+    self_play = vecenv.SelfPlay(white_agent, black_agent, num_envs) if num_envs is not None else None
+    state = load_state(state_path)
+    metrics = open(metrics_path, "a") if metrics_path is not None else None
+
+    start = time.perf_counter()
+    resumed_elapsed = state["elapsed"]
+    played = 0
+    last_checkpoint = state["games"]
+    last_eval = state["games"]
+    try:
+        while num_games is None or state["games"] < num_games:
+            batch_start = time.perf_counter()
+            batch = batch_size if num_games is None else min(batch_size, num_games - state["games"])
+            if self_play is not None:
+                # the games in progress may end at the same time, so a batch can be slightly larger
+                results = self_play.play(batch)
+                batch = sum(results.values())
+            else:
+                results = {"white": 0, "black": 0, "draw": 0}
+                for i in range(batch):
+                    results[play_game(white_agent, black_agent)] += 1
+            played += batch
+            state["games"] += batch
+            if progress is not None:
+                progress(state["games"])
+
+            now = time.perf_counter()
+            # the agents that learned nothing in the batch do not count
+            changes = [c for c in (white_agent.mean_value_change(), black_agent.mean_value_change()) if c is not None]
+            change = sum(changes) / len(changes) if changes else None
+            evaluation = {}
+            if eval_every is not None and state["games"] - last_eval >= eval_every:
+                evaluation = {"white_optimal_rate": perfect.optimal_move_rate(white_agent),
+                              "black_optimal_rate": perfect.optimal_move_rate(black_agent)}
+                last_eval = state["games"]
+            if metrics is not None:
+                metrics.write(json.dumps({
+                    "games": state["games"],
+                    "games_per_sec": batch / (now - batch_start),
+                    "white_win_rate": results["white"] / batch,
+                    "black_win_rate": results["black"] / batch,
+                    "draw_rate": results["draw"] / batch,
+                    "mean_value_change": change,
+                    "elapsed": resumed_elapsed + now - start,
+                    **(white_agent.cache_stats() if hasattr(white_agent, "cache_stats") else {}),
+                    **evaluation,
+                }) + "\n")
+                metrics.flush()
+
+            if state["games"] - last_checkpoint >= checkpoint_every:
+                state["elapsed"] = resumed_elapsed + now - start
+                checkpoint(white_agent, black_agent, state, state_path)
+                last_checkpoint = state["games"]
+
+            if tolerance is not None and change is not None and change < tolerance:
+                break
+            if time_budget is not None and now - start >= time_budget:
+                break
+            if stop_event is not None and stop_event.is_set():
+                break
+    finally:
+        state["elapsed"] = resumed_elapsed + time.perf_counter() - start
+        checkpoint(white_agent, black_agent, state, state_path)
+        if metrics is not None:
+            metrics.close()
+
+    return played
+
+
+# saves the values of both agents and the progress of the run
+def checkpoint(white_agent, black_agent, state, state_path):
+    white_agent.save_values()
+    black_agent.save_values()
+    save_state(state_path, state)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Trains the RL-based AIs by self-play, without a display.")
+    parser.add_argument("ai_type", choices=["qagent", "deeprl"])
+    parser.add_argument("--games", type=int, default=None, help="total number of games of the run")
+    parser.add_argument("--time", type=float, default=None, help="seconds of training of this invocation")
+    parser.add_argument("--batch-size", type=int, default=100, help="games of every batch of metrics")
+    parser.add_argument("--checkpoint-every", type=int, default=1000, help="games between checkpoints")
+    parser.add_argument("--tolerance", type=float, default=None,
+                        help="stop when the mean absolute value change of a batch falls below this value")
+    parser.add_argument("--exploration", type=float, default=0.8, help="exploration factor of the agents")
+    parser.add_argument("--envs", type=int, default=None,
+                        help="number of games played at once in a vectorised environment")
+    parser.add_argument("--eval-every", type=int, default=None,
+                        help="games between measures of the rate of optimal moves of the agents")
+    parser.add_argument("--metrics", default=None, help="JSONL file for the metrics of every batch")
+    parser.add_argument("--no-resume", action="store_true", help="start counting games from zero")
+    parser.add_argument("--stats", default=None, help="JSONL file where the statistics are dumped every 10 seconds")
+    args = parser.parse_args()
+
+    stats.configure_from_env()
+    if args.stats is not None:
+        stats.enable()
+        stats.start_dump(args.stats)
+
+    state_file = "datasets/train_" + args.ai_type + ".json"
+    metrics_file = args.metrics if args.metrics is not None else "datasets/train_" + args.ai_type + ".jsonl"
+    if args.no_resume and os.path.isfile(state_file):
+        os.remove(state_file)
+
+    try:
+        train(args.ai_type, args.games, args.time, args.batch_size, args.checkpoint_every, args.tolerance,
+              metrics_file, state_file, args.exploration, num_envs=args.envs, eval_every=args.eval_every)
+    finally:
+        stats.stop_dump()
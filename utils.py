@@ -1,6 +1,101 @@
-import numpy as np
+from collections import OrderedDict
+
 import pygame as pg
 
+# maximum number of pre-rendered text and button surfaces kept in memory
+SURFACE_CACHE_SIZE = 256
+
+# events after which the whole window has to be repainted
+EXPOSE_EVENTS = (pg.VIDEOEXPOSE, pg.WINDOWEXPOSED, pg.WINDOWRESTORED, pg.WINDOWSIZECHANGED)
+
+_fonts = {}
+_text_cache = OrderedDict()
+_button_cache = OrderedDict()
+_grid_layouts = {}
+
+# renderer that records what is drawn by the functions of this module, see Renderer
+_renderer = None
+
+
+class Renderer:
+    """
+        Presents the frames drawn on the screen. Every frame is fully drawn on the screen surface, but only the
+        regions where something has changed since the previous frame are copied to the window, and nothing at all
+        when the frame is identical. The functions of this module report what they draw with mark.
+        screen:         Screen surface of the window.
+        fps:            Maximum number of frames per second.
+        idle_timeout:   Maximum time in milliseconds to wait for an event when the game is idle.
+    """
+    def __init__(self, screen, fps=60, idle_timeout=500):
+        global _renderer
+        self.screen = screen
+        self.fps = fps
+        self.idle_timeout = idle_timeout
+        self.clock = pg.time.Clock()
+        self.items = {}  # what has been drawn in the current frame, as {key: rect}
+        self.previous = {}  # what was drawn in the previous frame
+        self.full_update = True  # the first frame is copied entirely
+        self.idle = False  # tells if the last frame was identical to the previous one
+        _renderer = self
+
+    # returns the events of the frame. When the last frame did not change and the game is not busy, the renderer
+    # sleeps until an event arrives or idle_timeout expires
+    def events(self, busy=False):
+        if self.idle and not busy:
+            event = pg.event.wait(self.idle_timeout)
+            events = [event] + pg.event.get() if event.type != pg.NOEVENT else []
+        else:
+            events = pg.event.get()
+        if any(event.type in EXPOSE_EVENTS for event in events):
+            self.full_update = True
+        return events
+
+    # records that rect has been drawn with the content identified by key
+    def mark(self, rect, key):
+        self.items[key] = rect
+
+    # copies the regions that have changed to the window and waits to keep the frame rate under fps
+    def present(self):
+        if self.full_update:
+            pg.display.flip()
+            self.full_update = False
+            self.idle = False
+        else:
+            dirty = [rect for key, rect in self.items.items() if key not in self.previous]
+            dirty += [rect for key, rect in self.previous.items() if key not in self.items]
+            if dirty:
+                pg.display.update(dirty)
+            self.idle = not dirty
+        self.previous, self.items = self.items, {}
+        self.clock.tick(self.fps)
+
+
+def _mark(rect, key):
+    if _renderer is not None:
+        _renderer.mark(rect, key)
+
+
+# returns the default font of the given size, created only once
+def get_font(size):
+    if size not in _fonts:
+        _fonts[size] = pg.font.Font(None, size)
+    return _fonts[size]
+
+
+def _cached(cache, key, create):
+    if key in cache:
+        cache.move_to_end(key)
+        return cache[key]
+    surface = cache[key] = create()
+    if len(cache) > SURFACE_CACHE_SIZE:
+        cache.popitem(last=False)
+    return surface
+
+
+# returns the rendered surface of the text, which is only rendered the first time it is displayed
+def render_text(text, font, color):
+    return _cached(_text_cache, (text, font, color), lambda: font.render(text, True, color))
+
 
 def display_text(text, font, color, center_x, center_y, display):
     """
@@ -12,11 +107,22 @@ def display_text(text, font, color, center_x, center_y, display):
         center_y:   Vertical coordinate of the center of the text box.
         display:    Screen surface that will display the text.
     """
-    text_surf = font.render(text, True, color)
+    text_surf = render_text(text, font, color)
     text_rect = text_surf.get_rect()
     text_rect.center = center_x, center_y
     display.blit(text_surf, text_rect)
-    
+    _mark(text_rect, ("text", text, font, color, text_rect.topleft))
+
+
+def _render_button(msg, size, color, tc, bc, font, bw):
+    surface = pg.Surface(size)
+    rect = surface.get_rect()
+    surface.fill(color)
+    pg.draw.rect(surface, bc, rect, bw)
+    text_surf = render_text(msg, font, tc)
+    surface.blit(text_surf, text_surf.get_rect(center=rect.center))
+    return surface
+
 
 def button(msg, rect, ic, ac, tc, display, mouse, bc=(0,0,0), font=None, bw=2, action=None, arg=None):
     """
@@ -37,35 +143,44 @@ def button(msg, rect, ic, ac, tc, display, mouse, bc=(0,0,0), font=None, bw=2, a
     click = pg.mouse.get_pressed()
 
     if font is None:
-        font = pg.font.Font(None, 24)
-
-    if rect.x + rect.w > mouse[0] > rect.x and rect.y + rect.h > mouse[1] > rect.y:
-        pg.draw.rect(display, ac, rect)
-
-        if click[0] == 1 and action is not None:
-            if arg is not None:
-                action(arg)
-            else:
-                action()
-    else:
-        pg.draw.rect(display, ic, rect)
-
-    pg.draw.rect(display, bc, rect, bw)
-
-    display_text(msg, font, tc, rect.x + (rect.w / 2), rect.y + (rect.h / 2), display)
-    
-    
-# display the play grid
-def display_grid(grid, screen, mouse, cell_margin, grid_w, grid_h, margin_x, margin_y):
-    cells = [s for s, v in np.ndenumerate(grid)]
-    for x in cells:
-        color = (84, 145, 255)
-        if grid[x] == 1:
-            color = (255, 255, 255)  # white
-        elif grid[x] == 2:
-            color = (0, 0, 0)  # black
-        elif (mouse[1] - margin_y) // (grid_h + cell_margin) == x[0] \
-                and (mouse[0] - margin_x) // (grid_w + cell_margin) == x[1]:
-            color = (105, 158, 255)
-        pg.draw.rect(screen, color, [(cell_margin + grid_w) * x[1] + cell_margin + margin_x,
-                                     (cell_margin + grid_h) * x[0] + cell_margin + margin_y, grid_w, grid_h])
+        font = get_font(24)
+
+    hovered = rect.x + rect.w > mouse[0] > rect.x and rect.y + rect.h > mouse[1] > rect.y
+    color = ac if hovered else ic
+    if hovered and click[0] == 1 and action is not None:
+        if arg is not None:
+            action(arg)
+        else:
+            action()
+
+    # the button is drawn once for each state and then copied from the cache
+    key = (msg, rect.size, color, tc, bc, font, bw)
+    display.blit(_cached(_button_cache, key, lambda: _render_button(msg, rect.size, color, tc, bc, font, bw)), rect)
+    _mark(rect, ("button", rect.topleft) + key)
+
+
+# returns the rectangles of the cells of the grid, computed once for every layout
+def _grid_layout(shape, cell_margin, grid_w, grid_h, margin_x, margin_y):
+    key = (shape, cell_margin, grid_w, grid_h, margin_x, margin_y)
+    if key not in _grid_layouts:
+        _grid_layouts[key] = [pg.Rect((cell_margin + grid_w) * c + cell_margin + margin_x,
+                                      (cell_margin + grid_h) * r + cell_margin + margin_y, grid_w, grid_h)
+                              for r in range(shape[0]) for c in range(shape[1])]
+    return _grid_layouts[key]
+
+
+# colors of the empty, white and black cells
+CELL_COLORS = ((84, 145, 255), (255, 255, 255), (0, 0, 0))
+HOVER_COLOR = (105, 158, 255)
+
+
+# display the play grid of a board.Board
+def display_grid(board, screen, mouse, cell_margin, grid_w, grid_h, margin_x, margin_y):
+    rects = _grid_layout((board.rows, board.cols), cell_margin, grid_w, grid_h, margin_x, margin_y)
+    row = (mouse[1] - margin_y) // (grid_h + cell_margin)
+    column = (mouse[0] - margin_x) // (grid_w + cell_margin)
+    hovered = int(row * board.cols + column) if 0 <= row < board.rows and 0 <= column < board.cols else -1
+    for i, value in enumerate(board.cells):
+        color = HOVER_COLOR if value == 0 and i == hovered else CELL_COLORS[value]
+        pg.draw.rect(screen, color, rects[i])
+        _mark(rects[i], ("cell", i, color))
@@ -0,0 +1,98 @@
+import numpy as np
+
+import bitboard as bb
+
+
+'''
+    Vectorised environment that plays N games of tic-tac-toe at once. The boards are stored in an
+    (N, 9) int8 array (0 = empty cell, 1 = white cell, 2 = black cell), and every game has its own
+    turn, so the games that end are reset without waiting for the others.
+'''
+class VecEnv:
+    def __init__(self, num_games):
+        self.num_games = num_games
+        self.boards = np.zeros((num_games, 9), dtype=np.int8)
+        self.white_turn = np.ones(num_games, dtype=bool)
+
+    def reset(self, games=None):
+        if games is None:
+            games = slice(None)
+        self.boards[games] = 0
+        self.white_turn[games] = True
+
+    # returns an (N, 9) boolean array of the empty cells of every game
+    def legal_moves(self):
+        return self.boards == 0
+
+    # returns the result codes of every game (see bitboard.py)
+    def winners(self):
+        return bb.check_victory_batch(self.boards)
+
+    '''
+        Plays a move in every game, actions being the (N,) array of the cells chosen by the player of
+        each game. The games that end are reset. Returns (boards, winners): the boards right after the
+        moves, before any reset, and their result codes.
+    '''
+    def step(self, actions):
+        games = np.arange(self.num_games)
+        if not (self.boards[games, actions] == 0).all():
+            raise ValueError("illegal move: the cell is not empty")
+
+        self.boards[games, actions] = np.where(self.white_turn, 1, 2)
+        boards = self.boards.copy()
+        winners = bb.check_victory_batch(boards)
+        self.white_turn = ~self.white_turn
+        self.reset(winners != bb.NONE)
+        return boards, winners
+
+
+'''
+    Self-play of two agents (see rl.Agent) over a VecEnv. Both agents choose the moves of all their
+    games at once with select_moves and learn with learn_batch, from the same transitions that
+    make_move_and_learn would see in a game played one move at a time.
+'''
+class SelfPlay:
+    def __init__(self, white_agent, black_agent, num_envs=1024):
+        self.env = VecEnv(num_envs)
+        self.agents = {True: white_agent, False: black_agent}
+        # board of every game at the previous turn of each agent
+        self.prev_states = {True: np.zeros((num_envs, 9), dtype=np.int8),
+                            False: np.zeros((num_envs, 9), dtype=np.int8)}
+
+    # plays until at least num_games games have ended, and returns the number of games won by each side
+    def play(self, num_games):
+        results = {"white": 0, "black": 0, "draw": 0}
+        played = 0
+        actions = np.zeros(self.env.num_games, dtype=np.int64)
+        while played < num_games:
+            for white in (True, False):
+                agent = self.agents[white]
+                games = np.flatnonzero(self.env.white_turn == white)
+                if len(games) == 0:
+                    continue
+                states = self.env.boards[games]
+                # the agent learns from its previous turn once it has a piece on the board
+                learn = (states == (1 if white else 2)).any(axis=1)
+                if learn.any():
+                    agent.learn_batch(self.prev_states[white][games[learn]], states[learn],
+                                      np.zeros(learn.sum(), dtype=np.int8))
+                self.prev_states[white][games] = states
+                actions[games] = agent.select_moves(states)
+
+            boards, winners = self.env.step(actions)
+            ended = np.flatnonzero(winners != bb.NONE)
+            if len(ended) == 0:
+                continue
+
+            for white in (True, False):
+                agent = self.agents[white]
+                # update last state
+                agent.learn_batch(self.prev_states[white][ended], boards[ended], winners[ended])
+                # update winning state
+                agent.learn_batch(boards[ended], boards[ended], winners[ended])
+                self.prev_states[white][ended] = 0
+
+            for code in winners[ended]:
+                results[bb.VICTORY_NAMES[code]] += 1
+            played += len(ended)
+        return results